@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+"""Time the scoring, counting and ingestion hot paths on synthetic data,
+and compare the results with those of another revision.
+
+Usage::
+    python hotpaths.py run [numdocs] [output.json] [repeat]
+    python hotpaths.py compare old.json new.json [tolerance]
+
+The pure Python backends and the smaller benchmarks use at most
+L{small_docs} of the synthetic citations, so that L{run} finishes in
+reasonable time for up to 16M citations.
+"""
+
+from __future__ import with_statement
+from __future__ import division
+
+__author__ = "Graham Poulter"
+__license__ = """This program is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your option)
+any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>."""
+
+from cStringIO import StringIO
+import logging
+import numpy as nx
+from path import path
+import platform
+import subprocess as sp
+import sys
+import tempfile
+import time
+import traceback
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from mscanner.benchmarks.synthetic import SyntheticVectors, medline_xml
+from mscanner.core import iofuncs
+from mscanner.core.FeatureScores import FeatureScores
+from mscanner.core.Validator import cross_validate
+from mscanner.core.metrics import PerformanceVectors
+from mscanner.configuration import rc
+from mscanner.fastscores.FeatureCounter import FeatureCounter
+from mscanner.fastscores.ScoreCalculator import ScoreCalculator
+from mscanner.medline.Article import Article
+from mscanner.medline.FeatureData import FeatureData
+from mscanner.medline.FeatureStream import \
+     vb_encode, vb_decode, vb_encode_many, vb_decode_many
+
+
+small_docs = 100000
+"""Maximum number of citations for the slower benchmarks"""
+
+xml_docs = 2000
+"""Number of citations of Medline XML to parse"""
+
+
+def timed(function, repeat):
+    """Call a function several times.
+    @return: Least time taken by one call, in seconds."""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+class Benchmarks:
+    """Collects the timings of the hot paths on one set of synthetic data.
+
+    @ivar workdir: Temporary directory for the synthetic files.
+
+    @ivar numdocs: Number of citations in the large feature stream.
+
+    @ivar repeat: Number of times to call each function (we keep the best time).
+
+    @ivar results: Dictionary from benchmark name to a dictionary with
+    "seconds", "items" and "rate" (items per second), or with "error" or
+    "skipped" giving the reason for not having a time.  Benchmarks reading a
+    feature stream may also give its size in "bytes".
+    """
+
+    def __init__(self, workdir, numdocs, repeat=3):
+        self.workdir = workdir
+        self.numdocs = numdocs
+        self.repeat = repeat
+        self.results = {}
+        self.synth = SyntheticVectors()
+        self.numfeats = self.synth.numfeats
+
+
+    def time(self, name, items, function, repeat=None):
+        """Time a function processing the given number of items, recording
+        an error instead if it raises an exception."""
+        try:
+            seconds = timed(function, self.repeat if repeat is None else repeat)
+        except Exception, e:
+            logging.error("%s failed: %s", name, traceback.format_exc())
+            self.results[name] = dict(error="%s: %s" % (type(e).__name__, e))
+            return
+        logging.info("%s: %d items in %.3fs (%.0f/s)", name, items, seconds,
+                     items/seconds if seconds > 0 else 0)
+        self.results[name] = dict(seconds=seconds, items=items,
+            rate=items/seconds if seconds > 0 else None)
+
+
+    def skip(self, name, reason):
+        """Record that a benchmark could not be run"""
+        logging.info("%s: skipped (%s)", name, reason)
+        self.results[name] = dict(skipped=reason)
+
+
+    def run_all(self):
+        """Run every benchmark, returning L{results}"""
+        self.bench_streams()
+        self.bench_vb()
+        self.bench_counter()
+        self.bench_scores()
+        self.bench_reorder()
+        self.bench_validation()
+        self.bench_ingest()
+        return self.results
+
+
+    def bench_streams(self):
+        """Write the large and small synthetic feature streams"""
+        self.stream = self.workdir / "large.stream"
+        self.small = self.workdir / "small.stream"
+        self.time("FeatureStream.write", self.numdocs,
+                  lambda: SyntheticVectors().write_stream(self.stream, self.numdocs), 1)
+        self.nsmall = min(self.numdocs, small_docs)
+        SyntheticVectors().write_stream(self.small, self.nsmall)
+
+
+    def bench_vb(self):
+        """Variable byte encoding and decoding of feature vectors"""
+        values, indptr = self.synth.vectors(self.nsmall)
+        vectors = [values[indptr[i]:indptr[i+1]].tolist() for i in xrange(self.nsmall)]
+        encoded = [vb_encode(v) for v in vectors]
+        self.time("vb_encode", self.nsmall, lambda: [vb_encode(v) for v in vectors])
+        self.time("vb_decode", self.nsmall, lambda: [vb_decode(s) for s in encoded])
+        self.time("vb_encode_many", self.nsmall, lambda: vb_encode_many(values, indptr))
+        self.time("vb_decode_many", self.nsmall, lambda: vb_decode_many(encoded))
+
+
+    def bench_counter(self):
+        """FeatureCounter backends"""
+        def counter(stream, numdocs):
+            return FeatureCounter(stream, numdocs, self.numfeats,
+                                  mindate=19950101, maxdate=20051231)
+        self.time("FeatureCounter.py_counts", self.nsmall,
+                  lambda: counter(self.small, self.nsmall).py_counts(), 1)
+        fc = counter(self.stream, self.numdocs)
+        if fc.counter_path.isfile():
+            self.time("FeatureCounter.c_counts", self.numdocs, fc.c_counts)
+        else:
+            self.skip("FeatureCounter.c_counts", "%s not built" % fc.counter_path.name)
+
+
+    def bench_scores(self):
+        """ScoreCalculator backends, with dense and sparse feature scores"""
+        rng = nx.random.RandomState(1)
+        featscores = rng.normal(0, 1, self.numfeats).astype(nx.float32)
+        featscores[rng.random_sample(self.numfeats) < 0.8] = 0
+        ids = nx.flatnonzero(featscores)
+        def scorer(stream, numdocs, scores):
+            return ScoreCalculator(stream, numdocs, scores, offset=-5.0,
+                limit=500, mindate=19950101, maxdate=20051231,
+                numfeats=self.numfeats)
+        self.time("ScoreCalculator.pyscore", self.nsmall,
+                  scorer(self.small, self.nsmall, featscores).pyscore, 1)
+        sc = scorer(self.stream, self.numdocs, featscores)
+        if sc.score_exec.isfile():
+            self.time("ScoreCalculator.cscore_pipe", self.numdocs, sc.cscore_pipe)
+            self.time("ScoreCalculator.cscore_pipe(sparse)", self.numdocs,
+                scorer(self.stream, self.numdocs, (ids, featscores[ids])).cscore_pipe)
+        else:
+            self.skip("ScoreCalculator.cscore_pipe", "%s not built" % sc.score_exec.name)
+        if sc.score_dll.isfile():
+            self.time("ScoreCalculator.cscore_dll", self.numdocs, sc.cscore_dll)
+        else:
+            self.skip("ScoreCalculator.cscore_dll", "%s not built" % sc.score_dll.name)
+
+
+    def bench_reorder(self):
+        """Scoring a feature stream before and after renumbering its features
+        by frequency with L{FeatureData.reorder}.  The synthetic Zipf
+        feature IDs are shuffled first, since they are already in order of
+        frequency, while real feature IDs are in order of first appearance."""
+        index = self.workdir / "reorder"
+        index.makedirs()
+        fd = FeatureData(index/"fmap", index/"fdb", index/"stream",
+                         "feats_mesh_qual_issn", rdonly=False)
+        rng = nx.random.RandomState(3)
+        shuffle = nx.concatenate(([0], 1 + rng.permutation(self.numfeats-1)))
+        pmids, dates, values, indptr = self.synth.records(self.nsmall)
+        values = shuffle[values]
+        vector = nx.repeat(nx.arange(self.nsmall), indptr[1:]-indptr[:-1])
+        values = values[nx.lexsort((values, vector))]
+        counts = nx.bincount(values, minlength=self.numfeats)
+        fd.featmap.add_features([("mesh", "F%d" % i) for i in xrange(1, self.numfeats)],
+                                counts[1:])
+        records = zip(pmids.tolist(), dates.tolist(), vb_encode_many(values, indptr))
+        fd.featuredb.bulk_load(records)
+        for pmid, date, featvec in records:
+            fd.fstream.additem(pmid, date, featvec)
+        fd.fstream.flush()
+        fd.featmap.commit()
+        featscores = rng.normal(0, 1, self.numfeats).astype(nx.float32)
+        def score(name):
+            stream = fd.fstream.filename
+            sc = ScoreCalculator(stream, self.nsmall, featscores, offset=-5.0,
+                limit=500, mindate=19950101, maxdate=20051231)
+            if not sc.score_exec.isfile():
+                self.skip(name, "%s not built" % sc.score_exec.name)
+                return
+            self.time(name, self.nsmall, sc.cscore_pipe)
+            if "seconds" in self.results[name]:
+                self.results[name]["bytes"] = stream.getsize()
+                logging.info("%s: stream of %d bytes", name, stream.getsize())
+        try:
+            score("ScoreCalculator.cscore_pipe(shuffled)")
+            self.time("FeatureData.reorder", self.nsmall, fd.reorder, 1)
+            score("ScoreCalculator.cscore_pipe(reordered)")
+        finally:
+            fd.close()
+
+
+    def bench_validation(self):
+        """Cross validation and performance statistics"""
+        rc.mincount = 0
+        rc.min_infogain = 0
+        rc.type_mask = []
+        npos, nneg = 1000, min(self.nsmall, 10000)
+        positives = self.synth.vector_list(npos)
+        negatives = self.synth.vector_list(nneg)
+        featinfo = FeatureScores([0]*self.numfeats, "scores_laplace_split")
+        self.time("cross_validate", npos+nneg,
+                  lambda: cross_validate(featinfo, positives, negatives, 10))
+        rng = nx.random.RandomState(2)
+        pscores = rng.normal(2, 1, 1000).astype(nx.float32)
+        nscores = rng.normal(0, 1, self.nsmall).astype(nx.float32)
+        self.time("PerformanceVectors", len(pscores)+len(nscores),
+                  lambda: PerformanceVectors(pscores, nscores, 0.5))
+
+
+    def bench_ingest(self):
+        """Parsing Medline XML and adding articles to a feature index"""
+        xml = medline_xml(xml_docs)
+        self.time("Article.parse_medline_xml", xml_docs,
+                  lambda: list(Article.parse_medline_xml(StringIO(xml))))
+        articles = list(Article.parse_medline_xml(StringIO(xml)))
+        def add_articles():
+            index = self.workdir / "index"
+            if index.exists():
+                index.rmtree()
+            index.makedirs()
+            fd = FeatureData(index/"fmap", index/"fdb", index/"stream",
+                             "feats_mesh_qual_issn", rdonly=False)
+            fd.add_articles(articles, check=False)
+            fd.close()
+        self.time("FeatureData.add_articles", xml_docs, add_articles, 1)
+
+
+
+def revision():
+    """Git commit of the source tree, or None if unavailable"""
+    try:
+        p = sp.Popen(["git", "rev-parse", "HEAD"], stdout=sp.PIPE,
+                     stderr=sp.PIPE, cwd=path(__file__).dirname())
+        commit = p.communicate()[0].strip()
+        return commit if p.returncode == 0 else None
+    except OSError:
+        return None
+
+
+def run(numdocs=1000000, output="benchmarks.json", repeat=3):
+    """Run the benchmarks and save the results as JSON.
+    @param numdocs: Number of synthetic citations (up to about 16M).
+    @param output: Path of the JSON file to write.
+    @param repeat: Number of times to call each function."""
+    numdocs, repeat = int(numdocs), int(repeat)
+    workdir = path(tempfile.mkdtemp(prefix="benchmarks-"))
+    try:
+        results = Benchmarks(workdir, numdocs, repeat).run_all()
+    finally:
+        workdir.rmtree(ignore_errors=True)
+    report = dict(
+        commit = revision(),
+        date = time.strftime("%Y-%m-%d %H:%M:%S"),
+        python = platform.python_version(),
+        numpy = nx.__version__,
+        machine = platform.platform(),
+        numdocs = numdocs,
+        results = results)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    logging.info("Wrote benchmark results to %s", output)
+    return report
+
+
+def compare(old, new, tolerance=0.1):
+    """Compare rates in two JSON files written by L{run}, exiting with
+    status 1 if any benchmark slowed down by more than the tolerance.
+    @param old, new: Paths to JSON results.
+    @param tolerance: Fraction of the old rate that may be lost."""
+    tolerance = float(tolerance)
+    with open(old) as f: old = json.load(f)
+    with open(new) as f: new = json.load(f)
+    if old["numdocs"] != new["numdocs"]:
+        logging.warning("Comparing runs with %d and %d citations",
+                        old["numdocs"], new["numdocs"])
+    regressions = []
+    for name in sorted(set(old["results"]) | set(new["results"])):
+        orate = old["results"].get(name, {}).get("rate")
+        nrate = new["results"].get(name, {}).get("rate")
+        if orate is None or nrate is None:
+            print "%-40s %12s %12s" % (name, orate and "%.0f" % orate, nrate and "%.0f" % nrate)
+            continue
+        ratio = nrate / orate
+        flag = ""
+        if ratio < 1 - tolerance:
+            flag = "REGRESSION"
+            regressions.append(name)
+        print "%-40s %12.0f %12.0f %6.2fx %s" % (name, orate, nrate, ratio, flag)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    # Call the named function with provided arguments
+    iofuncs.start_logger()
+    locals()[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,144 @@
+"""Generates synthetic feature streams and Medline XML for benchmarking"""
+
+from __future__ import with_statement
+from __future__ import division
+from contextlib import closing
+import numpy as nx
+
+from mscanner.medline.FeatureStream import FeatureStream, vb_encode_many
+
+
+__author__ = "Graham Poulter"
+__license__ = """This program is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your option)
+any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>."""
+
+
+class SyntheticVectors:
+    """Random feature vectors resembling those of Medline citations. Vector
+    lengths are 1 plus a Poisson variate, and feature IDs follow a Zipf
+    distribution (feature ID k has probability proportional to 1/k**skew),
+    as feature frequencies do in text and MeSH indexing.
+
+    The defaults resemble the feats_mesh_qual_issn feature space, with about
+    18 features per citation out of 30000.  For word features, try
+    numfeats=2000000 and meanlen=100.
+
+    @ivar numfeats: Size of the feature space (feature 0 is never used).
+
+    @ivar meanlen: Mean number of features per vector (before removing
+    repeated features).
+
+    @ivar skew: Exponent of the Zipf distribution of feature IDs.
+
+    @ivar rng: Numpy RandomState for generating the vectors.
+    """
+
+    def __init__(self, numfeats=30000, meanlen=18, skew=1.1, seed=0):
+        self.numfeats = numfeats
+        self.meanlen = meanlen
+        self.skew = skew
+        self.rng = nx.random.RandomState(seed)
+        # Cumulative distribution of feature IDs 1..numfeats-1
+        weights = 1.0 / nx.arange(1, numfeats, dtype=nx.float64) ** skew
+        self._cdf = nx.cumsum(weights) / nx.sum(weights)
+
+
+    def vectors(self, count):
+        """Generate sorted feature vectors without repeated features.
+        @return: Concatenated feature IDs, and the array of start positions
+        of each vector in them (the last being the total length)."""
+        lengths = 1 + self.rng.poisson(self.meanlen-1, count)
+        total = int(lengths.sum())
+        values = 1 + nx.searchsorted(self._cdf, self.rng.random_sample(total))
+        values = nx.minimum(values, self.numfeats-1)
+        vector = nx.repeat(nx.arange(count), lengths)
+        order = nx.lexsort((values, vector))
+        values, vector = values[order], vector[order]
+        # Remove features repeated within a vector
+        keep = nx.ones(total, nx.bool)
+        keep[1:] = (values[1:] != values[:-1]) | (vector[1:] != vector[:-1])
+        values, vector = values[keep], vector[keep]
+        indptr = nx.concatenate(([0], nx.cumsum(nx.bincount(vector, minlength=count))))
+        return values.astype(nx.int64), indptr
+
+
+    def vector_list(self, count):
+        """Generate a list of L{count} feature vectors as arrays"""
+        values, indptr = self.vectors(count)
+        return [values[indptr[i]:indptr[i+1]] for i in xrange(count)]
+
+
+    def records(self, count, start_pmid=1):
+        """Generate PubMed IDs (increasing with random gaps), completion dates
+        (YYYYMMDD between 1990 and 2008) and feature vectors.
+        @return: Arrays of PubMed IDs and dates, and L{vectors} result."""
+        pmids = start_pmid + nx.cumsum(self.rng.randint(1, 4, count))
+        dates = self.rng.randint(1990, 2009, count) * 10000 + \
+                self.rng.randint(1, 13, count) * 100 + \
+                self.rng.randint(1, 29, count)
+        values, indptr = self.vectors(count)
+        return pmids, dates, values, indptr
+
+
+    def write_stream(self, filename, numdocs, batchsize=100000):
+        """Write a L{FeatureStream} of L{numdocs} synthetic records,
+        replacing any existing file.
+        @return: Last PubMed ID in the stream."""
+        if filename.exists():
+            filename.remove()
+        pmid = 0
+        with closing(FeatureStream(filename, rdonly=False)) as fs:
+            for start in xrange(0, numdocs, batchsize):
+                count = min(batchsize, numdocs-start)
+                pmids, dates, values, indptr = self.records(count, pmid+1)
+                for pmid, date, featvec in zip(pmids.tolist(), dates.tolist(),
+                                               vb_encode_many(values, indptr)):
+                    fs.additem(pmid, date, featvec)
+        return pmid
+
+
+
+def medline_xml(numdocs, seed=0):
+    """Generate Medline XML with L{numdocs} citations, each with a title,
+    an abstract of 150-250 words, three authors and six MeSH headings.
+    @return: String of XML."""
+    rng = nx.random.RandomState(seed)
+    vocab = ["".join(chr(ord("a")+c) for c in rng.randint(0, 26, rng.randint(2,12)))
+             for i in xrange(20000)]
+    def words(n):
+        return " ".join(vocab[i] for i in rng.randint(0, len(vocab), n))
+    citations = []
+    for pmid in xrange(1, numdocs+1):
+        authors = "".join(
+            "<Author><LastName>%s</LastName><Initials>%s</Initials></Author>"
+            % (words(1).title(), words(1)[:2].upper()) for i in range(3))
+        headings = "".join(
+            "<MeshHeading><DescriptorName>%s</DescriptorName>"
+            "<QualifierName>%s</QualifierName></MeshHeading>"
+            % (words(2).title(), words(1)) for i in range(6))
+        citations.append("""<MedlineCitation Owner="NLM" Status="MEDLINE">
+<PMID>%d</PMID>
+<DateCompleted><Year>%d</Year><Month>%02d</Month><Day>%02d</Day></DateCompleted>
+<Article><Journal><ISSN>%04d-%04d</ISSN>
+<JournalIssue><PubDate><Year>%d</Year></PubDate></JournalIssue></Journal>
+<ArticleTitle>%s.</ArticleTitle>
+<Abstract><AbstractText>%s.</AbstractText></Abstract>
+<AuthorList>%s</AuthorList></Article>
+<MedlineJournalInfo><MedlineTA>%s</MedlineTA></MedlineJournalInfo>
+<MeshHeadingList>%s</MeshHeadingList>
+</MedlineCitation>
+""" % (pmid, rng.randint(1990,2009), rng.randint(1,13), rng.randint(1,29),
+       rng.randint(0,10000), rng.randint(0,10000), rng.randint(1990,2009),
+       words(12).capitalize(), words(rng.randint(150,250)).capitalize(), 
+       authors, words(3).title(), headings))
+    return '<?xml version="1.0"?>\n<MedlineCitationSet>\n%s</MedlineCitationSet>\n' \
+           % "".join(citations)
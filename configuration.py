@@ -40,11 +40,32 @@ rc.queue_path = lambda: rc.working / "queue"
 rc.web_root = "http://mscanner.stanford.edu/"
 ## File with process ID of the queue
 rc.queue_pid = rc.working / "queue_pid"
+## File of queue metrics written by the queue for the status page
+rc.queue_metrics = lambda: rc.working / "queue_metrics.json"
+## Seconds between writes of the queue metrics when the queue is idle
+rc.queue_metrics_interval = 30
+## Warn when scanning Medline is slower than this many citations per second
+rc.queue_min_scan_rate = None
+## SQLite index of the status of queued and completed tasks (the web server
+## and queue both write to it, so its directory must be writable by both)
+rc.queue_index = lambda: rc.working / "queue_index.db"
+## Number of tasks the queue processes at the same time
+rc.queue_workers = 2
+## Validations with at least this many negatives use a lot of memory
+rc.queue_heavy_numnegs = 50000
+## Maximum number of memory-heavy tasks to process at the same time
+rc.queue_max_heavy = 1
+## Seconds after which a waiting task goes ahead of smaller tasks
+rc.queue_max_wait = 900
 
 ## ARTICLE DATABASE FILES (in articles_home)
 
 ## Path to Article object database
 rc.articledb = path("articles.db")
+## Path to index of citation snippets (see CitationSnippets)
+rc.snippet_index = path("snippets.index")
+## Path to text fields of citation snippets
+rc.snippet_blob = path("snippets.blob")
 ## Path to track Medline files that have already been added
 rc.tracker = path("processed.txt")
 ## Path for log file
@@ -58,6 +79,9 @@ rc.featuremap = path("featuremap.sqlite")
 rc.featuredb = path("featvectors.sqlite")
 ## Base name for binary stream of PubMed IDs and MeSH-feature arrays
 rc.featurestream = path("features.stream")
+## Feature spaces whose feature IDs are hashed, mapped to the number of
+## hash bits (e.g. {"feats_wmqia":22}), bounding the size of the index
+rc.feature_hash_bits = {}
 
 ### COMMON REPORT FILES
 
@@ -69,6 +93,8 @@ rc.report_descriptor = path("descriptor.txt")
 rc.report_term_scores = path("terms.csv")
 ## Name of file to echo the log to
 rc.report_logfile = path("logging.txt")
+## Name of file with the time taken by each stage of the operation
+rc.report_timings = path("timings.json")
 
 ### QUERY REPORT FILES
 
@@ -78,6 +104,8 @@ rc.report_input_scores = path("inputs.txt")
 rc.report_input_broken = path("broken.txt")
 ## Name of result score file
 rc.report_result_scores = path("results.txt")
+## Name of binary (score, PubMed ID) array of results, for rendering on demand
+rc.report_result_records = path("results.bin")
 ## Name of file with citation records for the input
 rc.report_input_citations = path("inputs.html")
 ## Name of first page with citation records for the output
@@ -124,10 +152,15 @@ rc.alpha = 0.5
 rc.utility_r = None
 ## Number of citations per output file
 rc.citations_per_file = 250
+## Bytes of on-demand rendered citation pages to keep in the web output
+rc.web_page_cache = 200*1024*1024
 ## Random seed to use for cross validation shuffle (to get the same
 ## shuffle each time).  Set to None to get a different seed on each run.
 #rc.randseed = 124
 rc.randseed = None
+## Number of processes for evaluating cross validation folds, and for
+## extracting features when regenerating an index, in parallel
+rc.nprocs = 1
 
 ## Parameters affecting FeatureScores
 
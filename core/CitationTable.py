@@ -3,6 +3,8 @@
 from __future__ import with_statement
 from __future__ import division
 
+from cgi import escape
+
 from mscanner.configuration import rc
 from mscanner.core import iofuncs
 from Cheetah.Template import Template
@@ -26,140 +28,226 @@ You should have received a copy of the GNU General Public License along with
 this program. If not, see <http://www.gnu.org/licenses/>."""
 
 
-def write_citations(mode, dataset, citations, fname, perfile):
-    """Writes a set of HTML files containing citation records
-    
-    @param mode: 'input' or 'output'
+def page_files(fname, ncitations, perfile):
+    """Divide a set of citations into pages
     
-    @param dataset: Dataset title to print at the top of the page
-
-    @param citations: List of (score, Article) in descending order of score
-
     @param fname: Basic name for output files. ../results.html becomes
-    ../results.html, ../results_02.html, ../results_03.html etc.)
+    results.html, results_02.html, results_03.html etc.
 
+    @param ncitations: Number of citations in the set.
+    
     @param perfile: Number of citations per file (the very last file 
     may however have up to 2*perfile-1 citations)
+    
+    @return: List of (file name, start, end) for each page, where start and
+    end are indices into the list of citations.
     """
     # List of ranks where each file's citation records start
-    starts = range(0, len(citations), perfile)
+    starts = range(0, ncitations, perfile)
     # If the last file is less than half full, we concat to second-last
-    if len(starts)>1 and (len(citations)-starts[-1]) < (perfile//2):
+    if len(starts)>1 and (ncitations-starts[-1]) < (perfile//2):
         del starts[-1]
     # List of HTML files containing the citations
     from path import path
     fnames = [path(fname.basename())] # First file is the basic name
     fnames += [path(fname.namebase + ("_%02d" % x) + fname.ext)
                 for x in range(2, 1+len(starts))]
+    ends = starts[1:] + [ncitations]
+    return zip(fnames, starts, ends)
+
+
+
+def write_citations(mode, dataset, citations, fname, perfile, 
+                    allfname=None, pages=None):
+    """Writes a set of HTML files containing citation records
+    
+    Table rows are rendered once and streamed straight to the output files,
+    so the whole table never has to be held in memory.
+    
+    @param mode: 'input' or 'output'
+    
+    @param dataset: Dataset title to print at the top of the page
+
+    @param citations: List of (score, Article) in descending order of score.
+    Entries on pages that are not written are not accessed.
+
+    @param fname: Basic name for output files (see L{page_files}).
+
+    @param perfile: Number of citations per file.
+    
+    @param allfname: If not None, in the same pass also write all of the
+    citations to this single file, and to a zip file named allfname+".zip".
+    
+    @param pages: Indices of the pages to write (default is all of them).
+    """
+    files = page_files(fname, len(citations), perfile)
+    fnames = [f for f,s,e in files]
+    if pages is None:
+        pages = range(len(files))
     values = dict()
     page = Template(
         file=str(rc.templates/"citations.tmpl"), 
         filter="Filter", searchList=[values])
-    for count, start in enumerate(starts):
-        if count+1 < len(starts):
-            towrite = citations[start:start+perfile]
-        else:
-            towrite = citations[start:]
+    def page_parts(filelist, cur_idx, report_length):
+        """Render the page around the table, returning the (head, tail) HTML
+        strings on either side of the table."""
         values.update(dict(
-            cite_table = CitationTable(start+1, towrite),
+            cite_table = table_marker,
             dataset = dataset,
             mode = mode, 
-            report_length = len(towrite),
-            filelist = fnames,
-            cur_idx = count))
-        with iofuncs.FileTransaction(fname.dirname()/fnames[count], "w") as ft:
-            page.respond(ft)
-        
+            report_length = report_length,
+            filelist = filelist,
+            cur_idx = cur_idx))
+        text = page.respond()
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        return text.split(table_marker, 1)
+    # Streams receiving every row (the all-in-one file and its zip)
+    alls = []
+    if allfname is not None and len(citations) > 0:
+        alls.append(iofuncs.FileTransaction(allfname, "w"))
+        alls.append(iofuncs.ZipEntryWriter(
+            allfname + ".zip", allfname.basename()))
+        allhead, alltail = page_parts(
+            [allfname.basename()], 0, len(citations))
+        for out in alls:
+            out.write(allhead)
+            out.write(table_head)
+    try:
+        for count, (name, start, end) in enumerate(files):
+            if count not in pages:
+                if alls:
+                    for row in citation_rows(start+1, citations[start:end]):
+                        for out in alls:
+                            out.write(row)
+                continue
+            head, tail = page_parts(fnames, count, end-start)
+            ft = iofuncs.FileTransaction(fname.dirname()/name, "w")
+            try:
+                ft.write(head)
+                ft.write(table_head)
+                outs = alls + [ft]
+                for row in citation_rows(start+1, citations[start:end]):
+                    for out in outs:
+                        out.write(row)
+                ft.write(table_tail)
+                ft.write(tail)
+            finally:
+                ft.close()
+        for out in alls:
+            out.write(table_tail)
+            out.write(alltail)
+    finally:
+        for out in alls:
+            out.close()
 
 
-def CitationTable(startrank, citations):
-    """Create an HTML table of citations (uses ElementTree)
+table_marker = "<!--CITATION_TABLE-->"
+"""Placeholder for the citation table when rendering the page template"""
+
+
+ncols = 9
+"""Number of columns in the citation table"""
+
+
+table_head = "".join([
+    '<table id="citations">',
+    '<colgroup>',
+    '<col class="classification" />',
+    '<col class="rank" />',
+    '<col class="score" />',
+    '<col class="pmid" />',
+    '<col class="date" />',
+    '<col class="author" />',
+    '<col class="abstract" />',
+    '<col class="title" />',
+    '<col class="journal" />',
+    '</colgroup>',
+    '<thead><tr>',
+    '<th title="Classification">C</th>',
+    '<th title="Rank">R</th>',
+    '<th>Score</th>',
+    '<th>PMID</th>',
+    '<th>Date</th>',
+    '<th title="Author">Au</th>',
+    '<th title="Abstract">Ab</th>',
+    '<th>Title</th>',
+    '<th>Journal</th>',
+    '</tr></thead>',
+    '<tbody>'])
+"""HTML for the start of the citation table, up to the opening of the body"""
+
+
+table_tail = "</tbody></table>"
+"""HTML to close the citation table"""
+
+
+def citation_rows(startrank, citations):
+    """Generate the HTML rows of a citation table.
     
-    We use Cheetah when there is more HTML than logic, and ElementTree when
-    there is more logic than HTML. The old Cheetah template was getting
-    cluttered from all the logic. This way also outputs less whitespace.
+    We used to build the table with ElementTree, but writing the escaped
+    strings directly is much faster and needs no memory for the tree.
     
     @param startrank: Rank of the first article in the table
 
     @param citations: Iterable of (score, Article) in decreasing order of score
     
-    @return: HTML string for the <table> element containing citations
+    @return: Iterator over UTF-8 strings, each with the three <tr> elements
+    for a citation (main row, expanded authors, expanded abstract).
     """
-    from xml.etree.cElementTree import ElementTree, Element, SubElement
-    table = Element("table", id="citations")
-    ncols = 9 # Number of columns in the table
-    cg = SubElement(table, "colgroup")
-    SubElement(cg, "col", {"class":"classification"})
-    SubElement(cg, "col", {"class":"rank"})
-    SubElement(cg, "col", {"class":"score"})
-    SubElement(cg, "col", {"class":"pmid"})
-    SubElement(cg, "col", {"class":"date"})
-    SubElement(cg, "col", {"class":"author"})
-    SubElement(cg, "col", {"class":"abstract"})
-    SubElement(cg, "col", {"class":"title"})
-    SubElement(cg, "col", {"class":"journal"})
-    thead = SubElement(table, "thead")
-    tr = SubElement(thead, "tr")
-    SubElement(tr, "th", title="Classification").text = "C"
-    SubElement(tr, "th", title="Rank").text = "R"
-    SubElement(tr, "th").text = "Score"
-    SubElement(tr, "th").text = "PMID"
-    SubElement(tr, "th").text = "Date"
-    SubElement(tr, "th", title="Author").text = "Au"
-    SubElement(tr, "th", title="Abstract").text = "Ab"
-    SubElement(tr, "th").text = "Title"
-    SubElement(tr, "th").text = "Journal"
-    tbody = SubElement(table, "tbody")
     ncbi = "http://www.ncbi.nlm.nih.gov/entrez/query.fcgi?"
     ncbi_pmid = ncbi+"cmd=Retrieve&db=pubmed&list_uids="
     ncbi_jour = ncbi+"CMD=search&DB=journals&term="
+    def text(x):
+        """Escape text content, encoded as UTF-8"""
+        if x is None: return ""
+        if isinstance(x, unicode): x = x.encode("utf-8")
+        return escape(x)
+    def attr(x):
+        """Escape an attribute value"""
+        if isinstance(x, unicode): x = x.encode("utf-8")
+        return escape(x, True)
     for idx, (score, art) in enumerate(citations):
         pmid = str(art.pmid)
-        tr = SubElement(tbody, "tr", {"class":"main"}, id="P"+pmid)
-        # Classification
-        SubElement(tr, "td").text = " "
-        # Rank
-        SubElement(tr, "td").text = str(idx+startrank)
-        # Score
-        SubElement(tr, "td").text = "%.2f" % score
+        h = []
+        h.append('<tr class="main" id="P%s">' % pmid)
+        # Classification, Rank, Score
+        h.append('<td> </td><td>%d</td><td>%.2f</td>' % (idx+startrank, score))
         # PMID
-        td = SubElement(tr, "td")
-        SubElement(td, "a", href=ncbi_pmid+pmid).text = pmid
+        h.append('<td><a href="%s">%s</a></td>' % (attr(ncbi_pmid+pmid), pmid))
         # Date the record acquired "Medline" status
-        td = SubElement(tr, "td")
-        td.text = "%04d.%02d.%02d" % art.date_completed
-        # Expand Author button
-        td = SubElement(tr, "td")
-        td.text = "+" if art.authors else " "
-        # Expand Abstract button
-        td = SubElement(tr, "td")
-        td.text = "+" if art.abstract else " "
-        # Title
-        td = SubElement(tr, "td")
-        td.text = art.title
+        h.append('<td>%04d.%02d.%02d</td>' % art.date_completed)
+        # Expand Author and Abstract buttons
+        h.append('<td>%s</td>' % ("+" if art.authors else " "))
+        h.append('<td>%s</td>' % ("+" if art.abstract else " "))
+        # Title (ElementTree wrote an empty cell as <td />)
+        h.append('<td>%s</td>' % text(art.title) if art.title else '<td />')
         # ISSN
-        td = SubElement(tr, "td")
-        a = SubElement(td, "a")
-        a.text = " "
         if art.issn:
-            a.set("href", ncbi_jour+art.issn)
-            a.text = art.journal if art.journal else art.issn
+            h.append('<td><a href="%s">%s</a></td>' % (attr(ncbi_jour+art.issn), 
+                     text(art.journal if art.journal else art.issn)))
+        else:
+            h.append('<td><a> </a></td>')
+        h.append('</tr>')
         # Expanded authors
-        tr = SubElement(tbody, "tr", {"class":"author"})
-        td = SubElement(tr, "td", {"colspan":str(ncols)})
-        td.text = " "
-        if art.authors:
-            for initials, lastname in art.authors:
-                if initials: td.text += initials + " "
-                if lastname: td.text += lastname + ", "
+        h.append('<tr class="author"><td colspan="%d"> ' % ncols)
+        for initials, lastname in art.authors:
+            if initials: h.append(text(initials) + " ")
+            if lastname: h.append(text(lastname) + ", ")
+        h.append('</td></tr>')
         # Expanded Abstract
-        tr = SubElement(tbody, "tr", {"class":"abstract"})
-        td = SubElement(tr, "td", {"colspan":str(ncols)})
-        td.text = " "
-        if art.abstract:                        
-            td.text = art.abstract
-    import cStringIO
-    s = cStringIO.StringIO()
-    # Tell silly etree to use UTF-8 and not "us-ascii" for output
-    ElementTree(table).write(s, "utf-8") 
-    return s.getvalue()
+        h.append('<tr class="abstract"><td colspan="%d">%s</td></tr>' % 
+                 (ncols, text(art.abstract) if art.abstract else " "))
+        yield "".join(h)
+
+
+def CitationTable(startrank, citations):
+    """Create an HTML table of citations
+    
+    @param startrank: Rank of the first article in the table
+
+    @param citations: Iterable of (score, Article) in decreasing order of score
+    
+    @return: HTML string for the <table> element containing citations
+    """
+    return table_head + "".join(citation_rows(startrank, citations)) + table_tail
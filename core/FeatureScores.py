@@ -4,7 +4,6 @@ from __future__ import division
 import logging
 import numpy as nx
 from itertools import izip
-from heapq import nlargest
 
 from mscanner import update, delattrs
 from mscanner.core.Storage import Storage
@@ -29,12 +28,24 @@ class FeatureScores(object):
     """Feature score calculation and saving, with choice of calculation method,
     and methods to exclude certain kinds of features.
     
-    @group Set via constructor: featmap, scoremethod
+    @group Set via constructor: featmap, scoremethod, mincount, min_infogain,
+    positives_only, type_mask
     
     @ivar featmap: L{FeatureMapping} object
     
     @ivar scoremethod: Name of the method to call for calculating feature scores.
     
+    @ivar mincount: Select features with at least this many occurrences.
+    
+    @ivar min_infogain: Select features with at least this much information gain.
+    
+    @ivar positives_only: If True, select only features found in relevant articles.
+    
+    @ivar type_mask: Do not select features of these types (e.g. ["mesh","issn"]).
+    
+    @note: The feature selection options default to None, in which case the
+    values in L{rc} are used.
+    
     
     @group Set by update: pdocs, ndocs, pos_counts, neg_counts, 
     features,  prior
@@ -53,14 +64,14 @@ class FeatureScores(object):
     using the log of the ratio of relevant to irrelevant articles in the data.
 
 
-    @group Set by select_features: selected, features, infogain, 
+    @group Set by select_features: features, feats_infogain, 
     pos_selected, feats_type_selected, neg_selected
 
-    @ivar selected: Boolean array with True position corresponds to selected features.
-    
-    @ivar features: Array listing the feature IDs of the L{selected} features.
+    @ivar features: Array listing the feature IDs of the selected features,
+    in increasing order.
 
-    @ivar infogain: Cached results of L{infogain} from L{get_selected}.
+    @ivar feats_infogain: Information gain of each selected feature
+    (corresponds with L{features}), or None if L{min_infogain} is zero.
     
     @ivar feats_type_selected: Boolean array where True positions correspond to
     features whose types we are considering (a cached feature type mask).
@@ -73,19 +84,23 @@ class FeatureScores(object):
 
 
 
-    @group Set via scoremethod: scores, pfreqs, nfreqs, base
+    @group Set via scoremethod: scores_selected, pfreqs, nfreqs, base
     
-    @ivar scores: Score of each feature.
+    @ivar scores_selected: Score of each selected feature (corresponds with
+    L{features}).  Every other feature has a score of zero.
   
-    @ivar pfreqs: For positive documents, the estimated fraction having each feature.
+    @ivar pfreqs: For positive documents, the estimated fraction having each
+    selected feature.
     
-    @ivar nfreqs: For negative documents, the estimated fraction having each feature.
+    @ivar nfreqs: For negative documents, the estimated fraction having each
+    selected feature.
     
     @ivar base: Value to be added to all article scores (typically the
     score of an article with zero features).
     """
 
-    def __init__(self, featmap, scoremethod):
+    def __init__(self, featmap, scoremethod, mincount=None, min_infogain=None,
+                 positives_only=None, type_mask=None):
         """Initialise FeatureScores object (parameters are instance variables)"""
         update(self, locals())
 
@@ -104,7 +119,20 @@ class FeatureScores(object):
         @return: Vector of scores corresponding to L{docs}.
         """
         return self.base + self.prior +\
-               nx.array([nx.sum(self.scores[d]) for d in docs], nx.float32)
+               nx.array([self._score_of(d) for d in docs], nx.float32)
+
+
+    def _score_of(self, doc):
+        """Sum the scores of the selected features in one feature vector,
+        looking them up in L{features} instead of the full-length L{scores}.
+        @param doc: Array of feature IDs."""
+        doc = nx.asarray(doc)
+        if len(self.features) == 0 or len(doc) == 0:
+            return 0.0
+        idx = nx.searchsorted(self.features, doc)
+        idx[idx == len(self.features)] = 0
+        found = self.features[idx] == doc
+        return nx.sum(self.scores_selected[idx[found]])
 
 
     def update(self, pos_counts, neg_counts, pdocs, ndocs, prior=None):
@@ -126,45 +154,132 @@ class FeatureScores(object):
         # Get list of unmasked features and condensed count vectors
         # Call the method to calculate feature scores (it respects the mask)
         getattr(self, self.scoremethod)()
-        # Get rid of TFIDF property to recalculate
-        delattrs(self, "_stats", "_tfidf")
+        # Get rid of cached properties to recalculate
+        delattrs(self, "_stats", "_tfidf", "_scores", "_selected")
+
+
+    def option(self, name):
+        """Get a feature selection option, using the L{rc} value if the option
+        was not given to the constructor.
+        @param name: One of mincount, min_infogain, positives_only, type_mask."""
+        value = getattr(self, name)
+        if value is None:
+            from mscanner.configuration import rc
+            value = getattr(rc, name)
+        return value
+
+
+    def _buffer(self, name, dtype):
+        """Get a work array the length of the feature space, which is re-used
+        on later calls to avoid re-allocating full-vocabulary arrays on every
+        L{update} (such as for each cross validation fold).  Only for
+        intermediate results, never for arrays that callers may keep.
+        @param name: Name of the buffer.
+        @param dtype: Numpy type of the buffer.
+        @return: Array (the contents are not initialised)."""
+        try:
+            buffers = self._buffers
+        except AttributeError:
+            buffers = self._buffers = {}
+        nfeats = len(self.pos_counts)
+        buf = buffers.get(name)
+        if buf is None or len(buf) != nfeats or buf.dtype != dtype:
+            buf = buffers[name] = nx.empty(nfeats, dtype)
+        return buf
+
+
+    def _type_selected(self, type_mask):
+        """Get boolean array of features that are not of the types in
+        L{type_mask}. The array is kept between calls to L{update}, since the
+        feature types do not change between cross validation folds."""
+        key = (tuple(type_mask), len(self.pos_counts))
+        if getattr(self, "_type_key", None) != key:
+            self._type_notmasked = ~self.featmap.type_mask(type_mask)
+            self._type_key = key
+        return self._type_notmasked
 
 
     def select_features(s):
         """Perform feature selection.  Is called during the L{update} method to 
         set certain attributes relating to selected features (see class description).
-        """
-        from mscanner.configuration import rc
-        s.selected = nx.ones(len(s.pos_counts), nx.bool)
+        
+        The count and type criteria are combined in a re-used boolean
+        buffer, and information gain is then only calculated for the
+        features that pass them."""
+        type_mask = s.option("type_mask")
+        mincount = s.option("mincount")
+        min_infogain = s.option("min_infogain")
+        selected = s._buffer("selected", nx.bool)
+        selected.fill(True)
+        mask = s._buffer("mask", nx.bool)
         s.feats_type_selected = None
-        if rc.type_mask:
+        if type_mask:
             # Keep only features that are not of the specified types
-            s.feats_type_selected = ~s.featmap.type_mask(rc.type_mask)
-            s.selected &= s.feats_type_selected 
-        if rc.mincount > 0:
+            s.feats_type_selected = s._type_selected(type_mask)
+            selected &= s.feats_type_selected 
+        if mincount > 0:
             # Keep only features having enough occurrences
-            s.selected &= ((s.pos_counts + s.neg_counts) >= rc.mincount)
-        if rc.positives_only:
+            selected &= nx.greater_equal(s.pos_counts+s.neg_counts, mincount, mask)
+        if s.option("positives_only"):
             # Keep only features found in a relevant article
-            s.selected &= (s.pos_counts != 0)
+            selected &= nx.not_equal(s.pos_counts, 0, mask)
+        s.features = nx.flatnonzero(selected)
         s.feats_infogain = None
-        if rc.min_infogain > 0:
+        if min_infogain > 0:
             # Keep features by information gain.
-            s.feats_infogain = s.infogain()
-            s.selected &= (s.feats_infogain >= rc.min_infogain)
-        s.features = nx.arange(len(s.selected))[s.selected]
-        s.pos_selected = s.pos_counts[s.selected]
-        s.neg_selected = s.neg_counts[s.selected]
+            infogain = s.infogain(s.features)
+            keep = infogain >= min_infogain
+            s.features = s.features[keep]
+            s.feats_infogain = infogain[keep]
+        s.pos_selected = s.pos_counts[s.features]
+        s.neg_selected = s.neg_counts[s.features]
 
-    
-    def infogain(s):
+
+    @property
+    def selected(self):
+        """Boolean array with True at the positions of selected features
+        (made from L{features} on first use after each L{update})."""
+        try:
+            return self._selected
+        except AttributeError:
+            pass
+        self._selected = nx.zeros(len(self.pos_counts), nx.bool)
+        self._selected[self.features] = True
+        return self._selected
+
+
+    # Number of features per block in L{infogain}
+    infogain_block = 65536
+
+    def infogain(s, features=None):
         """Calculate information gain on features.  Not traditional - we calculate
         information gain divided by entropy of original distribution, as a fractional
         reduction in entropy.  This is because if the distribution is already low
-        entropy (high class skew), we cannot expect large information gains."""
+        entropy (high class skew), we cannot expect large information gains.
+        
+        @param features: Array of feature IDs to calculate information gain
+        for (default is all features).
+        
+        @return: Array of information gain, corresponding to L{features}.
+        It is calculated in blocks of L{infogain_block} features, so that the
+        temporary arrays are only as large as a block."""
+        if features is None:
+            features = nx.arange(len(s.pos_counts))
+        result = nx.empty(len(features), nx.float32)
+        for start in xrange(0, len(features), s.infogain_block):
+            block = features[start:start+s.infogain_block]
+            result[start:start+len(block)] = s._infogain(
+                s.pos_counts[block], s.neg_counts[block])
+        return result
+
+
+    def _infogain(s, pos_counts, neg_counts):
+        """Calculate information gain for one block of L{infogain}.
+        @param pos_counts, neg_counts: Positive and negative counts of the
+        features in the block."""
         def S(p): return -p*nx.log2(p) # Entropy in bits
-        R1 = s.pos_counts.astype(nx.float32) # relevant and term present
-        I1 = s.neg_counts.astype(nx.float32) # irrelevant and term present
+        R1 = pos_counts.astype(nx.float32) # relevant and term present
+        I1 = neg_counts.astype(nx.float32) # irrelevant and term present
         R = float(s.pdocs) # relevant
         I = float(s.ndocs) # irrelevant
         N = R+I # total
@@ -191,10 +306,9 @@ class FeatureScores(object):
         """Estimate support scores of features assuming documents are generated
         by a multivariate Bernoulli distribution. For non-occurring features,
         we use a base score and adjust the score for feature occurrence.
-        Evaluation of frequencies is done only on selected features (the
-        feature ID for each item is the corresponding item in L{features}), but
-        the final L{scores} array is full-length (feature ID of each item is
-        the array index).
+        Evaluation of frequencies and scores is done only on selected
+        features (the feature ID for each item is the corresponding item in
+        L{features}).
         
         @param pos_a, pos_ab: Beta prior (a=successes, ab=total) for relevant articles.
         @param neg_a, neg_ab: Beta prior (a=successes, ab=total) for irrelevant articles.
@@ -209,9 +323,31 @@ class FeatureScores(object):
         s.failure_scores = nx.log((1-s.pfreqs) / (1-s.nfreqs))
         # Convert success/failure to base score and occurrence score
         s.base = nx.sum(s.failure_scores)
-        # Create score vector for ALL features, single-precision, with zeros at non-selected features
-        s.scores = nx.zeros(len(s.featmap), nx.float32)
-        s.scores[s.selected] = nx.float32(s.success_scores - s.failure_scores)
+        # Single-precision occurrence scores of the selected features
+        s.scores_selected = (s.success_scores - s.failure_scores).astype(nx.float32)
+
+
+    @property
+    def scores(self):
+        """Score of each feature, in a single-precision array the length of
+        the feature space with zeros at non-selected features (made from
+        L{scores_selected} on first use after each L{update})."""
+        try:
+            return self._scores
+        except AttributeError:
+            pass
+        self._scores = nx.zeros(len(self.pos_counts), nx.float32)
+        self._scores[self.features] = self.scores_selected
+        return self._scores
+
+
+    def sparse_scores(self):
+        """Scores of the features which may have non-zero scores (only the
+        selected features), for when only a small part of the feature space
+        is selected.
+        @return: Pair of arrays, with increasing feature IDs and their
+        scores. Every other feature has a score of zero."""
+        return self.features.astype(nx.uint32), self.scores_selected
 
 
     def scores_laplace(s):
@@ -232,7 +368,7 @@ class FeatureScores(object):
     def scores_bgfreq(s):
         """The prior is 'background frequency' successes, out of 1 total occurrence 
         in each class."""
-        bgvec = s.featmap.counts[s.selected] / s.numdocs
+        bgvec = s.featmap.counts[s.features] / s.numdocs
         s.scores_bayes(bgvec, 1, bgvec, 1)
 
 
@@ -242,12 +378,11 @@ class FeatureScores(object):
         probabilities are replaced by 1e-8 (ignores other masks)"""
         s.base = 0
         s.prior = 0
-        s.pfreqs = s.pos_counts / float(s.pdocs)
-        s.nfreqs = s.neg_counts / float(s.ndocs)
+        s.pfreqs = s.pos_selected / float(s.pdocs)
+        s.nfreqs = s.neg_selected / float(s.ndocs)
         s.pfreqs[s.pfreqs == 0.0] = 1e-8
         s.nfreqs[s.nfreqs == 0.0] = 1e-8
-        s.scores = nx.log(s.pfreqs) - nx.log(s.nfreqs)
-        s.scores[~s.selected] = 0
+        s.scores_selected = (nx.log(s.pfreqs) - nx.log(s.nfreqs)).astype(nx.float32)
 
 
     @property 
@@ -282,7 +417,7 @@ class FeatureScores(object):
         def __init__(s, featscores):
             fs = featscores
             s.feats_selected = len(fs.pos_selected) # Array with only selected features
-            s.feats_total = len(fs.selected) # Boolean array of all features
+            s.feats_total = len(fs.pos_counts) # Counts of all features
             if fs.feats_type_selected is None:
                 # Distinct features in data are those that occur at least once.
                 s.feats_in_data = nx.sum(fs.pos_counts+fs.neg_counts > 0)
@@ -326,6 +461,30 @@ class FeatureScores(object):
         return self._tfidf
     
 
+    def top_features(s, values, maxfeats):
+        """Find the selected features with the largest values, without
+        sorting the whole feature space.  Ties are broken by larger feature
+        ID first, which gives the same order as C{nlargest(maxfeats,
+        izip(values, s.features))}.
+        
+        @param values: Array of values corresponding to L{features}.
+        
+        @param maxfeats: Maximum number of features to return.
+        
+        @return: Arrays of feature IDs and of their values, by decreasing value."""
+        maxfeats = min(maxfeats, len(values))
+        if maxfeats <= 0:
+            return s.features[:0], values[:0]
+        # Candidates are all features at least as large as the N'th largest
+        kth = len(values)-maxfeats
+        threshold = values[nx.argpartition(values, kth)[kth]]
+        candidates = nx.flatnonzero(values >= threshold)
+        # Decreasing value, and decreasing ID among equal values
+        order = nx.lexsort((s.features[candidates], values[candidates]))
+        best = candidates[order[::-1][:maxfeats]]
+        return s.features[best], values[best]
+
+
     def get_best_tfidfs(s, maxfeats, min_tfidf=0.001):
         """Get a table of features with the highest TFIDF values, up to a limit
         and only for TF-IDFs above a minimum.
@@ -336,10 +495,13 @@ class FeatureScores(object):
         
         @return: List of (Feature ID, TFIDF, (feature, featureclass), 
         feature score, positive count, negative count)."""
-        best_tfidfs = nlargest(maxfeats, izip(s.tfidf, s.features))
-        return [ (t, tfidf, s.featmap.get_feature(t), s.scores[t], 
-                  s.pos_counts[t], s.neg_counts[t])
-                  for tfidf, t in best_tfidfs if tfidf >= min_tfidf ]
+        features, tfidfs = s.top_features(s.tfidf, maxfeats)
+        keep = tfidfs >= min_tfidf
+        features, tfidfs = features[keep], tfidfs[keep]
+        names = s.featmap.get_features(features)
+        scores = s.scores_selected[nx.searchsorted(s.features, features)]
+        return [ (t, tfidf, name, score, s.pos_counts[t], s.neg_counts[t])
+                  for t, tfidf, name, score in izip(features, tfidfs, names, scores) ]
 
 
     def write_csv(s, stream, maxfeats=None):
@@ -354,10 +516,13 @@ class FeatureScores(object):
         # Output features by decreasing score
         stream.write(u"score,relIG,pos_count,neg_count,termid,type,term\n")
         if maxfeats is None:
-            maxfeats = len(s.selected)
-        if s.feats_infogain is None:
-            s.feats_infogain = nx.zeros(len(s.selected))
-        for (score, t) in nlargest(maxfeats, izip(s.scores[s.selected], s.features)):
-            fname, ftype = s.featmap.get_feature(t)
+            maxfeats = len(s.features)
+        infogain = s.feats_infogain
+        if infogain is None:
+            infogain = nx.zeros(len(s.features))
+        features, scores = s.top_features(s.scores_selected, maxfeats)
+        infogain = infogain[nx.searchsorted(s.features, features)]
+        names = s.featmap.get_features(features)
+        for t, score, ig, (fname, ftype) in izip(features, scores, infogain, names):
             stream.write(u'%.3f, %.2e, %d, %d, %d,%s,"%s"\n' % 
-            (s.scores[t], s.feats_infogain[t], s.pos_counts[t], s.neg_counts[t], t, ftype, fname))
+            (score, ig, s.pos_counts[t], s.neg_counts[t], t, ftype, fname))
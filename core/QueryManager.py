@@ -5,7 +5,7 @@ from __future__ import division
 
 import codecs
 from contextlib import closing
-from itertools import izip
+from itertools import chain, izip
 import logging
 import numpy as nx
 from path import path
@@ -19,6 +19,7 @@ from mscanner.medline.FeatureData import FeatureData
 from mscanner.core.FeatureScores import FeatureScores
 from mscanner.core.Validator import count_features
 from mscanner.core import CitationTable, iofuncs
+from mscanner.core.timing import Timings
 from mscanner.fastscores.ScoreCalculator import ScoreCalculator
 from mscanner.fastscores.FeatureCounter import FeatureCounter
 
@@ -54,6 +55,10 @@ class QueryManager:
     @param artdb: Shelf of Article objects by PubMed ID.
     
     @param fdata: Selected FeatureData (document representation of articles).
+    
+    @ivar snippets: Optional L{CitationSnippets}, used in preference to
+    L{artdb} when writing citation tables (citations missing from the snippets
+    are still fetched from L{artdb}).
 
     @ivar threshold: Decision threshold for the classifier (default should be 0).
     Use None to retrieve everything up to the result limit.
@@ -87,13 +92,16 @@ class QueryManager:
     @ivar timestamp: Time at the start of the operation.
     
     @ivar logfile: logging.FileHandler for logging to output directory
+
+    @ivar timings: L{Timings} of the stages of the query and report, saved
+    to L{rc.report_timings} in the output directory.
     """
 
 
     def __init__(self, outdir, dataset, limit, artdb, fdata,
                  threshold=None, prior=None, 
                  mindate=None, maxdate=None, 
-                 t_mindate=None, t_maxdate=None):
+                 t_mindate=None, t_maxdate=None, snippets=None):
         if not outdir.exists():
             outdir.makedirs()
             outdir.chmod(0777)
@@ -109,6 +117,7 @@ class QueryManager:
         self.maxdate = maxdate
         self.t_mindate = mindate if t_mindate is None else t_mindate
         self.t_maxdate = maxdate if t_maxdate is None else t_maxdate
+        self.snippets = snippets
         # Set internal attributes
         self.timestamp = time.time()
         self.pmids = None
@@ -116,6 +125,7 @@ class QueryManager:
         self.inputs = None
         self.results = None
         self.notfound_pmids = None
+        self.timings = Timings()
         self.logfile = iofuncs.open_logfile(self.outdir/rc.report_logfile)
 
 
@@ -131,14 +141,23 @@ class QueryManager:
         @param train_exclude: PubMed IDs to exclude from background when training
         """
         logging.info("START: Query for %s", self.dataset)
-        if not self._load_input(input):
-            return
-        self._make_feature_info(train_exclude)
+        t = self.timings
         try:
-            self._load_results()
-        except IOError: 
-            self._make_results()
-            self._save_results()
+            with t.span("load_input"):
+                if not self._load_input(input):
+                    return
+            with t.span("make_feature_info"):
+                self._make_feature_info(train_exclude)
+            try:
+                with t.span("load_results"):
+                    self._load_results()
+            except IOError: 
+                with t.span("make_results"):
+                    self._make_results()
+                with t.span("save_results"):
+                    self._save_results()
+        finally:
+            t.save(self.outdir/rc.report_timings)
         
         
     def _load_input(self, input):
@@ -153,6 +172,7 @@ class QueryManager:
             logging.info("Loading PubMed IDs from %s", input.basename())
             self.pmids, self.notfound_pmids, exclude = \
                 iofuncs.read_pmids_careful(input, self.fdata.featuredb)
+            self.timings.count("notfound_pmids", len(self.notfound_pmids))
             iofuncs.write_pmids(
                 self.outdir/rc.report_input_broken, self.notfound_pmids)
         else:
@@ -164,9 +184,11 @@ class QueryManager:
                 self.outdir/rc.report_index, self.dataset, self.notfound_pmids)
             return False
         # Pre-load vectors from feature database
-        self.pmids, self.pmids_vectors =\
-            zip(*((p, nx.array(v,nx.uint32)) for (p,d,v) in 
-                self.fdata.featuredb.get_records(self.pmids)))
+        with self.timings.span("get_records"):
+            self.pmids, self.pmids_vectors =\
+                zip(*((p, nx.array(v,nx.uint32)) for (p,d,v) in 
+                    self.fdata.featuredb.get_records(self.pmids)))
+        self.timings.count("input_pmids", len(self.pmids))
         return True
 
 
@@ -199,18 +221,21 @@ class QueryManager:
             if train_exclude is None:
                 train_exclude = self.pmids
             # Call the C program to count features
-            ndocs, neg_counts = FeatureCounter(
-                docstream = self.fdata.fstream.filename,
-                numdocs = len(self.fdata.featuredb),
-                numfeats = len(self.fdata.featmap),
-                mindate = self.t_mindate,
-                maxdate = self.t_maxdate,
-                exclude = train_exclude,
-                ).c_counts()
+            with self.timings.span("FeatureCounter"):
+                ndocs, neg_counts = FeatureCounter(
+                    docstream = self.fdata.fstream.filename,
+                    numdocs = len(self.fdata.featuredb),
+                    numfeats = len(self.fdata.featmap),
+                    mindate = self.t_mindate,
+                    maxdate = self.t_maxdate,
+                    exclude = train_exclude,
+                    ).c_counts()
         
         # Evaluating feature scores from the counts
         logging.info("Calculating feature scores from counts.")
-        self.featinfo.update(pos_counts, neg_counts, pdocs, ndocs, self.prior)
+        with self.timings.span("update_scores"):
+            self.featinfo.update(pos_counts, neg_counts, pdocs, ndocs, self.prior)
+        self.timings.count("background_docs", ndocs)
 
 
     def _load_results(self):
@@ -224,6 +249,8 @@ class QueryManager:
         """Write L{inputs} and L{results} with scores in the report directory."""
         iofuncs.write_scores(self.outdir/rc.report_input_scores, self.inputs, sort=True)
         iofuncs.write_scores(self.outdir/rc.report_result_scores, self.results, sort=True)
+        iofuncs.write_score_records(
+            self.outdir/rc.report_result_records, self.results, sort=True)
 
 
     def _make_results(self):
@@ -235,28 +262,43 @@ class QueryManager:
         # Calculate results as decreasing (score, PMID)
         logging.info("Calculating Medline scores between %s to %s", 
                      str(self.mindate), str(self.maxdate))
-        self.results = ScoreCalculator(
-            path(self.fdata.fstream.stream.name),
-            len(self.fdata.featuredb),
-            self.featinfo.scores,
-            self.featinfo.base+self.featinfo.prior,
-            self.limit,
-            self.threshold,
-            self.mindate,
-            self.maxdate,
-            set(self.pmids),
-            ).score()
+        # Only pass selected feature scores when few features are selected
+        numfeats = len(self.featinfo.pos_counts)
+        if len(self.featinfo.features) < numfeats//4:
+            featscores = self.featinfo.sparse_scores()
+        else:
+            featscores = self.featinfo.scores
+        with self.timings.span("ScoreCalculator"):
+            self.results = ScoreCalculator(
+                path(self.fdata.fstream.stream.name),
+                len(self.fdata.featuredb),
+                featscores,
+                self.featinfo.base+self.featinfo.prior,
+                self.limit,
+                self.threshold,
+                self.mindate,
+                self.maxdate,
+                set(self.pmids),
+                numfeats,
+                ).score()
+        self.timings.count("scored_docs", len(self.fdata.featuredb))
+        self.timings.count("results", len(self.results))
         logging.info("ScoreCalculator returned %d (limit %d)", len(self.results), self.limit)
 
 
-    def write_report(self, maxreport=None):
+    def write_report(self, maxreport=None, lazy=False):
         """Write the HTML report for the query results
         
-        @note: Article database lookups are carried out beforehand because
+        @note: Article database lookups are carried out beforehand (in one
+        C{get_many} call on L{snippets}, then on L{artdb} for the rest) because
         lookups while doing template output is extremely slow.
         
         @param maxreport: Largest number of records to write to the HTML reports
         (L{maxreport} may override the result limit).
+        
+        @param lazy: If True, only write the first page of result citations.
+        The other pages, and the all-in-one file, are left for the web
+        interface to render from L{rc.report_result_records} on demand.
         """
         # Cancel report if there are no results
         if self.results is None: return
@@ -271,37 +313,66 @@ class QueryManager:
         #with closing(codecs.open(self.outdir/rc.report_term_scores, "wb", "utf-8")) as f:
         #    self.featinfo.write_csv(f, rc.max_output_features)
         
-        logging.debug("Writing citations to %s", rc.report_input_citations)
+        t = self.timings
+        try:
+            with t.span("write_report"):
+                self._write_report(maxreport, lazy)
+        finally:
+            t.save(self.outdir/rc.report_timings)
+        logging.debug("FINISH: Query for %s", self.dataset)
+
+
+    def _write_report(self, maxreport, lazy):
+        """Write the citation tables and index page (see L{write_report})"""
+        t = self.timings
+        # Fetch all the articles in one sorted pass over the database
         self.inputs.sort(reverse=True)
-        inputs = [ (s,self.artdb[str(p)]) for s,p in self.inputs]
-        CitationTable.write_citations(
-            "input", self.dataset, inputs, 
-            self.outdir/rc.report_input_citations, 
-            rc.citations_per_file)
-        
-        logging.debug("Writing citations to %s", rc.report_result_citations)
         self.results.sort(reverse=True)
-        outputs = [ (s,self.artdb[str(p)]) for s,p in self.results[:maxreport] ]
-        CitationTable.write_citations(
-            "output", self.dataset, outputs,
-            self.outdir/rc.report_result_citations, 
-            rc.citations_per_file)
+        nfetch = min(rc.citations_per_file*2, maxreport) if lazy else maxreport
+        pmids = [str(p) for s,p in chain(self.inputs, self.results[:nfetch])]
+        with t.span("get_many"):
+            articles = {}
+            if self.snippets is not None:
+                articles = self.snippets.get_many(pmids)
+            missing = [p for p in pmids if p not in articles]
+            if missing:
+                articles.update(self.artdb.get_many(missing))
+        t.count("fetched_articles", len(articles))
         
-        # Write ALL output citations to a single HTML, and a zip file
-        if len(outputs) > 0:
-            logging.debug("Writing citations to %s", rc.report_result_all)
-            outfname = self.outdir/rc.report_result_all
-            zipfname = str(outfname + ".zip")
+        logging.debug("Writing citations to %s", rc.report_input_citations)
+        inputs = [ (s,articles[str(p)]) for s,p in self.inputs]
+        with t.span("input_citations"):
             CitationTable.write_citations(
-                "output", self.dataset, outputs, outfname, len(outputs))
-            from zipfile import ZipFile, ZIP_DEFLATED
-            with closing(ZipFile(zipfname, "w", ZIP_DEFLATED)) as zf:
-                zf.write(str(outfname), str(outfname.basename()))
+                "input", self.dataset, inputs, 
+                self.outdir/rc.report_input_citations, 
+                rc.citations_per_file)
+        
+        # Output pages, plus ALL output citations to a single HTML and a zip
+        # file, written in the same pass over the citations.
+        outputs = [ (s,articles.get(str(p))) for s,p in self.results[:maxreport] ]
+        if lazy:
+            logging.debug("Writing citations to %s", rc.report_result_citations)
+            if not (self.outdir/rc.report_result_records).exists():
+                iofuncs.write_score_records(
+                    self.outdir/rc.report_result_records, self.results)
+            with t.span("result_citations"):
+                CitationTable.write_citations(
+                    "output", self.dataset, outputs,
+                    self.outdir/rc.report_result_citations, 
+                    rc.citations_per_file, pages=[0])
+        else:
+            logging.debug("Writing citations to %s and %s", 
+                          rc.report_result_citations, rc.report_result_all)
+            with t.span("result_citations_and_zip"):
+                CitationTable.write_citations(
+                    "output", self.dataset, outputs,
+                    self.outdir/rc.report_result_citations, 
+                    rc.citations_per_file, self.outdir/rc.report_result_all)
         
         # Index.html
         logging.debug("Writing %s", rc.report_index)
         from Cheetah.Template import Template
-        with iofuncs.FileTransaction(self.outdir/rc.report_index, "w") as ft:
-            Template(file=str(rc.templates/"results.tmpl"), 
-                     filter="RawOrEncodedUnicode", searchList=dict(QM=self)).respond(ft)
-        logging.debug("FINISH: Query for %s", self.dataset)
+        with t.span("index"):
+            with iofuncs.FileTransaction(self.outdir/rc.report_index, "w") as ft:
+                Template(file=str(rc.templates/"results.tmpl"), 
+                         filter="RawOrEncodedUnicode", searchList=dict(QM=self)).respond(ft)
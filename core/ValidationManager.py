@@ -21,7 +21,8 @@ from mscanner.core import iofuncs
 from mscanner.core.FeatureScores import FeatureScores
 from mscanner.core.metrics import PerformanceVectors, PerformanceRange
 from mscanner.core.Plotter import Plotter
-from mscanner.core.Validator import cross_validate, count_features
+from mscanner.core.timing import Timings
+from mscanner.core.Validator import cross_validate, make_folds, PackedVectors
 
 
                                      
@@ -43,7 +44,8 @@ this program. If not, see <http://www.gnu.org/licenses/>."""
 class CrossValidation:
     """Carries out N-fold cross validation.
     
-    @group Set in the constructor: outdir, dataset, fdata, timestamp, logfile
+    @group Set in the constructor: outdir, dataset, fdata, timestamp, logfile,
+    timings
 
     @ivar outdir: Path to directory for output files, which is created if it
     does not exist.
@@ -58,6 +60,9 @@ class CrossValidation:
     @ivar logfile: logging.FileHandler so that log output is
     sent to output directory as well (set automatically by __init__).
 
+    @ivar timings: L{Timings} of the stages of validation and reporting,
+    saved to L{rc.report_timings} in the output directory.
+
 
     @group Set by validation: featinfo, nfolds
     
@@ -75,8 +80,8 @@ class CrossValidation:
     @ivar notfound_pmids: List of input PubMed IDs not found in the database.
     
     @group Set by _load_vectors: pos_vectors, neg_vectors, pos_counts, neg_counts
-    pos_vectors: Feature vectors corresponding to positives.
-    neg_vectors: Feature vectors corresponding to negatives.
+    pos_vectors: L{PackedVectors} of feature vectors corresponding to positives.
+    neg_vectors: L{PackedVectors} of feature vectors corresponding to negatives.
     pos_counts: Number of occurrences of features in positives.
     neg_counts: Number of occurrences of features in negatives.
     
@@ -99,6 +104,7 @@ class CrossValidation:
         self.dataset = dataset
         self.fdata = fdata
         self.timestamp = time.time() 
+        self.timings = Timings()
         self.logfile = iofuncs.open_logfile(self.outdir/rc.report_logfile)
         # Additional attributes for 
         self.nfolds = None
@@ -133,34 +139,94 @@ class CrossValidation:
         self.notfound_pmids = []
         self.featinfo = FeatureScores.Defaults(self.fdata.featmap)
         self.featinfo.numdocs = len(self.fdata.featuredb) # For scores_bgfreq
+        t = self.timings
         # Try to load saved results
         try:
-            logging.debug("Checking if there are saved results to load...")
-            self.positives, self.pscores =\
-                iofuncs.read_scores_array(self.outdir/rc.report_positives)
-            self.negatives, self.nscores =\
-                iofuncs.read_scores_array(self.outdir/rc.report_negatives)
-            self._load_vectors(0)
-            self.featinfo.update(self.pos_counts, self.neg_counts, 
-                             len(self.positives), len(self.negatives))
-            self.featinfo.stats
-            logging.debug("Successfully loaded results")
-        # Failed to load saved results, so perform cross validation
-        except IOError:
-            if not self._load_input(pos, neg):return
-            self._load_vectors(rc.randseed)
-            self._crossvalid_scores()
-            iofuncs.write_scores(self.outdir/rc.report_positives,
-                                 izip(self.pscores, self.positives))
-            iofuncs.write_scores(self.outdir/rc.report_negatives, 
-                                 izip(self.nscores, self.negatives))
+            try:
+                logging.debug("Checking if there are saved results to load...")
+                with t.span("load_results"):
+                    self.positives, self.pscores =\
+                        iofuncs.read_scores_array(self.outdir/rc.report_positives)
+                    self.negatives, self.nscores =\
+                        iofuncs.read_scores_array(self.outdir/rc.report_negatives)
+                with t.span("load_vectors"):
+                    self._load_vectors(0)
+                with t.span("update_scores"):
+                    self.featinfo.update(self.pos_counts, self.neg_counts, 
+                                     len(self.positives), len(self.negatives))
+                    self.featinfo.stats
+                logging.debug("Successfully loaded results")
+            # Failed to load saved results, so perform cross validation
+            except IOError:
+                with t.span("load_input"):
+                    if not self._load_input(pos, neg):return
+                with t.span("load_vectors"):
+                    self._load_vectors(rc.randseed)
+                with t.span("cross_validate"):
+                    self._crossvalid_scores()
+                with t.span("save_results"):
+                    iofuncs.write_scores(self.outdir/rc.report_positives,
+                                         izip(self.pscores, self.positives))
+                    iofuncs.write_scores(self.outdir/rc.report_negatives, 
+                                         izip(self.nscores, self.negatives))
+        finally:
+            t.save(self.outdir/rc.report_timings)
+
+
+    def sweep(self, pos, neg, configs, nfolds=10):
+        """Cross validate the same data under several feature scoring
+        configurations.
+        
+        The articles are loaded, shuffled and divided into folds once, and the
+        features of each fold are counted once, so each configuration costs
+        only the calculation of feature and article scores.
+        
+        @param pos, neg: Parameters for L{_load_input}
+        
+        @param configs: List of dictionaries of keyword arguments for
+        L{FeatureScores} (scoremethod, mincount, min_infogain,
+        positives_only, type_mask).  Missing arguments take their value from
+        L{rc}.
+        
+        @param nfolds: Number of validation folds to use.
+        
+        @return: List of (config, L{FeatureScores}, L{PerformanceVectors}) for
+        each configuration. The feature scores are from all of the data.
+        """
+        logging.info("START: Cross validation sweep for %s", self.dataset)
+        self.nfolds = nfolds
+        self.notfound_pmids = []
+        if not self._load_input(pos, neg): return []
+        self._load_vectors(rc.randseed)
+        folds = make_folds(self.pos_vectors, self.neg_vectors, 
+                           nfolds, len(self.fdata.featmap))
+        results = []
+        for config in configs:
+            config = dict(config)
+            config.setdefault("scoremethod", rc.scoremethod)
+            logging.info("Sweep configuration: %s", str(config))
+            featinfo = FeatureScores(self.fdata.featmap, **config)
+            featinfo.numdocs = len(self.fdata.featuredb) # For scores_bgfreq
+            pscores, nscores = cross_validate(
+                featinfo, self.pos_vectors, self.neg_vectors, nfolds, 
+                rc.nprocs, folds)
+            featinfo.update(self.pos_counts, self.neg_counts, 
+                            len(self.positives), len(self.negatives))
+            results.append((config, featinfo, PerformanceVectors(
+                pscores, nscores, rc.alpha, rc.utility_r)))
+        return results
 
 
     def report_validation(self):
         """Report cross validation results, using default threshold of 0"""
         if len(self.positives)>0 and len(self.negatives)>0:
-            self._get_performance(0.0)
-            self._write_report()
+            try:
+                with self.timings.span("performance"):
+                    self._get_performance(0.0)
+                with self.timings.span("write_report"):
+                    self._write_report()
+            finally:
+                self.timings.save(self.outdir/rc.report_timings)
 
     
     def _load_vectors(self, randseed):
@@ -183,9 +249,13 @@ class CrossValidation:
         # Extract separate PubMed ID and vector lists
         self.positives, self.pos_vectors = zip(*pos_data)
         self.negatives, self.neg_vectors = zip(*neg_data)
-        # Count feature occurrences
-        self.pos_counts = count_features(len(self.fdata.featmap), self.pos_vectors)
-        self.neg_counts = count_features(len(self.fdata.featmap), self.neg_vectors)
+        self.timings.count("positives", len(self.positives))
+        self.timings.count("negatives", len(self.negatives))
+        # Pack the vectors and count feature occurrences
+        self.pos_vectors = PackedVectors(self.pos_vectors)
+        self.neg_vectors = PackedVectors(self.neg_vectors)
+        self.pos_counts = self.pos_vectors.counts(len(self.fdata.featmap))
+        self.neg_counts = self.neg_vectors.counts(len(self.fdata.featmap))
 
 
     def _crossvalid_scores(self):
@@ -196,7 +266,8 @@ class CrossValidation:
         """
         logging.info("Calculating scores under cross validation.")
         self.pscores, self.nscores = cross_validate(
-            self.featinfo, self.pos_vectors, self.neg_vectors, self.nfolds)
+            self.featinfo, self.pos_vectors, self.neg_vectors, self.nfolds, 
+            rc.nprocs)
         logging.info("Updating feature scores after validation.")
         self.featinfo.update(self.pos_counts, self.neg_counts, 
                              len(self.positives), len(self.negatives))
@@ -228,8 +299,9 @@ class CrossValidation:
         # Write term scores to file
         if not (self.outdir/rc.report_term_scores).exists():
             logging.debug("Writing features scores to %s", rc.report_term_scores)
-            with closing(codecs.open(self.outdir/rc.report_term_scores, "wb", "utf-8")) as f:
-                self.featinfo.write_csv(f, rc.max_output_features)
+            with self.timings.span("term_scores"):
+                with closing(codecs.open(self.outdir/rc.report_term_scores, "wb", "utf-8")) as f:
+                    self.featinfo.write_csv(f, rc.max_output_features)
         # Aliases for the performance data
         p = self.metric_vectors
         t = self.metric_range.average
@@ -255,13 +327,14 @@ class CrossValidation:
         fi = self.featinfo
         plotter.plot_feature_histogram(
             self.outdir/rc.report_featscores_img, 
-            fi.scores[fi.selected & (fi.pos_counts+fi.neg_counts)>0])
+            fi.scores_selected[(fi.pos_selected+fi.neg_selected)>0])
         # Write index file
         logging.debug("FINISH: Writing %s for %s", rc.report_index, self.dataset)
         from Cheetah.Template import Template
-        with iofuncs.FileTransaction(self.outdir/rc.report_index, "w") as ft:
-            Template(file=str(rc.templates/"validation.tmpl"), 
-                     filter="Filter", searchList=dict(VM=self)).respond(ft)
+        with self.timings.span("index"):
+            with iofuncs.FileTransaction(self.outdir/rc.report_index, "w") as ft:
+                Template(file=str(rc.templates/"validation.tmpl"), 
+                         filter="Filter", searchList=dict(VM=self)).respond(ft)
    
 
     def _load_input(self, pos, neg):
@@ -37,54 +37,212 @@ def make_partitions(nitems, nparts):
     return starts, sizes
 
 
+class PackedVectors:
+    """Feature vectors of a list of documents packed into a single array, like
+    the rows of a sparse matrix in compressed sparse row (CSR) format.
+    
+    Counting features and scoring documents then take a few array operations
+    instead of a Python loop over the documents.
+    
+    @ivar ids: Concatenation of the feature vectors of the documents.
+    
+    @ivar indptr: Vector of length N+1, where document i has the features
+    in C{ids[indptr[i]:indptr[i+1]]}.
+    """
+
+    def __init__(self, featurevectors):
+        """Pack the feature vectors.
+        @param featurevectors: Iterable of feature vectors."""
+        featurevectors = list(featurevectors)
+        self.indptr = nx.zeros(len(featurevectors)+1, nx.int64)
+        self.indptr[1:] = nx.cumsum([len(v) for v in featurevectors])
+        if len(featurevectors) > 0:
+            self.ids = nx.concatenate(featurevectors).astype(nx.uint32)
+        else:
+            self.ids = nx.zeros(0, nx.uint32)
+
+
+    def __len__(self):
+        """Number of documents"""
+        return len(self.indptr)-1
+
+
+    def counts(self, nfeats, start=0, end=None):
+        """Count occurrences of each feature in a range of documents.
+        @param nfeats: Size of feature space.
+        @param start, end: Range of documents to count.
+        @return: Array of length L{nfeats}, with the number of occurrences of 
+        each feature."""
+        if end is None: end = len(self)
+        ids = self.ids[self.indptr[start]:self.indptr[end]]
+        return nx.bincount(ids, minlength=nfeats).astype(nx.uint32)
+
+
+    def scores(self, featscores, start=0, end=None):
+        """Sum the feature scores of each document in a range of documents.
+        @param featscores: Vector of score for each feature.
+        @param start, end: Range of documents to score.
+        @return: Vector of the summed score of each document."""
+        if end is None: end = len(self)
+        offset = self.indptr[start]
+        # Differences of the cumulative sum give the sum for each document
+        cumsum = nx.zeros(self.indptr[end]-offset+1, nx.float64)
+        nx.cumsum(featscores[self.ids[offset:self.indptr[end]]], out=cumsum[1:])
+        bounds = self.indptr[start:end+1] - offset
+        return (cumsum[bounds[1:]] - cumsum[bounds[:-1]]).astype(nx.float32)
+
+
+
 def count_features(nfeats, featurevectors):
     """Count occurrenes of each feature in a set of articles.
     @param nfeats: Size of feature space.
     @param featurevectors: Iterable of feature vectors.
     @return: Array of length L{nfeats}, with the number of occurrences of each feature.
     """
-    counts = nx.zeros(nfeats, nx.uint32)
-    for featvec in featurevectors:
-        counts[featvec] += 1
-    return counts
+    return PackedVectors(featurevectors).counts(nfeats)
+
 
+def fold_ranges(positives, negatives, nfolds):
+    """Partition the articles into cross validation folds.
+    @param positives, negatives: L{PackedVectors} for relevant and irrelevant 
+    articles.
+    @param nfolds: Number of validation folds
+    @return: List with (pstart, pend, nstart, nend) for each fold, the ranges
+    of the positive and negative test articles.
+    """
+    pstarts, psizes = make_partitions(len(positives), nfolds)
+    nstarts, nsizes = make_partitions(len(negatives), nfolds)
+    return [(pstart, pstart+psize, nstart, nstart+nsize) for 
+            pstart,psize,nstart,nsize in zip(pstarts,psizes,nstarts,nsizes)]
 
-def cross_validate(featinfo, positives, negatives, nfolds):
+
+def make_folds(positives, negatives, nfolds, nfeats):
+    """Partition the articles into cross validation folds, and count the
+    features in the training articles of each fold.  This keeps two count
+    vectors per fold, so is only worth it when validating the same articles
+    several times (see L{cross_validate}).
+    
+    @param positives, negatives: L{PackedVectors} for relevant and irrelevant 
+    articles.
+    @param nfolds: Number of validation folds
+    @param nfeats: Size of feature space.
+    @return: List with (pstart, pend, nstart, nend, pos_counts, neg_counts)
+    for each fold, where the ranges are the positive and negative test
+    articles, and the counts are of features in the training articles.
+    """
+    pcounts = positives.counts(nfeats)
+    ncounts = negatives.counts(nfeats)
+    return [(pstart, pend, nstart, nend,
+             pcounts - positives.counts(nfeats, pstart, pend),
+             ncounts - negatives.counts(nfeats, nstart, nend))
+            for pstart, pend, nstart, nend in 
+            fold_ranges(positives, negatives, nfolds)]
+
+
+def cross_validate(featinfo, positives, negatives, nfolds, nprocs=1, folds=None):
     """Perform cross validation. Remember to shuffle L{positives} and
     L{negatives} before passing them in!
+    
+    @note: With several processes, each forked worker has its own copy of
+    L{featinfo}, and sees the packed vectors through the memory it inherits
+    from the parent. Feature types are loaded before forking, and each worker
+    opens its own connection to the feature mapping database. Folds are
+    assigned in order and each fold is computed exactly as in the serial
+    case, so the scores are identical.
+    
     @param featinfo: L{FeatureScores} instance for getting feature scores.
-    @param positives: List of feature vectors of relevant articles.
-    @param negatives: List of feature vectors of irrelevant articles.
+    @param positives: List of feature vectors of relevant articles (or the
+    L{PackedVectors} for them).
+    @param negatives: List of feature vectors of irrelevant articles (or the
+    L{PackedVectors} for them).
     @param nfolds: Number of validation folds
+    @param nprocs: Number of processes for evaluating folds in parallel.
+    @param folds: Result of L{make_folds}, to save re-counting features when
+    validating the same articles several times.  Otherwise the features of
+    the training articles are counted as each fold is evaluated.
     @return: (pscores, nscores), vectors of document scores of the articles
     """
-    pdocs = len(positives)
-    ndocs = len(negatives)
-    nfeats = len(featinfo.featmap)
-    logging.debug("Cross-validating %d pos and %d neg items", pdocs, ndocs)
-    pstarts, psizes = make_partitions(pdocs, nfolds)
-    nstarts, nsizes = make_partitions(ndocs, nfolds)
-    pscores = nx.zeros(pdocs, nx.float32)
-    nscores = nx.zeros(ndocs, nx.float32)
-    pcounts = count_features(nfeats, positives)
-    ncounts = count_features(nfeats, negatives)
-    for fold, (pstart,psize,nstart,nsize) in \
-        enumerate(zip(pstarts,psizes,nstarts,nsizes)):
-        logging.debug("Fold %d: pstart = %d, psize = %s; nstart = %d, nsize = %d", 
-                  fold, pstart, psize, nstart, nsize)
-        # Calculate feature scores for this fold
-        featinfo.update(
-            pos_counts = pcounts - count_features(nfeats, positives[pstart:pstart+psize]), 
-            neg_counts = ncounts - count_features(nfeats, negatives[nstart:nstart+nsize]),
-            pdocs = pdocs - psize, 
-            ndocs = ndocs - nsize,
-            prior = nx.log(pdocs/ndocs),
-        )
-        # Calculate the article scores for the test fold
-        pscores[pstart:pstart+psize] =\
-               featinfo.scores_of(positives[pstart:pstart+psize])
-        nscores[nstart:nstart+nsize] =\
-               featinfo.scores_of(negatives[nstart:nstart+nsize])
+    global _validation
+    if not isinstance(positives, PackedVectors):
+        positives = PackedVectors(positives)
+    if not isinstance(negatives, PackedVectors):
+        negatives = PackedVectors(negatives)
+    logging.debug("Cross-validating %d pos and %d neg items", 
+                  len(positives), len(negatives))
+    totals = None
+    if folds is None:
+        nfeats = len(featinfo.featmap)
+        folds = fold_ranges(positives, negatives, nfolds)
+        totals = (positives.counts(nfeats), negatives.counts(nfeats))
+    pscores = nx.zeros(len(positives), nx.float32)
+    nscores = nx.zeros(len(negatives), nx.float32)
+    _validation = (featinfo, positives, negatives, folds, totals)
+    try:
+        if nprocs > 1:
+            from multiprocessing import Pool
+            if featinfo.option("type_mask"):
+                featinfo.featmap.types # Shared with the workers
+            pool = Pool(min(nprocs, len(folds)), _init_fold_worker)
+            try:
+                results = pool.map(_fold_scores, range(len(folds)), chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [ _fold_scores(fold) for fold in range(len(folds)) ]
+    finally:
+        _validation = None
+    for fold, (fold_pscores, fold_nscores) in zip(folds, results):
+        pstart, pend, nstart, nend = fold[:4]
+        pscores[pstart:pend] = fold_pscores
+        nscores[nstart:nend] = fold_nscores
     return pscores, nscores
 
-    
+
+_validation = None
+"""Tuple of (featinfo, positives, negatives, folds, totals) for the cross
+validation in progress, for L{_fold_scores} (global so that forked
+worker processes inherit it)."""
+
+
+def _init_fold_worker():
+    """Initialise a forked process for L{_fold_scores} with its own
+    connection to the feature mapping database (SQLite connections must not
+    be used across a fork)."""
+    featmap = _validation[0].featmap
+    if hasattr(featmap, "reconnect"):
+        featmap.reconnect()
+
+
+def _fold_scores(fold):
+    """Calculate scores for the test articles of one cross validation fold.
+    @param fold: Index of the fold in the list from L{make_folds}, or from
+    L{fold_ranges} if the feature counts of all the positive and negative
+    articles are given as totals.
+    @return: Vectors of scores for the positive and negative test articles.
+    """
+    featinfo, positives, negatives, folds, totals = _validation
+    pstart, pend, nstart, nend = folds[fold][:4]
+    if totals is None:
+        pos_counts, neg_counts = folds[fold][4:]
+    else:
+        # Count the training articles of this fold only
+        pcounts, ncounts = totals
+        nfeats = len(pcounts)
+        pos_counts = pcounts - positives.counts(nfeats, pstart, pend)
+        neg_counts = ncounts - negatives.counts(nfeats, nstart, nend)
+    pdocs, ndocs = len(positives), len(negatives)
+    logging.debug("Fold %d: pstart = %d, pend = %d; nstart = %d, nend = %d", 
+                  fold, pstart, pend, nstart, nend)
+    # Calculate feature scores for this fold
+    featinfo.update(
+        pos_counts = pos_counts, 
+        neg_counts = neg_counts,
+        pdocs = pdocs - (pend-pstart), 
+        ndocs = ndocs - (nend-nstart),
+        prior = nx.log(pdocs/ndocs),
+    )
+    # Calculate the article scores for the test fold
+    base = featinfo.base + featinfo.prior
+    return (base + positives.scores(featinfo.scores, pstart, pend), 
+            base + negatives.scores(featinfo.scores, nstart, nend))
@@ -5,6 +5,10 @@ from __future__ import division
 
 import numpy as nx
 from itertools import izip
+import struct
+import time
+import zipfile
+import zlib
 
                                      
 __author__ = "Graham Poulter"                                        
@@ -121,6 +125,30 @@ def read_scores_array(filename):
     return nx.array(pmids,nx.int32), nx.array(scores,nx.float32)
 
 
+score_dtype = nx.dtype([("score", nx.float32), ("pmid", nx.uint32)])
+"""Numpy record type for (score, PubMed ID) in binary score files"""
+
+
+def write_score_records(filename, pairs, sort=False):
+    """Write scores and PubMed IDs to a binary file of L{score_dtype} records.
+    
+    This is much smaller and faster to load than L{write_scores}.
+    
+    @param pairs: Iterable over (score, PMID)
+
+    @param sort: If True, write them in decreasing order of score
+    """
+    sorted_pairs = sorted(pairs, reverse=True) if sort else pairs
+    nx.array(list(sorted_pairs), score_dtype).tofile(str(filename))
+
+
+def read_score_records(filename):
+    """Read a file written by L{write_score_records}
+    
+    @return: Array of L{score_dtype} records."""
+    return nx.fromfile(str(filename), score_dtype)
+
+
 def no_valid_pmids_page(filename, dataset, pmids):
     """Print an error page when no valid PubMed IDs were found
     
@@ -168,6 +196,92 @@ class FileTransaction(file):
 
 
 
+class ZipEntryWriter:
+    """Streams a single compressed file into a new zip archive.
+    
+    The zipfile module can only add a whole string or file to an archive, so
+    to zip a report we used to read it back after writing it.  This writes
+    the deflated data while the report is generated, then goes back to fill
+    in the CRC and sizes in the local header, and writes the central
+    directory itself (using the record layouts of the zip format, not the
+    internals of the zipfile module).
+    
+    Usage::
+        with ZipEntryWriter("results.zip", "results.html") as zw:
+            zw.write("<html>...")
+    
+    @ivar fp: The zip file being written.
+    
+    @ivar arcname: Name of the entry within the archive.
+    
+    @ivar CRC, compress_size, file_size: Checksum and sizes of the entry
+    so far.
+    """
+    
+    def __init__(self, zipname, arcname):
+        """Create the archive and write a placeholder local header
+        
+        @param zipname: Path to the zip file to create.
+        
+        @param arcname: Name of the file within the archive.
+        """
+        self.fp = open(zipname, "wb")
+        self.arcname = str(arcname)
+        t = time.localtime()
+        self.dostime = t[3] << 11 | t[4] << 5 | t[5] // 2
+        self.dosdate = (t[0] - 1980) << 9 | t[1] << 5 | t[2]
+        self.CRC = self.compress_size = self.file_size = 0
+        self.fp.write(self._local_header())
+        self.compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+    def _local_header(self):
+        """Local file header of the entry, for the sizes so far"""
+        return struct.pack("<4s2B4HL2L2H", "PK\003\004", 20, 0, 0, 
+            zipfile.ZIP_DEFLATED, self.dostime, self.dosdate, self.CRC, 
+            self.compress_size, self.file_size, len(self.arcname), 0) \
+            + self.arcname
+
+    def write(self, data):
+        """Compress a string into the archive"""
+        self.file_size += len(data)
+        self.CRC = zlib.crc32(data, self.CRC) & 0xffffffff
+        data = self.compressor.compress(data)
+        self.compress_size += len(data)
+        self.fp.write(data)
+
+    def close(self):
+        """Flush the compressor, complete the local header and write the
+        central directory."""
+        if self.fp is None:
+            return
+        fp = self.fp
+        data = self.compressor.flush()
+        self.compress_size += len(data)
+        fp.write(data)
+        directory = fp.tell()
+        fp.seek(0)
+        fp.write(self._local_header())
+        fp.seek(directory)
+        # Central directory entry (made by Unix, for rw-r--r-- permissions)
+        fp.write(struct.pack("<4s4B4HL2L5H2L", "PK\001\002", 20, 3, 20, 0, 
+            0, zipfile.ZIP_DEFLATED, self.dostime, self.dosdate, self.CRC, 
+            self.compress_size, self.file_size, len(self.arcname), 0, 0, 0, 0, 
+            0644 << 16L, 0) + self.arcname)
+        # End of central directory record
+        fp.write(struct.pack("<4s4H2LH", "PK\005\006", 0, 0, 1, 1, 
+            fp.tell() - directory, directory, 0))
+        fp.close()
+        self.fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+
 def start_logger(console=True, logfile=False):
     """Set up logging to file or console
     @param console: If True, log to the console.
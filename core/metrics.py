@@ -97,52 +97,26 @@ class PerformanceVectors:
 
 
     def _confusion_vectors(self):
-        """Calculates confusion matrix counts by iterating over pscores
+        """Calculates confusion matrix counts by binary search of the unique
+        scores in the sorted pscores and nscores.
         
         Sets L{uscores}, L{PE}, L{NE}, L{TP}, L{TN}, L{FP}, L{FN}
         """
         s = self
         self.uscores = nx.unique(nx.concatenate((s.pscores,s.nscores)))
-        vlen = len(s.uscores)
         P = len(s.pscores)
         N = len(s.nscores)
-        self.PE = nx.zeros(vlen, nx.float32) # positives with given score
-        self.NE = nx.zeros(vlen, nx.float32) # negatives with given score
-        self.TP = nx.zeros(vlen, nx.float32) # true positives
-        self.TN = nx.zeros(vlen, nx.float32) # true negatives
-        self.FP = nx.zeros(vlen, nx.float32) # false positives
-        self.FN = nx.zeros(vlen, nx.float32) # false negatives
-        TN = 0
-        FN = 0
-        for idx, threshold in enumerate(s.uscores):
-
-            # Classify positives scoring < threshold as negative
-            # (look up score for the next article to classify)
-            while (FN < P) and (s.pscores[FN] < threshold):
-                FN += 1
-            TP = P - FN # TP+FN=P
-
-            # pcount-FN = number of positives having threshold score
-            pcount = FN # Start at FN, subtract it later
-            while (pcount < P) and s.pscores[pcount] == threshold:
-                pcount += 1
-            s.PE[idx] = pcount-FN
-            
-            # Classify negatives scoring < threshold as negative
-            while (TN < N) and (s.nscores[TN] < threshold):
-                TN += 1
-            FP = N - TN  # TN+FP=N
-
-            # ncount-TN = number of negatives having threshold score
-            ncount = TN # Start at TN and subtract it later
-            while (ncount < N) and s.nscores[ncount] == threshold:
-                ncount += 1
-            s.NE[idx] = ncount-TN
-            
-            s.TP[idx] = TP
-            s.TN[idx] = TN
-            s.FP[idx] = FP
-            s.FN[idx] = FN
+        # Positives scoring < threshold are classified as negative
+        FN = nx.searchsorted(s.pscores, s.uscores, side="left")
+        # Negatives scoring < threshold are correctly classified
+        TN = nx.searchsorted(s.nscores, s.uscores, side="left")
+        # Numbers of positives and negatives having each threshold score
+        self.PE = (nx.searchsorted(s.pscores, s.uscores, side="right") - FN).astype(nx.float32)
+        self.NE = (nx.searchsorted(s.nscores, s.uscores, side="right") - TN).astype(nx.float32)
+        self.TP = (P - FN).astype(nx.float32) # TP+FN=P
+        self.TN = TN.astype(nx.float32)
+        self.FP = (N - TN).astype(nx.float32) # TN+FP=N
+        self.FN = FN.astype(nx.float32)
 
 
     def _ratio_vectors(self, alpha):
@@ -186,25 +160,21 @@ class PerformanceVectors:
 
 
     def _mergescores(self):
-        """Merges pscores and nscores in a single pass
+        """Merges pscores and nscores into a single ranking
         
-        @note: L{nscores} and L{pscores} must be in increasing order of score.        
+        @note: Where a positive and a negative have the same score, the
+        positive is ranked first.
         
-        @return: Iterator over (score, relevance) in decreasing order of score.
-        Relevance is True for members of pscores, and False for members of
-        nscores. """
+        @return: Vector of scores in decreasing order, and a boolean vector of
+        relevance which is True for members of pscores, and False for members
+        of nscores."""
         s = self
-        p_idx = len(s.pscores)-1
-        n_idx = len(s.nscores)-1
-        while p_idx >= 0 or n_idx >= 0:
-            if p_idx >= 0 and \
-            (n_idx < 0 or s.pscores[p_idx] >= s.nscores[n_idx]):
-                yield s.pscores[p_idx], True
-                p_idx -= 1
-            elif n_idx >= 0 and \
-            (p_idx < 0 or s.nscores[n_idx] > s.pscores[p_idx]):
-                yield s.nscores[n_idx], False
-                n_idx -= 1
+        scores = nx.concatenate((s.pscores, s.nscores))
+        relevant = nx.concatenate((nx.ones(len(s.pscores), bool), 
+                                   nx.zeros(len(s.nscores), bool)))
+        # Sort on decreasing score, then on relevance
+        order = nx.lexsort((~relevant, -scores))
+        return scores[order], relevant[order]
 
 
     def _averaged_precision(self):
@@ -212,16 +182,12 @@ class PerformanceVectors:
         
         Sets L{AvPrec}, which is precision averaged over each point where a
         relevant document is returned"""
-        AvPrec = 0.0
-        TP = 0
-        FP = 0
-        for score, relevant in self._mergescores():
-            if relevant:
-                TP += 1
-                AvPrec += TP/(TP+FP)
-            else:
-                FP += 1
-        self.AvPrec = AvPrec/TP
+        scores, relevant = self._mergescores()
+        # Rank of each relevant document, and the number of relevant 
+        # documents up to and including it
+        ranks = nx.flatnonzero(relevant) + 1
+        TP = nx.arange(1, len(ranks)+1)
+        self.AvPrec = nx.sum(TP / ranks) / len(ranks)
 
 
     def _roc_error(self):
@@ -273,18 +239,16 @@ class PerformanceVectors:
         """Return the interpolated 11-point curve of precision versus recall.
         Precision is evaluated at recall of 0, 0.1, ..., 0.9, 1.0."""
         TPR, PPV = self.TPR, self.PPV
-        N = len(self.TPR)
+        # Greatest precision at recall >= target recall. Recall decreases
+        # with the threshold index, so that is a prefix of the vectors.
+        maxprec = nx.maximum.accumulate(PPV)
+        # Compare in double precision, as the target recalls are doubles
+        TPR = TPR.astype(nx.float64)
         self.precision_11 = [0] * 11
-        idx = 0
-        curprec = 0
-        # Decreasing recall, increasing precision as idx increases
         for i, recall in enumerate(nx.linspace(1,0,11)):
-            # Select greatest precision that has recall >= target recall
-            while idx < N and TPR[idx] >= recall:
-                if PPV[idx] > curprec:
-                    curprec = PPV[idx]
-                idx += 1
-            self.precision_11[i] = curprec
+            count = nx.sum(TPR >= recall)
+            if count > 0:
+                self.precision_11[i] = max(0, maxprec[count-1])
         self.precision_11.reverse()
 
 
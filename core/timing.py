@@ -0,0 +1,144 @@
+"""Lightweight timing of the stages of an operation, with counters and
+peak memory use, saved as JSON in the output directory."""
+
+from __future__ import with_statement
+from __future__ import division
+
+from contextlib import contextmanager
+import logging
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import resource
+except ImportError:
+    resource = None # Not available on Windows
+
+
+__author__ = "Graham Poulter"
+__license__ = """This program is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your option)
+any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>."""
+
+
+def peak_rss():
+    """Peak resident memory in kilobytes of this process and of its
+    finished child processes (such as FeatureCounter and ScoreCalculator).
+    @return: (self, children), or (None, None) if not available."""
+    if resource is None:
+        return None, None
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+class Timings:
+    """Records the time taken by named stages (spans) of an operation, and
+    counts of things processed.  Spans nest, and the name of a span inside
+    another is the path of names separated by '/'.
+
+    Usage::
+        timings = Timings()
+        with timings.span("load"):
+            timings.count("articles", len(articles))
+        timings.save(outdir/rc.report_timings)
+
+    @ivar started: Time when the object was created.
+
+    @ivar spans: List of dictionaries for finished spans, with "name",
+    "start" (seconds after L{started}), "seconds", and "rss_kb" and
+    "child_rss_kb" (peak memory use at the end of the span).
+
+    @ivar counters: Dictionary from counter name to integer count.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.spans = []
+        self.counters = {}
+        self._stack = []
+
+
+    @contextmanager
+    def span(self, name):
+        """Context manager to time a stage of the operation"""
+        self._stack.append(name)
+        fullname = "/".join(self._stack)
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            self._stack.pop()
+            rss, child_rss = peak_rss()
+            self.spans.append(dict(name=fullname, start=start-self.started,
+                seconds=seconds, rss_kb=rss, child_rss_kb=child_rss))
+            logging.debug("Timing: %s took %.3fs", fullname, seconds)
+
+
+    def count(self, name, n=1):
+        """Add to a named counter"""
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+
+    def totals(self):
+        """Total seconds for each span name"""
+        totals = {}
+        for span in self.spans:
+            totals[span["name"]] = totals.get(span["name"], 0) + span["seconds"]
+        return totals
+
+
+    def as_dict(self):
+        """Dictionary of everything recorded, as saved by L{save}"""
+        rss, child_rss = peak_rss()
+        return dict(started=self.started, seconds=time.time()-self.started,
+                    rss_kb=rss, child_rss_kb=child_rss,
+                    spans=self.spans, totals=self.totals(),
+                    counters=self.counters)
+
+
+    def save(self, filename):
+        """Write L{as_dict} as JSON to a file (replacing it in one step)"""
+        tmpfile = filename + ".tmp"
+        with open(tmpfile, "w") as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+        tmpfile.rename(filename)
+
+
+
+def load_timings(filename):
+    """Read a dictionary saved by L{Timings.save}"""
+    with open(filename) as f:
+        return json.load(f)
+
+
+def aggregate(timings):
+    """Summarise the span totals of many operations.
+    @param timings: Iterable of dictionaries from L{load_timings}.
+    @return: Dictionary from span name to a dictionary with "count" (number
+    of operations having the span), "total", "mean", "median", "p95" and
+    "max" seconds.  The name "*" is for the whole of each operation."""
+    samples = {}
+    for timing in timings:
+        samples.setdefault("*", []).append(timing["seconds"])
+        for name, seconds in timing["totals"].iteritems():
+            samples.setdefault(name, []).append(seconds)
+    summary = {}
+    for name, values in samples.iteritems():
+        values.sort()
+        n = len(values)
+        summary[name] = dict(count=n, total=sum(values), mean=sum(values)/n,
+            median=values[n//2], p95=values[min(n-1, int(0.95*n))], max=values[-1])
+    return summary
@@ -36,7 +36,12 @@ class ScoreCalculator:
     
     @ivar numdocs: Number of documents in the stream of feature vectors.
     
-    @ivar featscores: Numpy array of single-precision feature scores.
+    @ivar featscores: Numpy array of single-precision feature scores, or a
+    sparse (ids, scores) pair of arrays giving the features whose scores are
+    not zero.
+    
+    @ivar numfeats: Number of features (defaults to the length of a dense
+    L{featscores}).
     
     @ivar offset: Sum of the Bayesian prior score and the base log likelihood 
     of an article with no features.
@@ -80,14 +85,32 @@ class ScoreCalculator:
                  mindate=None,
                  maxdate=None,
                  exclude=set(),
+                 numfeats=None,
                  ):
         # Callers may want to pass None, but the C code needs numbers.
         if threshold is None: threshold = -10000.0
         if mindate is None: mindate = 10110101
         if maxdate is None: maxdate = 30330303
+        if numfeats is None: numfeats = len(featscores)
         update(self, locals())
 
 
+    @property
+    def sparse(self):
+        """True if L{featscores} is a sparse (ids, scores) pair."""
+        return isinstance(self.featscores, tuple)
+
+
+    def dense_scores(self):
+        """Return L{featscores} as a dense single-precision array."""
+        if not self.sparse:
+            return self.featscores
+        ids, scores = self.featscores
+        result = nx.zeros(self.numfeats, nx.float32)
+        result[ids] = scores
+        return result
+
+
     def score(s):
         """Meta-method to top-scoring PubMed IDs in Medline
         
@@ -119,6 +142,7 @@ class ScoreCalculator:
         results = [(-100000, 0)] * s.limit
         import heapq
         ndocs = 0
+        featscores = s.dense_scores()
         logging.debug("Calculating article scores")
         marker = 0
         docs = FeatureStream(s.docstream, rdonly=True)
@@ -129,7 +153,7 @@ class ScoreCalculator:
                     marker += 100000
                 if (docid in s.exclude or date < s.mindate or date > s.maxdate):
                     continue
-                score = s.offset + nx.sum(s.featscores[features])
+                score = s.offset + nx.sum(featscores[features])
                 if score >= s.threshold:
                     ndocs += 1
                     if score >= results[0][0]:
@@ -137,7 +161,7 @@ class ScoreCalculator:
         finally:
             docs.close()
         if ndocs > s.limit:
-            ndocs = limit
+            ndocs = s.limit
         return heapq.nlargest(ndocs, results)
 
 
@@ -150,14 +174,26 @@ class ScoreCalculator:
             s.score_exec, 
             s.docstream,
             str(s.numdocs),
-            str(len(s.featscores)),
+            str(s.numfeats),
             str(s.offset),
             str(s.limit+len(s.exclude)),
             str(s.threshold),
             str(s.mindate),
             str(s.maxdate),
-            ], stdout=sp.PIPE, stdin=sp.PIPE)
-        p.stdin.write(s.featscores.tostring())
+            ] + (["sparse"] if s.sparse else []), stdout=sp.PIPE, stdin=sp.PIPE)
+        if s.sparse:
+            # Only send the features having non-zero scores, by increasing
+            # feature ID since the program looks them up by binary search
+            ids, scores = s.featscores
+            ids = nx.asarray(ids, nx.uint32)
+            if nx.any(ids[1:] < ids[:-1]):
+                order = nx.argsort(ids)
+                ids, scores = ids[order], nx.asarray(scores)[order]
+            p.stdin.write(struct.pack("I", len(ids)))
+            p.stdin.write(ids.tostring())
+            p.stdin.write(nx.asarray(scores, nx.float32).tostring())
+        else:
+            p.stdin.write(s.featscores.tostring())
         output = p.stdout.read(8)
         count = 0
         # Go through results in decreasing order to filter them
@@ -206,13 +242,13 @@ class ScoreCalculator:
         cscore.cscore(
             s.docstream,
             s.numdocs,
-            len(s.featscores),
+            s.numfeats,
             s.offset,
             output_size,
             s.threshold,
             s.mindate,
             s.maxdate,
-            s.featscores,
+            s.dense_scores(),
             byref(o_numresults),
             o_scores,
             o_pmids)
@@ -12,6 +12,7 @@ Usage:
 [threshold] \
 [mindate] \
 [maxdate] \
+[sparse] \
 < feature_scores > results
 
   See _FeatureCounter.c for format of the [citations] file.
@@ -19,6 +20,13 @@ Usage:
   The feature scores from standard input are a list of [numfeats]
   32-bit single-precision floats.
 
+  If the optional [sparse] argument is given as "sparse", the standard
+  input instead starts with a 32-bit unsigned count N, followed by N
+  32-bit unsigned feature IDs in increasing order and then N 32-bit floats
+  with the scores of those features. All other features have a score of
+  zero. Each feature of a citation is then found by binary search in the
+  IDs, instead of in an array of [numfeats] scores.
+
   The output is a list of [limit] citation scores as score_t structures,
   where each citation score has [offset] added to it beforehand.
   
@@ -39,6 +47,7 @@ this program. If not, see <http://www.gnu.org/licenses/>. */
 
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <math.h>
 
 // Simple tests for ctypes
@@ -63,6 +72,28 @@ int compare_scores(const void *a, const void *b) {
 }
 
 
+// Score of feature feat from the sorted sparse_ids and their sparse_scores,
+// or zero if feat is not listed.  Searches from *lo onwards and leaves *lo
+// at the position of feat, since the features of a citation are increasing.
+float sparse_score(
+    const unsigned int *sparse_ids, const float *sparse_scores,
+    unsigned int numsparse, unsigned int *lo, unsigned int feat) 
+{
+    unsigned int hi = numsparse;
+    unsigned int mid = 0;
+    while (*lo < hi) {
+        mid = *lo + (hi - *lo) / 2;
+        if (sparse_ids[mid] < feat)
+            *lo = mid + 1;
+        else
+            hi = mid;
+    }
+    if ((*lo < numsparse) && (sparse_ids[*lo] == feat))
+        return sparse_scores[*lo];
+    return 0.0;
+}
+
+
 #ifdef CSCORE
 int main (int argc, char **argv)
 {
@@ -112,13 +143,29 @@ void cscore(
     unsigned int gap = 0; // Gap between feature IDs
     unsigned int last = 0; // Value of previous decoded feature ID
 
+    // Sparse feature scores (only used with the "sparse" argument)
+    unsigned int numsparse = 0; // Number of features with non-zero scores
+    unsigned int *sparse_ids = NULL; // Increasing IDs of those features
+    float *sparse_scores = NULL; // Scores of those features
+    unsigned int lo = 0; // Search position in sparse_ids
+
     // Scores of all citations 
     score_t *scores = (score_t*) malloc (numcites * sizeof(score_t));
 
     #ifdef CSCORE
     // Allocate space for feature scores and read them from input
-    float *featscores = (float*) malloc (numfeats * sizeof(float));
-    fread(featscores, sizeof(float), numfeats, stdin);
+    float *featscores = NULL;
+    if ((argc > 9) && (strcmp(argv[9], "sparse") == 0)) {
+        // Read only the IDs and scores of the non-zero feature scores
+        fread(&numsparse, sizeof(unsigned int), 1, stdin);
+        sparse_ids = (unsigned int*) malloc (numsparse * sizeof(unsigned int));
+        sparse_scores = (float*) malloc (numsparse * sizeof(float));
+        fread(sparse_ids, sizeof(unsigned int), numsparse, stdin);
+        fread(sparse_scores, sizeof(float), numsparse, stdin);
+    } else {
+        featscores = (float*) malloc (numfeats * sizeof(float));
+        fread(featscores, sizeof(float), numfeats, stdin);
+    }
     #endif
 
     // Calculate citation scores
@@ -154,8 +201,16 @@ void cscore(
         // Start with the offset score
         tmp_score = offset;
         // Add up the adjusted feature scores
-        for(fi = 0; fi < featvec_size; fi++) {
-            tmp_score += (float)featscores[featvec[fi]];
+        if (sparse_ids != NULL) {
+            lo = 0;
+            for(fi = 0; fi < featvec_size; fi++) {
+                tmp_score += sparse_score(
+                    sparse_ids, sparse_scores, numsparse, &lo, featvec[fi]);
+            }
+        } else {
+            for(fi = 0; fi < featvec_size; fi++) {
+                tmp_score += (float)featscores[featvec[fi]];
+            }
         }
         scores[pi].score = tmp_score;
         // Count the result if it scores high enough
@@ -34,6 +34,7 @@ urls = (
     '/query', 'templates.query_logic.QueryPage',
     '/status', 'templates.status_logic.StatusPage',
     '/output', 'templates.output_logic.OutputPage',
+    '/report/([^/]+)/(.*)', 'templates.report_logic.ReportPage',
     '/contact', 'templates.contact_logic.ContactPage',
 )
 """Mapping between URLs and objects to process the requests"""
@@ -4,7 +4,10 @@
 
 Queueing program checks queue directory every second for new descriptor files,
 and starts a query or validation operation. When the operation completes, the
-descriptor file is moved to the output.
+descriptor file is moved to the output.  Several tasks run at once in worker
+processes, with retrievals starting before validations (see L{schedule}).
+The queue wakes as soon as a descriptor is written (see L{QueueWatcher}),
+and keeps the status of every task in a L{TaskIndex} for the web pages.
 
 Example descriptor file for query::
     #operation = query
@@ -25,24 +28,36 @@ Example descriptor file for validation::
     804133
     3214241
     ...
+
+Run C{queue.py timings [N]} to print the time taken by each stage of
+the newest N completed tasks (default all), from their timings files, and
+C{queue.py metrics} to print the queue metrics last written by the queue.
 """
 
 from __future__ import with_statement
 from __future__ import division
 
+import ctypes
+import ctypes.util
 import logging
 import math
 import numpy as nx
 import os
 from path import path
+from pysqlite2 import dbapi2 as sqlite3
+import select
 import sys
 import time
 
 from mscanner.configuration import rc
-from mscanner.core.QueryManager import QueryManager
-from mscanner.core.ValidationManager import CrossValidation
 from mscanner.core import iofuncs
-from mscanner.medline.Updater import Updater
+from mscanner.core.Storage import Storage
+from mscanner.core.timing import aggregate, load_timings, peak_rss
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 
                                      
@@ -86,6 +101,7 @@ descriptor_keys = dict(
     numnegs=int,           # Number of irrelevant articles for CV
     operation=str,         # "retrieval" or "validation"
     submitted=float,       # Timestamp when the task was submitted
+    submitter=str,         # Address of the submitter, for sharing the workers
     prevalence=float,      # Prevalence of relevant articles in Medline (deprecated)
     )
 
@@ -98,7 +114,6 @@ def read_descriptor(fpath):
     with read_pmids, which will ignores the lines beginning with '#'.
 
     @return: Storage object, with additional '_filename' containing fpath."""
-    from mscanner.core.Storage import Storage
     result = Storage()
     with open(fpath, "r") as f:
         line = f.readline()
@@ -132,16 +147,59 @@ def write_descriptor(fpath, pmids, params):
         f.flush()
 
 
+def submit_task(pmids, task):
+    """Add a task to the queue, writing its descriptor under a hidden name
+    and renaming it into place so the queue never sees a partial file.  The
+    task goes in the L{TaskIndex} before the rename, so that status pages
+    show it at once, and the queue cannot have started it yet.
+    @param pmids: List of PubMed IDs for the descriptor.
+    @param task: Parameters of the task (see L{write_descriptor})."""
+    fpath = rc.queue_path / task["dataset"]
+    tmpfile = rc.queue_path / ("." + task["dataset"])
+    write_descriptor(tmpfile, pmids, task)
+    descriptor = read_descriptor(tmpfile)
+    descriptor._filename = fpath
+    index = TaskIndex()
+    try:
+        index.put(descriptor, QueueStatus.WAITING)
+    finally:
+        index.close()
+    tmpfile.rename(fpath)
+
+
+def cancel_task(dataset):
+    """Remove a waiting task from the L{TaskIndex} and the queue.  The index
+    row goes first, so that the queue does not pick up the task after its
+    descriptor is gone."""
+    index = TaskIndex()
+    try:
+        index.remove(dataset)
+    finally:
+        index.close()
+    (rc.queue_path / dataset).remove()
+
+
+
 class QueueStatus:
-    """Describes the current state of the queue
+    """Describes the current state of the queue, as recorded in the
+    L{TaskIndex} (which is built by scanning the queue and output
+    directories the first time it is used).
     
     @ivar tasklist: Descriptors of tasks in the queue, oldest first.
     
-    @ivar running: First member of L{tasklist}, which is being processed.
+    @ivar runlist: Members of L{tasklist} being processed by the queue
+    workers, in the order they started.
+    
+    @ivar waitlist: Members of L{tasklist} that are neither running nor
+    failed, in the order that L{schedule} would start them if they all had
+    to wait for one worker.
+    
+    @ivar running: First member of L{runlist}, or None.
     
     @ivar donelist: Completed tasks, oldest first.
     
-    @ivar status: Mapping from dataset to status code (DONE, RUNNING, WAITING)
+    @ivar status: Mapping from dataset to status code (DONE, RUNNING,
+    WAITING, FAILED)
     
     @ivar _tasks: Mapping from dataset to task object
     """
@@ -149,34 +207,36 @@ class QueueStatus:
     DONE = "done"
     RUNNING = "running"
     WAITING = "waiting"
+    FAILED = "failed"
     
     def __init__(self, with_done=True):
         """Constructor for the status
         
         @param with_done: Set this to False if you don't need L{donelist}."""
-        self._load_tasklist()
-        self.donelist = []
-        if with_done: self._load_donelist()
+        index = TaskIndex()
+        try:
+            if not index.built:
+                index.rebuild()
+            self._load_tasklist(index)
+            self.donelist = []
+            if with_done: self._load_donelist(index)
+        finally:
+            index.close()
         self._load_maps()
 
     
-    def _load_tasklist(self):
-        """Populate L{tasklist}."""
-        maxtime = time.time() - 0.19 # Slept for 0.2 in query_logic.py
-        eligible_files = [f for f in rc.queue_path.files() if f.mtime < maxtime]
-        self.tasklist = [read_descriptor(f) for f in eligible_files]
-        self.tasklist.sort(key=lambda x:x.submitted)
-        self.running = self.tasklist[0] if self.tasklist else None
+    def _load_tasklist(self, index):
+        """Populate L{tasklist}, L{runlist}, L{waitlist} and L{running}."""
+        self.tasklist = index.tasks(self.WAITING, self.RUNNING, self.FAILED)
+        self.runlist = index.tasks(self.RUNNING, order="started")
+        self.waitlist = index.tasks(self.WAITING)
+        self.waitlist.sort(key=lambda t: task_priority(t, {}, time.time()))
+        self.running = self.runlist[0] if self.runlist else None
 
 
-    def _load_donelist(self):
+    def _load_donelist(self, index):
         """Populate L{donelist}"""
-        self.donelist = []
-        for fpath in rc.web_report_dir.dirs():
-            if (fpath/rc.report_descriptor).exists():
-                self.donelist.append(
-                    read_descriptor(fpath/rc.report_descriptor))
-        self.donelist.sort(key=lambda x:x.submitted)
+        self.donelist = index.tasks(self.DONE)
 
 
     def _load_maps(self):
@@ -184,13 +244,15 @@ class QueueStatus:
         self.status = {}
         self._tasks = {}
         for task in self.tasklist:
-            self.status[task.dataset] = self.WAITING
+            self.status[task.dataset] = self.FAILED
             self._tasks[task.dataset] = task
         for task in self.donelist:
             self.status[task.dataset] = self.DONE
             self._tasks[task.dataset] = task
-        if self.tasklist:
-            self.status[self.running.dataset] = self.RUNNING
+        for task in self.waitlist:
+            self.status[task.dataset] = self.WAITING
+        for task in self.runlist:
+            self.status[task.dataset] = self.RUNNING
 
     
     def __getitem__(self, dataset):
@@ -204,26 +266,575 @@ class QueueStatus:
 
 
     def position(self, dataset):
-        """Return distance of dataset from front of queue."""
-        for idx, d in enumerate(self.tasklist):
+        """Return distance of dataset from front of queue (the number of
+        tasks running or due to start before it)."""
+        for idx, d in enumerate(self.runlist + self.waitlist):
             if d.dataset == dataset:
                 return idx
         return None
 
+
+
+class TaskIndex:
+    """SQLite table of the status of every task, so that status pages and
+    the queue do not have to read every descriptor in the queue and output
+    directories.  The queue and the web pages update it as tasks are
+    submitted, started, completed and deleted, and L{sync_queue} picks up
+    changes to the queue directory made by other means.
     
+    @ivar filename: Path to the database (defaults to L{rc.queue_index}).
     
+    @ivar con: Connection to the database.
+    """
+
+    def __init__(self, filename=None):
+        """Open the index, creating the table if necessary.  The web server
+        and the queue run as different users and both write to the index, so
+        a new database file is made world-writable (like the descriptors),
+        and its directory must be writable by both for SQLite's journal."""
+        self.filename = path(rc.queue_index if filename is None else filename)
+        created = not self.filename.exists()
+        self.con = sqlite3.connect(self.filename, timeout=30)
+        self.con.execute("""CREATE TABLE IF NOT EXISTS tasks (
+          dataset TEXT PRIMARY KEY, status TEXT, submitted REAL, 
+          started REAL, filename TEXT, params TEXT)""")
+        self.con.execute("""CREATE TABLE IF NOT EXISTS meta (
+          key TEXT PRIMARY KEY, value REAL)""")
+        self.con.commit()
+        if created:
+            try:
+                self.filename.chmod(0666)
+            except OSError:
+                pass # Created by another process at the same time
+
+
+    def close(self):
+        """Close the underlying database"""
+        self.con.close()
+
+
+    @property
+    def built(self):
+        """True if L{rebuild} has been called on this index"""
+        return self.con.execute(
+            "SELECT value FROM meta WHERE key='built'").fetchone() is not None
+
+
+    def put(self, task, status, started=None):
+        """Add or replace a task.
+        @param task: Descriptor of the task (see L{read_descriptor}).
+        @param status: One of the L{QueueStatus} status codes.
+        @param started: Time when the task started running."""
+        self._put(task, status, started)
+        self.con.commit()
+
+
+    def _put(self, task, status, started=None):
+        """Add or replace a task without committing"""
+        params = dict((k, v) for k, v in task.iteritems() if k in descriptor_keys)
+        self.con.execute("INSERT OR REPLACE INTO tasks VALUES (?,?,?,?,?,?)",
+            (task.dataset, status, task.submitted, started, 
+             str(task._filename), json.dumps(params)))
+
+
+    def set_status(self, dataset, status, started=None):
+        """Change the status of a task (and the time it started)"""
+        self.con.execute("UPDATE tasks SET status=?, started=? WHERE dataset=?",
+                         (status, started, dataset))
+        self.con.commit()
+
+
+    def remove(self, dataset):
+        """Remove a task from the index"""
+        self.con.execute("DELETE FROM tasks WHERE dataset=?", (dataset,))
+        self.con.commit()
+
+
+    def tasks(self, *statuses, **kwargs):
+        """Get the tasks having any of the given status codes.
+        @keyword order: Column to sort by ("submitted" or "started").
+        @return: List of task descriptors, as from L{read_descriptor}."""
+        order = kwargs.get("order", "submitted")
+        if order not in ["submitted", "started"]:
+            raise ValueError("Cannot sort tasks by %s" % order)
+        result = []
+        for filename, params in self.con.execute(
+            "SELECT filename, params FROM tasks WHERE status IN (%s) ORDER BY %s" 
+            % (",".join("?" * len(statuses)), order), statuses):
+            task = Storage()
+            for key, value in json.loads(params).iteritems():
+                key = str(key)
+                task[key] = value if value is None else descriptor_keys[key](value)
+            task["_filename"] = path(filename)
+            result.append(task)
+        return result
+
+
+    def sync_queue(self):
+        """Bring the waiting tasks up to date with the queue directory:
+        descriptors not in the index are added as waiting, and waiting or
+        failed tasks whose descriptor has gone are marked done if they have an
+        output descriptor, or removed.  Hidden files (being written by
+        L{submit_task}) are ignored.  Running tasks are left to the queue.
+        @return: Number of tasks added or removed."""
+        files = dict((f.name, f) for f in rc.queue_path.files() 
+                     if not f.name.startswith("."))
+        known = dict(self.con.execute(
+            "SELECT dataset, status FROM tasks WHERE status IN (?,?,?)",
+            (QueueStatus.WAITING, QueueStatus.RUNNING, QueueStatus.FAILED)))
+        changes = 0
+        for name, fpath in files.iteritems():
+            if name not in known:
+                try:
+                    self._put(read_descriptor(fpath), QueueStatus.WAITING)
+                    changes += 1
+                except (IOError, ValueError, KeyError), e:
+                    logging.warning("Could not read descriptor %s: %s", fpath, e)
+        for name, status in known.iteritems():
+            if name not in files and status != QueueStatus.RUNNING:
+                self._sync_gone(name)
+                changes += 1
+        self.con.commit()
+        return changes
+
+
+    def _sync_gone(self, dataset):
+        """Update a task whose queue descriptor has gone, without committing"""
+        done = rc.web_report_dir / dataset / rc.report_descriptor
+        if done.exists():
+            self._put(read_descriptor(done), QueueStatus.DONE)
+        else:
+            self.con.execute("DELETE FROM tasks WHERE dataset=?", (dataset,))
+
+
+    def task_finished(self, dataset):
+        """Mark a task done if its descriptor was moved to the output
+        directory, or failed otherwise.  Failed tasks stay in the queue
+        directory, and are retried when L{rebuild} makes them waiting."""
+        if (rc.queue_path / dataset).exists():
+            self.con.execute("UPDATE tasks SET status=?, started=NULL WHERE dataset=?",
+                             (QueueStatus.FAILED, dataset))
+        else:
+            self._sync_gone(dataset)
+        self.con.commit()
+
+
+    def rebuild(self):
+        """Replace the index with the tasks found by reading every
+        descriptor in the queue and output directories.  Tasks in the queue
+        directory are waiting (including ones that failed before), unless
+        they have an output descriptor."""
+        self.con.execute("DELETE FROM tasks")
+        for fpath in rc.queue_path.files():
+            if not fpath.name.startswith("."):
+                self._put(read_descriptor(fpath), QueueStatus.WAITING)
+        for dirpath in rc.web_report_dir.dirs():
+            if (dirpath/rc.report_descriptor).exists():
+                self._put(read_descriptor(dirpath/rc.report_descriptor), 
+                          QueueStatus.DONE)
+        self.con.execute("INSERT OR REPLACE INTO meta VALUES ('built',?)", 
+                         (time.time(),))
+        self.con.commit()
+
+
+
+class QueueWatcher:
+    """Waits for files to change in a directory, using inotify where the C
+    library provides it, or else by sleeping for the whole timeout.
+    
+    @ivar fd: File descriptor of the inotify instance, or None if polling.
+    """
+    
+    IN_CLOSE_WRITE = 0x08
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_DELETE = 0x200
+    
+    def __init__(self, dirpath):
+        """Start watching the directory for files being written, moved or
+        deleted"""
+        self.fd = None
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init()
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init failed")
+            if libc.inotify_add_watch(fd, str(dirpath), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.fd = fd
+        except (OSError, AttributeError, TypeError), e:
+            logging.info("Polling %s because inotify is not available (%s)", dirpath, e)
+
+
+    def close(self):
+        """Stop watching the directory"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+    def wait(self, timeout):
+        """Wait until the directory changes or the timeout passes.
+        @param timeout: Maximum number of seconds to wait.
+        @return: True if the directory changed (always True when polling)."""
+        if self.fd is None:
+            time.sleep(timeout)
+            return True
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        # Discard the pending events
+        while select.select([self.fd], [], [], 0)[0]:
+            os.read(self.fd, 4096)
+        return True
+
+
+
+def heavy_task(task):
+    """Whether a task takes a lot of memory (a validation with at least
+    L{rc.queue_heavy_numnegs} negatives)"""
+    return task.operation == "validate" and \
+           (task.get("numnegs") or 0) >= rc.queue_heavy_numnegs
+
+
+def task_priority(task, users, now):
+    """Sort key for starting waiting tasks: tasks that have waited longer than
+    L{rc.queue_max_wait} go first (oldest first).  Otherwise we prefer
+    submitters with fewer running tasks, then retrievals over validations,
+    then validations with fewer negatives, then the oldest.
+    @param users: Mapping from submitter to number of running tasks.
+    @param now: Current time."""
+    if now - task.submitted > rc.queue_max_wait:
+        return (0, task.submitted)
+    if task.operation == "retrieval":
+        size = 0
+    else:
+        size = 1 + (task.get("numnegs") or 0)
+    return (1, users.get(task.get("submitter"), 0), size, task.submitted)
+
+
+def schedule(waiting, running, now=None):
+    """Choose the next task to start, if a worker is free.  At most 
+    L{rc.queue_workers} tasks run at once, of which at most
+    L{rc.queue_max_heavy} may be L{heavy_task}s.
+    @param waiting: Descriptors of tasks that have not started.
+    @param running: Descriptors of running tasks.
+    @param now: Current time (defaults to time.time()).
+    @return: The member of L{waiting} to start, or None."""
+    if len(running) >= rc.queue_workers:
+        return None
+    if now is None:
+        now = time.time()
+    users = {}
+    for task in running:
+        users[task.get("submitter")] = users.get(task.get("submitter"), 0) + 1
+    heavy = len([t for t in running if heavy_task(t)])
+    eligible = [t for t in waiting if heavy < rc.queue_max_heavy or not heavy_task(t)]
+    if not eligible:
+        return None
+    return min(eligible, key=lambda t: task_priority(t, users, now))
+
+    
+    
+
+class Histogram:
+    """Counts of values falling under each of a list of upper bounds
+
+    @ivar bounds: Increasing upper bounds of the bins (the last bin has no
+    upper bound).
+
+    @ivar counts: Number of values in each bin (one more than L{bounds}).
+
+    @ivar total: Sum of all the values.
+    """
+
+    def __init__(self, bounds=(1, 2, 5, 10, 30, 60, 120, 300, 600, 1800)):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds)+1)
+        self.total = 0.0
+
+
+    def add(self, value):
+        """Count a value"""
+        self.counts[nx.searchsorted(self.bounds, value)] += 1
+        self.total += value
+
+
+    def as_dict(self):
+        """Dictionary of the histogram, with the count and mean"""
+        count = sum(self.counts)
+        return dict(bounds=self.bounds, counts=self.counts, count=count,
+                    mean=self.total/count if count else None)
+
+
+
+class QueueMetrics:
+    """Statistics of the queue kept in memory by L{mainloop}, and written
+    to L{rc.queue_metrics} for the status page.
+
+    @ivar started: Time when the queue started.
+
+    @ivar heartbeat: Time of the last L{save}.
+
+    @ivar tasks: Number of completed tasks, by operation.
+
+    @ivar failed: Number of failed tasks, by operation.
+
+    @ivar wait: L{Histogram} of seconds from submission to the start of tasks.
+
+    @ivar latency: L{Histogram} of seconds taken by completed tasks, by
+    operation (failed tasks are left out, since they may stop early).
+
+    @ivar cache: Number of tasks whose saved results were reused ("hit")
+    or calculated ("miss").
+
+    @ivar scan_rate: Citations per second scanned by the ScoreCalculator
+    in the last query.
+
+    @ivar scan_rate_avg: Exponentially weighted average of L{scan_rate}.
+
+    @ivar updates: Number of Medline updates, with their last and total
+    duration in seconds and number of articles added.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.heartbeat = None
+        self.tasks = {}
+        self.failed = {}
+        self.wait = Histogram()
+        self.latency = {}
+        self.cache = dict(hit=0, miss=0)
+        self.scan_rate = None
+        self.scan_rate_avg = None
+        self.updates = dict(count=0, last_seconds=None, total_seconds=0.0, 
+                            articles=0)
+
+
+    def task_done(self, task, started, timings, failed=False):
+        """Record a finished task.
+        @param task: Descriptor of the task (see L{read_descriptor}).
+        @param started: Time when the task started.
+        @param timings: Dictionary of timings saved by the task (see
+        L{mscanner.core.timing.load_timings}), or None.
+        @param failed: True if the task raised an exception."""
+        op = task.operation
+        counter = self.failed if failed else self.tasks
+        counter[op] = counter.get(op, 0) + 1
+        self.wait.add(started - task.submitted)
+        if failed:
+            return
+        self.latency.setdefault(op, Histogram()).add(time.time() - started)
+        if timings is None:
+            return
+        totals = timings["totals"]
+        if "make_results" in totals or "cross_validate" in totals:
+            self.cache["miss"] += 1
+        elif "load_results" in totals:
+            self.cache["hit"] += 1
+        seconds = totals.get("make_results/ScoreCalculator")
+        if seconds:
+            self.scan_rate = timings["counters"].get("scored_docs", 0) / seconds
+            if self.scan_rate_avg is None:
+                self.scan_rate_avg = self.scan_rate
+            else:
+                self.scan_rate_avg = 0.8*self.scan_rate_avg + 0.2*self.scan_rate
+            if rc.queue_min_scan_rate and self.scan_rate < rc.queue_min_scan_rate:
+                logging.warning("Scanned only %.0f citations/second (minimum %.0f)",
+                                self.scan_rate, rc.queue_min_scan_rate)
+
+
+    def update_done(self, started, articles):
+        """Record a finished Medline update.
+        @param started: Time when the update started.
+        @param articles: Number of articles that were added."""
+        seconds = time.time() - started
+        self.updates["count"] += 1
+        self.updates["last_seconds"] = seconds
+        self.updates["total_seconds"] += seconds
+        self.updates["articles"] += articles
+
+
+    def as_dict(self):
+        """Dictionary of the metrics, as saved by L{save}"""
+        lookups = self.cache["hit"] + self.cache["miss"]
+        rss, child_rss = peak_rss()
+        return dict(
+            started = self.started,
+            heartbeat = self.heartbeat,
+            pid = os.getpid(),
+            rss_kb = rss,
+            tasks = self.tasks,
+            failed = self.failed,
+            wait = self.wait.as_dict(),
+            latency = dict((op, h.as_dict()) for op, h in self.latency.iteritems()),
+            cache = dict(self.cache, 
+                         hit_rate=self.cache["hit"]/lookups if lookups else None),
+            scan_rate = self.scan_rate,
+            scan_rate_avg = self.scan_rate_avg,
+            scan_rate_alert = bool(rc.queue_min_scan_rate and self.scan_rate 
+                                   and self.scan_rate < rc.queue_min_scan_rate),
+            updates = self.updates)
+
+
+    def save(self, filename=None):
+        """Write the metrics as JSON (replacing the file in one step)
+        @param filename: Defaults to L{rc.queue_metrics}."""
+        if filename is None:
+            filename = rc.queue_metrics
+        self.heartbeat = time.time()
+        tmpfile = filename + ".tmp"
+        with open(tmpfile, "w") as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+        tmpfile.rename(filename)
+
+
+
+def load_metrics(filename=None):
+    """Read the metrics saved by L{QueueMetrics.save}.
+    @param filename: Defaults to L{rc.queue_metrics}.
+    @return: Dictionary of metrics, or None if not available."""
+    if filename is None:
+        filename = rc.queue_metrics
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
 
 def delete_output(dataset):
-    """Delete the output directory for the given task"""
+    """Delete the output directory for the given task, and remove the task
+    from the L{TaskIndex}"""
     logging.debug("Attempting to delete output for %s" % dataset)
     dirpath = rc.web_report_dir / dataset
     for fname in dirpath.files():
         fname.remove()
     dirpath.rmdir()
+    index = TaskIndex()
+    try:
+        index.remove(dataset)
+    finally:
+        index.close()
+
+
+def timing_summary(newest=None):
+    """Aggregate the stage timings of completed tasks (see
+    L{mscanner.core.timing.aggregate}).
+    @param newest: If not None, only use this many of the newest outputs.
+    @return: List of (span name, summary dictionary), slowest total first."""
+    files = [d/rc.report_timings for d in rc.web_report_dir.dirs()
+             if (d/rc.report_timings).exists()]
+    files.sort(key=lambda f: f.mtime, reverse=True)
+    if newest is not None:
+        files = files[:int(newest)]
+    timings = []
+    for fname in files:
+        try:
+            timings.append(load_timings(fname))
+        except (IOError, ValueError):
+            logging.warning("Could not read timings from %s", fname)
+    summary = aggregate(timings).items()
+    summary.sort(key=lambda x: x[1]["total"], reverse=True)
+    return summary
+
+
+def print_timings(newest=None):
+    """Print L{timing_summary} as a table"""
+    print "%-40s %6s %9s %9s %9s %9s" % ("stage", "count", "mean", "median", "p95", "max")
+    for name, s in timing_summary(newest):
+        print "%-40s %6d %9.3f %9.3f %9.3f %9.3f" % (
+            name, s["count"], s["mean"], s["median"], s["p95"], s["max"])
+
+
+def run_task(task, updater, usewords):
+    """Perform a queued task in a worker process forked by L{mainloop}, and
+    move its descriptor to the output directory when it succeeds.
+    
+    The worker reconnects to the databases, but shares the PubMed IDs and
+    feature counts loaded by the queue, and the memory-mapped citation
+    snippets, with the queue and the other workers.  The database handles
+    inherited from the queue are kept in L{_inherited}, because closing
+    them in the worker would affect the queue's own handles.
+    
+    @param task: Descriptor of the task (see L{read_descriptor}).
+    @param updater: L{Updater} with the databases of the queue.
+    @param usewords: Whether the second feature space of the updater
+    (feats_wmqia) is available.
+    """
+    from mscanner.core.QueryManager import QueryManager
+    from mscanner.core.ValidationManager import CrossValidation
+    from mscanner.medline import Shelf
+    # The output directory for the task
+    outdir = rc.web_report_dir / task.dataset
+    logging.info("Starting %s for %s", task.operation, task.dataset)
+    _inherited.append(updater.artdb)
+    for fdata in updater.fdata_list:
+        _inherited.extend([fdata.featuredb.con, fdata.featmap.con])
+    try:
+        updater.artdb = Shelf.open(rc.articles_home/rc.articledb, 'r')
+        for fdata in updater.fdata_list:
+            fdata.reconnect()
+        # Configure feature space
+        if (not usewords) or (not task.allfeatures):
+            fdata = updater.fdata_list[0] # feats_mesh_qual_issn
+            rc.min_infogain = 0
+            rc.mincount = 2
+            rc.scoremethod = "scores_bgfreq"
+        else:
+            fdata = updater.fdata_list[1] # feats_wmqia
+            rc.min_infogain = 2e-5
+            rc.mincount = 0
+            rc.scoremethod = "scores_laplace_split"
+        # Retrieval operation
+        if task.operation == "retrieval":
+            QM = QueryManager(
+                outdir=outdir, 
+                dataset=task.dataset,
+                limit=task.limit,
+                artdb=updater.artdb,
+                snippets=updater.snippets,
+                fdata=fdata,
+                threshold=task.minscore,
+                prior=None,
+                mindate=task.mindate,
+                maxdate=None,
+                )
+            QM.query(task._filename)
+            QM.write_report(lazy=True)
+            QM.__del__()
+        # Cross validation operation
+        elif task.operation == "validate":
+            VM = CrossValidation(
+                outdir=outdir,
+                dataset=task.dataset,
+                fdata=fdata)                        
+            VM.validation(task._filename, task.numnegs)
+            VM.report_validation()
+            VM.__del__()
+        task._filename.move(outdir / "descriptor.txt")
+    except Exception, e:
+        logging.exception(e)
+        sys.exit(1)
+
+
+_inherited = []
+"""Database handles that a worker process inherited from the queue (see
+L{run_task}).  They are never closed in the worker: the reference here
+outlives the task, and the worker leaves through C{os._exit}, which skips
+finalizers."""
 
 
 def mainloop():
-    """Look for descriptor files every second"""
+    """Wait for descriptor files to appear (see L{QueueWatcher}), starting
+    tasks in a pool of up to L{rc.queue_workers} worker processes (see
+    L{schedule} and L{run_task}) and recording their status in the
+    L{TaskIndex}.  Medline updates wait for the running tasks to finish, and
+    no tasks start until the update is done."""
+    from multiprocessing import Process
+    from mscanner.medline.Updater import Updater
     usewords = True # Whether to include feats_wmqia capability
     featurespaces = ["feats_mesh_qual_issn"]
     if usewords: 
@@ -234,17 +845,34 @@ def mainloop():
     if usewords: 
         # Do not grow the word feature space
         updater.fdata_list[1].featmap.grow_features = False
+    metrics = QueueMetrics()
+    # Mapping from dataset to (process, task, start time) for running tasks
+    workers = {}
+    index = TaskIndex()
+    index.rebuild()
+    watcher = QueueWatcher(rc.queue_path)
     try:
         logging.debug("Queue is now running.")
+        metrics.save()
         # Time of last output clean
         last_clean = time.time()
         # Time of last database update
         last_update = 0 #time.time()
+        # Time of last full look at the queue directory
+        last_sync = time.time()
+        # Whether the queue directory may have changed
+        woke = False
         while True:
             
             # Touch the PID file
             rc.queue_pid.write_text(str(os.getpid()))
             
+            # Index tasks added to or removed from the queue directory
+            if woke or time.time() - last_sync > 60:
+                index.sync_queue()
+                last_sync = time.time()
+                woke = False
+            
             # Delete oldest outputs daily
             if time.time() - last_clean > 24*3600:  
                 logging.info("Looking for old datasets")
@@ -255,74 +883,91 @@ def mainloop():
                         delete_output(task.dataset)
                     except OSError:
                         pass # Failed to delete output
+                for name, s in timing_summary():
+                    logging.info("Timings of %s: %d tasks, mean %.2fs, p95 %.2fs",
+                                 name, s["count"], s["mean"], s["p95"])
                 last_clean = time.time()
             
-            # Update the databases twice daily
-            if time.time() - last_update > 24*3600:
+            # Collect finished tasks
+            changed = False
+            for dataset, (process, task, started) in workers.items():
+                if process.is_alive():
+                    continue
+                process.join()
+                del workers[dataset]
+                index.task_finished(dataset)
+                changed = True
+                if process.exitcode != 0:
+                    logging.error("Task %s failed with exit code %s", 
+                                  dataset, process.exitcode)
+                timings = None
+                timefile = rc.web_report_dir / dataset / rc.report_timings
+                if timefile.exists():
+                    try:
+                        timings = load_timings(timefile)
+                    except (IOError, ValueError):
+                        pass
+                metrics.task_done(task, started, timings, process.exitcode != 0)
+            
+            # Update the databases daily, once the running tasks finish
+            update_due = time.time() - last_update > 24*3600
+            if update_due and not workers:
                 logging.info("Looking for Medline updates")
+                started = time.time()
+                articles = updater.timings.counters.get("articles", 0)
                 updater.add_directory(rc.medline, save_delay=0)
                 updater.load_properties()
+                metrics.update_done(started, 
+                    updater.timings.counters.get("articles", 0) - articles)
+                metrics.save()
                 last_update = time.time()
+                update_due = False
             
-            # Perform any queued tasks
-            queue = QueueStatus()
-            task = queue.running
-            if task is not None:
-                # The output directory for the task
-                outdir = rc.web_report_dir / task.dataset
-                logging.info("Starting %s for %s", task.operation, task.dataset)
-                # Update task file mod time for the status display
-                task._filename.utime(None) 
-                try:
-                    # Configure feature space
-                    if (not usewords) or (not task.allfeatures):
-                        fdata = updater.fdata_list[0] # feats_mesh_qual_issn
-                        rc.min_infogain = 0
-                        rc.mincount = 2
-                        rc.scoremethod = "scores_bgfreq"
-                    else:
-                        fdata = updater.fdata_list[1] # feats_wmqia
-                        rc.min_infogain = 2e-5
-                        rc.mincount = 0
-                        rc.scoremethod = "scores_laplace_split"
-                    # Retrieval operation
-                    if task.operation == "retrieval":
-                        QM = QueryManager(
-                            outdir=outdir, 
-                            dataset=task.dataset,
-                            limit=task.limit,
-                            artdb=updater.artdb,
-                            fdata=fdata,
-                            threshold=task.minscore,
-                            prior=None,
-                            mindate=task.mindate,
-                            maxdate=None,
-                            )
-                        QM.query(task._filename)
-                        QM.write_report()
-                        QM.__del__()
-                    # Cross validation operation
-                    elif task.operation == "validate":
-                        VM = CrossValidation(
-                            outdir=outdir,
-                            dataset=task.dataset,
-                            fdata=fdata)                        
-                        VM.validation(task._filename, task.numnegs)
-                        VM.report_validation()
-                        VM.__del__()
-                    task._filename.move(outdir / "descriptor.txt")
-                except ValueError, e:
-                    logging.exception(e)
+            # Start queued tasks while there are free workers
+            if not update_due:
+                # Failed tasks are not retried until the queue restarts
+                waiting = [t for t in index.tasks(QueueStatus.WAITING) if
+                           t.dataset not in workers]
+                running = [task for p, task, s in workers.values()]
+                task = schedule(waiting, running)
+                while task is not None:
+                    # Update task file mod time for the status display
+                    try:
+                        task._filename.utime(None) 
+                    except OSError, e:
+                        # Cancelled since we listed the waiting tasks
+                        logging.info("Skipping task %s: %s", task.dataset, e)
+                        waiting.remove(task)
+                        task = schedule(waiting, running)
+                        continue
+                    process = Process(target=run_task, 
+                                      args=(task, updater, usewords))
+                    process.start()
+                    workers[task.dataset] = (process, task, time.time())
+                    index.set_status(task.dataset, QueueStatus.RUNNING, time.time())
+                    changed = True
+                    waiting.remove(task)
+                    running.append(task)
+                    task = schedule(waiting, running)
+            
+            if changed:
+                metrics.save()
             else:
-                # Nothing to do, so sleep before the next iteration
-                time.sleep(1)
+                # Nothing to do, so wait for the queue directory to change
+                woke = watcher.wait(1)
+                if time.time() - metrics.heartbeat > rc.queue_metrics_interval:
+                    metrics.save()
     finally:
+        for dataset, (process, task, started) in workers.items():
+            process.join()
+            index.task_finished(dataset)
+        watcher.close()
+        index.close()
         updater.close()
 
 
 def populate_test_queue():
     """Place some dummy queue files to test the queue operation"""
-    from mscanner.core.Storage import Storage
     pmids = list(iofuncs.read_pmids(rc.corpora / "Test" / "gdsmall.txt"))
     task = Storage(
         allfeatures = True,
@@ -335,14 +980,20 @@ def populate_test_queue():
         numnegs = 1000, 
         operation = "validate", 
         submitted = time.time())
-    write_descriptor(rc.queue_path/task.dataset, pmids, task)
+    submit_task(pmids, task)
     task.operation = "retrieval"
     task.dataset = "gd_wmqia_query"
     task.submitted += 5
-    write_descriptor(rc.queue_path/task.dataset, pmids, task)
+    submit_task(pmids, task)
 
 
 if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "timings":
+        print_timings(*sys.argv[2:])
+        sys.exit()
+    if len(sys.argv) == 2 and sys.argv[1] == "metrics":
+        print json.dumps(load_metrics(), indent=1, sort_keys=True)
+        sys.exit()
     if rc.queue_pid.exists() and rc.queue_pid.mtime >= time.time()-3600:
         sys.exit()
     iofuncs.start_logger(logfile=True)
@@ -2,4 +2,5 @@ import contact, contact_logic
 import front
 import query, query_logic
 import output, output_logic
-import status, status_logic
\ No newline at end of file
+import status, status_logic
+import report_logic
\ No newline at end of file
@@ -7,7 +7,7 @@ __license__ = "GPL"
 import web
 import md5
 
-import output, query_logic
+import output, query_logic, report_logic
 from mscanner.htdocs import forms, queue
 from mscanner.configuration import rc
 
@@ -76,7 +76,7 @@ class OutputPage:
                 page.delete_error = "there is no task with that name."
             elif q.status[target] == q.RUNNING:
                 page.delete_error = "MScanner is busy with the task."
-            elif q.status[target] in [q.WAITING, q.DONE]:
+            elif q.status[target] in [q.WAITING, q.FAILED, q.DONE]:
                 md5code = md5.new(oform.d.delcode).hexdigest()
                 if "delcode" in q[target] and md5code != q[target].delcode:
                     page.delete_error = "incorrect deletion code."
@@ -86,9 +86,9 @@ class OutputPage:
                             queue.delete_output(target)
                         except OSError, e:
                             page.delete_error = str(e)
-                    elif q.status[target] == q.WAITING:
+                    else:
                         try:
-                            q[target]._filename.remove()
+                            queue.cancel_task(target)
                         except OSError, e:
                             page.delete_error = str(e)
             self.print_page(page)
@@ -104,7 +104,12 @@ class OutputPage:
                 outfile = outdir / (page.target + ".zip")
                 if not outfile.exists():
                     from zipfile import ZipFile, ZIP_DEFLATED
-                    zf = ZipFile(str(outfile), "w", ZIP_DEFLATED)
+                    # Render the result pages of lazy reports not yet viewed
+                    for fname, pageno in report_logic.lazy_files(outdir).iteritems():
+                        if pageno >= 0 and not (outdir/fname).exists():
+                            report_logic.render_file(outdir, fname, pageno)
+                    tmpfile = outdir / ("." + outfile.basename())
+                    zf = ZipFile(str(tmpfile), "w", ZIP_DEFLATED)
                     for fpath in outdir.files():
                         # Omit existing zip files
                         if fpath.endswith(".zip"):
@@ -118,7 +123,8 @@ class OutputPage:
                             continue
                         zf.write(str(fpath), str(fpath.basename()))
                     zf.close()
-                    outfile.chmod(0777)
+                    tmpfile.chmod(0777)
+                    tmpfile.rename(outfile)
                 ds = web.urlquote(page.target)
                 web.seeother(rc.web_root + "static/output/" + ds + "/" + ds + ".zip")
             
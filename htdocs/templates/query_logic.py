@@ -168,6 +168,7 @@ class QueryPage:
             # Add a descriptor to the queue
             inputs = qform.d
             inputs.submitted = time.time()
+            inputs.submitter = web.ctx.ip
             inputs.hidden = forms.ischecked(inputs.hidden)
             inputs.allfeatures = forms.ischecked(inputs.allfeatures)
             # MD5 hash the deletion code
@@ -175,10 +176,7 @@ class QueryPage:
             inputs.delcode = md5.new(delcode_plain).hexdigest()
             # Parse the date string to integer
             inputs.mindate = parse_date(inputs.mindate)
-            queue.write_descriptor(rc.queue_path / inputs.dataset, 
-                                   parse_pmids(inputs.positives), inputs)
-            # Sleep to make sure the file is done writing
-            time.sleep(0.2)
+            queue.submit_task(parse_pmids(inputs.positives), inputs)
             # Show status page for the task
             web.seeother("status?dataset=%s;delcode=%s" % 
                          (inputs.dataset, web.urlquote(delcode_plain)))
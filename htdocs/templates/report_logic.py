@@ -0,0 +1,222 @@
+"""web.py handler for viewing task outputs, rendering citation pages on demand"""
+
+                                     
+__author__ = "Graham Poulter"                                        
+__license__ = "GPL"
+
+import web
+import logging
+from path import path
+import tempfile
+import time
+
+import query_logic
+from mscanner.htdocs import queue
+from mscanner.configuration import rc
+from mscanner.core import CitationTable, iofuncs
+
+
+content_types = {
+    ".html": "text/html; charset=utf-8",
+    ".csv": "text/plain; charset=utf-8",
+    ".txt": "text/plain",
+    ".png": "image/png",
+    ".zip": "application/zip",
+}
+"""Content types for the files in an output directory"""
+
+
+
+def lazy_files(outdir):
+    """List the files of an output directory that can be rendered on demand
+    
+    These are the result citation pages after the first, and the all-in-one
+    result file and zip. Only outputs with a L{rc.report_result_records}
+    file support rendering on demand.
+    
+    @return: Dictionary from file name to index of the citation page, where
+    -1 denotes the all-in-one file or zip.
+    """
+    records = outdir/rc.report_result_records
+    if not records.exists():
+        return {}
+    nresults = records.size // iofuncs.score_dtype.itemsize
+    files = CitationTable.page_files(outdir/rc.report_result_citations, 
+                                     nresults, rc.citations_per_file)
+    result = dict((fname, idx) for idx, (fname, s, e) in enumerate(files))
+    del result[rc.report_result_citations]
+    if nresults > 0:
+        result[rc.report_result_all] = -1
+        result[rc.report_result_all_zip] = -1
+    return result
+
+
+
+def render_file(outdir, fname, pageno):
+    """Render a citation page of a lazily written report
+    
+    @param outdir: Output directory of the task
+    
+    @param fname: Name of file to render, from L{lazy_files}
+
+    @param pageno: Index of the page, or -1 for the all-in-one file and zip.
+    
+    @note: The files are rendered in a hidden temporary directory and renamed
+    into place when complete, so other requests never serve a partly written
+    file, and nothing is left behind if rendering fails.
+    
+    @return: List of paths to the files that were written.
+    """
+    from mscanner.medline.CitationSnippets import CitationSnippets
+    logging.debug("Rendering %s for %s on demand", fname, outdir.basename())
+    results = iofuncs.read_score_records(outdir/rc.report_result_records)
+    dataset = queue.read_descriptor(outdir/rc.report_descriptor).dataset
+    base = outdir/rc.report_result_citations
+    if pageno < 0:
+        start, end = 0, len(results)
+    else:
+        fname, start, end = CitationTable.page_files(
+            base, len(results), rc.citations_per_file)[pageno]
+    snippets = CitationSnippets(rc.articles_home/rc.snippet_index, 
+                                rc.articles_home/rc.snippet_blob)
+    pmids = [str(p) for p in results["pmid"][start:end]]
+    try:
+        articles = snippets.get_many(pmids)
+    finally:
+        snippets.close()
+    missing = [p for p in pmids if p not in articles]
+    if missing:
+        # Snippets may lag behind the article database
+        from mscanner.medline import Shelf
+        artdb = Shelf.open(rc.articles_home/rc.articledb, "r")
+        try:
+            articles.update(artdb.get_many(missing))
+        finally:
+            artdb.close()
+    # Citations outside the page are not accessed by write_citations
+    citations = [(float(s),articles.get(str(p))) for s,p in results]
+    tmpdir = path(tempfile.mkdtemp(prefix=".render-", dir=outdir))
+    try:
+        tmpbase = tmpdir/rc.report_result_citations
+        if pageno < 0:
+            names = [rc.report_result_all, rc.report_result_all + ".zip"]
+            CitationTable.write_citations(
+                "output", dataset, citations, tmpbase, rc.citations_per_file, 
+                tmpdir/rc.report_result_all, pages=[])
+        else:
+            names = [fname]
+            CitationTable.write_citations(
+                "output", dataset, citations, tmpbase, rc.citations_per_file, 
+                pages=[pageno])
+        for name in names:
+            (tmpdir/name).rename(outdir/name)
+    finally:
+        tmpdir.rmtree(ignore_errors=True)
+    return [outdir/name for name in names]
+
+
+
+def rendered_files():
+    """Find the files rendered on demand in every output directory
+    @return: Dictionary from path to size of each file."""
+    rendered = {}
+    for outdir in rc.web_report_dir.dirs():
+        for fname in lazy_files(outdir):
+            fpath = outdir/fname
+            if fpath.exists():
+                rendered[fpath] = fpath.size
+    return rendered
+
+
+_rendered = None
+"""Dictionary from path to size of the files rendered on demand, as found by
+L{rendered_files} and updated by L{evict_files}"""
+
+_rendered_total = 0
+"""Total size of the files in L{_rendered}"""
+
+_rendered_scanned = 0
+"""Time when L{_rendered} was last found by scanning the output directories"""
+
+
+def evict_files(written, budget, rescan=3600):
+    """Delete least recently served files rendered on demand, until their
+    total size is within the budget.
+    
+    The sizes of the rendered files are kept in memory with a running total,
+    and the output directories are only scanned again after L{rescan}
+    seconds (to pick up files rendered by other processes, and outputs that
+    were deleted).
+    
+    @param written: Paths to the files just written by L{render_file}, which
+    are added to the total, and are not deleted.
+    
+    @param budget: Number of bytes of rendered files to keep.
+    
+    @param rescan: Seconds between scans of the output directories.
+    """
+    global _rendered, _rendered_total, _rendered_scanned
+    if _rendered is None or time.time() - _rendered_scanned > rescan:
+        _rendered = rendered_files()
+        _rendered_total = sum(_rendered.itervalues())
+        _rendered_scanned = time.time()
+    for fpath in written:
+        if fpath.exists():
+            _rendered_total += fpath.size - _rendered.get(fpath, 0)
+            _rendered[fpath] = fpath.size
+    if _rendered_total <= budget:
+        return
+    # Least recently served first (serving a file updates its mtime)
+    candidates = []
+    for fpath, size in _rendered.items():
+        if fpath in written:
+            continue
+        try:
+            candidates.append((fpath.mtime, size, fpath))
+        except OSError:
+            # Deleted by other means
+            del _rendered[fpath]
+            _rendered_total -= size
+    candidates.sort()
+    for mtime, size, fpath in candidates:
+        if _rendered_total <= budget:
+            break
+        try:
+            fpath.remove()
+        except OSError:
+            pass # Maybe deleted by another request
+        del _rendered[fpath]
+        _rendered_total -= size
+
+
+
+class ReportPage:
+    """Serves files from task output directories, rendering result citation
+    pages when they are first requested.
+    
+    Files are rendered into the output directory, and their modification times
+    are updated on each request, so they are evicted in least recently used
+    order when their total size exceeds L{rc.web_page_cache}.
+    """
+
+    def GET(self, dataset, fname):
+        """Print a file from the output directory of the task"""
+        if not query_logic.dataset_validator.valid(dataset):
+            return web.notfound()
+        outdir = rc.web_report_dir / dataset
+        if fname == "":
+            fname = rc.report_index
+        if "/" in fname or fname.startswith(".") or not outdir.isdir():
+            return web.notfound()
+        fpath = outdir / fname
+        lazy = lazy_files(outdir)
+        if fname in lazy:
+            if not fpath.exists():
+                written = render_file(outdir, fname, lazy[fname])
+                evict_files(written, rc.web_page_cache)
+            fpath.utime(None)
+        if not fpath.isfile():
+            return web.notfound()
+        web.header("Content-Type", 
+            content_types.get(fpath.ext, "application/octet-stream"))
+        print fpath.bytes(),
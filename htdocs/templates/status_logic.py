@@ -47,6 +47,7 @@ class StatusPage:
         page.queue = queue.QueueStatus()
         if (rc.articles_home/rc.logfile).exists():
             page.log_lines = (rc.articles_home/rc.logfile).lines()[-30:]
+        page.metrics = queue.load_metrics()
         page.inputs = StatusForm()
         dataset = "" # The task to print the status for
         if page.queue.running is not None:
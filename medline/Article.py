@@ -17,14 +17,80 @@ this program. If not, see <http://www.gnu.org/licenses/>."""
 import logging
 import re
 
-# List of words to ignore in free text
-stopwords = []
+# Set of words to ignore in free text
+stopwords = frozenset()
 
 def init_stopwords(filename):
-    """Initialise the L{stopwords} module variable."""
-    global stopwords
+    """Initialise the L{stopwords} and L{tokenizer} module variables."""
+    global stopwords, tokenizer
     if filename is not None:
-        stopwords = filename.lines(retain=False)
+        stopwords = frozenset(filename.lines(retain=False))
+        tokenizer = Tokenizer(stopwords)
+
+
+
+class Tokenizer:
+    """Splits free text into word features, with the regular expressions
+    compiled once and stopwords kept in a set.
+    
+    @ivar stopwords: Set of (lower case) words to leave out.
+    """
+    
+    r_split = re.compile(r"\s|\'s|--|[!/<>=#$^\"{};:&]")
+    """Separators of words for L{words}"""
+    
+    r_word = re.compile(r"^\W*(.*?)\W*$", re.UNICODE)
+    """Strips non-word characters before and after a word"""
+    
+    r_number = re.compile(r'^[0-9eE\W]+$')
+    """Detects numbers"""
+    
+    r_nonword = re.compile(r"\W+", re.UNICODE)
+    """Separators of words for L{split_words}"""
+
+    def __init__(self, stopwords=()):
+        self.stopwords = frozenset(stopwords)
+
+
+    def words(self, text, numbers=False, lowcase=False):
+        """Get the set of words in some text (see L{Article.feats_word}).
+        @param numbers: If True, keep words that look like numbers.
+        @param lowcase: If True, lower-case the text. Otherwise title-case
+        all words as at the start of a sentence."""
+        if lowcase: text = text.lower()
+        stopwords = self.stopwords
+        r_word, r_number = self.r_word, self.r_number
+        wordset = set()
+        for word in self.r_split.split(text):
+            # Words that start and end alphanumeric have nothing to strip
+            if not (word[:1].isalnum() and word[-1:].isalnum()):
+                word = r_word.match(word).group(1)
+            if len(word) > 1 and\
+               (word.lower() not in stopwords) and\
+               (numbers or not r_number.match(word)):
+                if not lowcase: word = word[0].upper() + word[1:]
+                wordset.add(word)
+        return wordset
+
+
+    def split_words(self, text):
+        """Get the set of lower-cased words in some text, splitting on all 
+        non-word characters (see L{Article.feats_word_strip})."""
+        stopwords = self.stopwords
+        return set(x for x in self.r_nonword.split(text.lower()) 
+                   if len(x) > 1 and x not in stopwords)
+
+
+    def tokenize_many(self, articles, numbers=False, lowcase=False):
+        """Get word features of many articles.
+        @param articles: Iterable of L{Article} objects.
+        @return: List of L{Article.feats_word} feature dictionaries."""
+        words = self.words
+        return [{"w":list(words(art.text(), numbers, lowcase))} for art in articles]
+
+
+tokenizer = Tokenizer()
+"""Default L{Tokenizer} using L{stopwords}"""
 
 
 class Article:
@@ -143,30 +209,20 @@ class Article:
         return dict(mesh=headings, qual=quals, issn=issns)
 
 
+    def text(self):
+        """Title and abstract joined by a space (as available)"""
+        text = ""
+        if self.title is not None: text = self.title + " "
+        if self.abstract is not None: text += self.abstract
+        return text
+
+
     def feats_word(self, numbers=False, lowcase=False):
         """Alphanumeric case-folded features derived from title and abstract/
         
         @return: Dictionary with the key 'word', and value being a list
         of word feature strings."""
-        text = ""
-        if self.title is not None: text = self.title + " "
-        if self.abstract is not None: text += self.abstract
-        if lowcase: text = text.lower()
-        # Strip non-word characters before and after a word
-        r_word = re.compile(r"^\W*(.*?)\W*$", re.UNICODE)
-        # Detect numbers
-        r_number = re.compile(r'^[0-9eE\W]+$')
-        # Split on space characters
-        wordset = set()
-        for word in re.compile(r"\s|\'s|--|[!/<>=#$^\"{};:&]").split(text):
-            word = r_word.match(word).group(1)
-            if len(word) > 1 and\
-               (word.lower() not in stopwords) and\
-               (numbers or not r_number.match(word)):
-                # Title-case all words as at start of sentence
-                if not lowcase: word = word[0].upper() + word[1:]
-                wordset.add(word)
-        return {"w":list(wordset)}
+        return {"w":list(tokenizer.words(self.text(), numbers, lowcase))}
 
 
     def feats_word_fold(self):
@@ -182,13 +238,7 @@ class Article:
     def feats_word_strip(self):
         """Word features using splitting on all non-word characters 
         (instead of keeping non-word characters that are inside words)."""
-        text = ""
-        if self.title is not None: text = self.title.lower() + " "
-        if self.abstract is not None: text += self.abstract.lower()
-        r_word = re.compile(r"\W+", re.UNICODE)
-        wordset = set(x for x in r_word.split(text) 
-                      if len(x) > 1 and x not in stopwords)
-        return {"w":list(wordset)}
+        return {"w":list(tokenizer.split_words(self.text()))}
 
 
     def feats_author(self):
@@ -197,20 +247,24 @@ class Article:
         return {"a": [(F+" "+L).lower() for F,L in self.authors if F and L]}
 
 
-    def feats_wmqia(self):
+    def feats_wmqia(self, cache=None):
         """Union of the L{feats_mesh_qual_issn}, L{feats_word} and
         L{feats_author} spaces. 
+        @param cache: L{FeatureCache} for getting the component spaces.
         @return: Feature dictionary with w,mesh,qual,issn,au keys."""
-        features = self.feats_mesh_qual_issn()
-        features.update(self.feats_word())
-        features.update(self.feats_author())
+        cache = cache or FeatureCache(self)
+        features = dict(cache("feats_mesh_qual_issn"))
+        features.update(cache("feats_word"))
+        features.update(cache("feats_author"))
         return features
     
     
-    def feats_wmqia_filt(self):
+    def feats_wmqia_filt(self, cache=None):
         """Like L{feats_wmqia}, but remove word features that occur in MeSH
-        features."""
-        ft = self.feats_wmqia()
+        features.
+        @param cache: L{FeatureCache} for getting the component spaces."""
+        cache = cache or FeatureCache(self)
+        ft = dict(cache("feats_wmqia"))
         meshlowtext = (" ".join(ft["mesh"] + ft["qual"])).lower()
         meshwords = set(re.compile(r'\W+', re.UNICODE).split(meshlowtext))
         ft["w"] = [x for x in ft["w"] if x.lower() not in meshwords]
@@ -240,4 +294,45 @@ class Article:
 
     def feats_iedb_word(self):
         """LIke {feats_iedb_concat}, but only with title/abstract features"""
-        return self.feats_iedb_concat(justword=True)
\ No newline at end of file
+        return self.feats_iedb_concat(justword=True)
+
+
+
+class FeatureCache:
+    """Computes the features of one article for several feature spaces,
+    so that feature spaces built from others (like L{Article.feats_wmqia})
+    share the component feature dictionaries instead of recomputing them.
+    
+    Usage::
+        cache = FeatureCache(article)
+        mqi = cache("feats_mesh_qual_issn")
+        wmqia = cache("feats_wmqia") # Re-uses mqi
+    
+    @note: The returned dictionaries are shared, so must not be modified.
+
+    @ivar article: The L{Article} to get features of.
+    
+    @ivar features: Dictionary of feature dictionaries computed so far,
+    keyed by name of the L{Article} method.
+    """
+    
+    composite = set(["feats_wmqia", "feats_wmqia_filt"])
+    """Feature spaces whose methods take the cache as a parameter."""
+    
+    def __init__(self, article):
+        self.article = article
+        self.features = {}
+        
+    def __call__(self, featurespace):
+        """Get the feature dictionary of the article for a feature space
+        @param featurespace: Name of a method of L{Article}."""
+        try:
+            return self.features[featurespace]
+        except KeyError:
+            method = getattr(self.article, featurespace)
+            if featurespace in self.composite:
+                result = method(self)
+            else:
+                result = method()
+            self.features[featurespace] = result
+            return result
@@ -0,0 +1,199 @@
+"""Compact store of the article fields needed to print citation tables"""
+
+from __future__ import with_statement
+import mmap
+import numpy as nx
+
+from mscanner import delattrs
+from mscanner.medline.Article import Article
+from mscanner.medline.FeatureStream import DateAsInteger, DateFromInteger
+
+
+                                     
+__author__ = "Graham Poulter"                                        
+__license__ = """This program is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your option)
+any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>."""
+
+
+class CitationSnippets:
+    """Stores just the fields of each article that are printed in citation
+    tables (title, abstract, journal, ISSN, authors and completion date), so
+    that reports do not have to unpickle whole L{Article} objects.
+
+    The index file is an array of L{index_dtype} records, one per article in
+    order of addition, which is memory-mapped when reading. Each record points
+    to a UTF-8 string in the blob file, holding the text fields separated by
+    NUL characters. If an article is added twice, the later record wins.
+
+    @ivar indexfile: Path to the array of index records.
+
+    @ivar blobfile: Path to the file of concatenated text fields.
+
+    @ivar rdonly: If True, do not allow adding articles.
+
+    @ivar blob: File object underlying the blob file.
+    """
+
+    index_dtype = nx.dtype([("pmid", nx.uint32), ("date", nx.uint32),
+                            ("offset", nx.uint64), ("length", nx.uint32)])
+    """Numpy record type for each entry of the index file."""
+
+
+    def __init__(self, indexfile, blobfile, rdonly=True):
+        """Initialise the store, creating empty files if necessary."""
+        self.indexfile = indexfile
+        self.blobfile = blobfile
+        self.rdonly = rdonly
+        for fname in indexfile, blobfile:
+            if not fname.exists():
+                fname.touch()
+        self.blob = open(blobfile, "rb" if rdonly else "rb+")
+        # Go to end of file for appending
+        self.blob.seek(0,2)
+
+
+    def close(self):
+        """Close the underlying files"""
+        delattrs(self, "_index", "_sorted", "_order", "_blobmap")
+        if not self.blob.closed:
+            self.blob.close()
+
+
+    def __len__(self):
+        """Number of distinct articles in the store"""
+        return len(nx.unique(self.index["pmid"]))
+
+
+    @property
+    def index(self):
+        """Memory-mapped array of index records"""
+        try:
+            return self._index
+        except AttributeError:
+            if self.indexfile.size == 0:
+                self._index = nx.zeros(0, self.index_dtype)
+            else:
+                self._index = nx.memmap(
+                    self.indexfile, dtype=self.index_dtype, mode="r")
+            return self._index
+
+
+    def _lookup(self):
+        """Return PubMed IDs in increasing order, and the position of the
+        corresponding record in L{index} (stable, so the latest copy of a
+        re-added article comes last)."""
+        try:
+            return self._sorted, self._order
+        except AttributeError:
+            pmids = self.index["pmid"]
+            self._order = nx.argsort(pmids, kind="mergesort")
+            self._sorted = pmids[self._order]
+            return self._sorted, self._order
+
+
+    def _blob(self):
+        """Memory map of the blob file"""
+        try:
+            return self._blobmap
+        except AttributeError:
+            if self.blobfile.size == 0:
+                self._blobmap = ""
+            else:
+                self._blobmap = mmap.mmap(
+                    self.blob.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._blobmap
+
+
+    def add_articles(self, articles):
+        """Append citation snippets for an iterable of L{Article} objects"""
+        if self.rdonly:
+            raise NotImplementedError("Attempt to write to read-only snippets.")
+        self.blob.seek(0,2)
+        offset = self.blob.tell()
+        records = []
+        for art in articles:
+            text = self.encode(art)
+            self.blob.write(text)
+            records.append((art.pmid, DateAsInteger(art.date_completed),
+                            offset, len(text)))
+            offset += len(text)
+        self.blob.flush()
+        with open(self.indexfile, "ab") as f:
+            nx.array(records, self.index_dtype).tofile(f)
+        delattrs(self, "_index", "_sorted", "_order", "_blobmap")
+
+
+    @staticmethod
+    def encode(art):
+        """Return the UTF-8 string of text fields for an L{Article}"""
+        def text(x):
+            if x is None: return u""
+            return x if isinstance(x, unicode) else x.decode("utf-8")
+        authors = u"\x01".join(text(initials) + u"\x02" + text(lastname)
+                               for initials, lastname in art.authors)
+        return u"\x00".join([text(art.title), text(art.abstract),
+            text(art.journal), text(art.issn), authors]).encode("utf-8")
+
+
+    @staticmethod
+    def decode(pmid, date, data):
+        """Return an L{Article} with the citation fields filled in from
+        the string produced by L{encode}."""
+        title, abstract, journal, issn, authors = \
+             data.decode("utf-8").split(u"\x00")
+        return Article(
+            pmid = pmid,
+            title = title or None,
+            abstract = abstract or None,
+            journal = journal or None,
+            issn = issn or None,
+            date_completed = DateFromInteger(date),
+            authors = [tuple(x or None for x in a.split(u"\x02"))
+                       for a in authors.split(u"\x01") if a])
+
+
+    def get_many(self, keys):
+        """Retrieve citation snippets for many articles at once, reading the
+        blob file in storage order.
+
+        @param keys: Iterable over PubMed IDs (as integers or strings).
+
+        @return: Dictionary from str(PubMed ID) to L{Article} objects having
+        only the citation fields. Missing PubMed IDs are left out."""
+        pmids = nx.unique(nx.array([int(k) for k in keys], nx.uint32))
+        spmids, order = self._lookup()
+        if len(pmids) == 0 or len(spmids) == 0:
+            return {}
+        # Position of the latest record for each PubMed ID
+        pos = nx.searchsorted(spmids, pmids, side="right") - 1
+        found = (pos >= 0) & (spmids[nx.maximum(pos, 0)] == pmids)
+        records = self.index[order[pos[found]]]
+        records = records[nx.argsort(records["offset"])]
+        blob = self._blob()
+        result = {}
+        for pmid, date, offset, length in records:
+            offset = int(offset)
+            result[str(pmid)] = self.decode(
+                int(pmid), int(date), blob[offset:offset+int(length)])
+        return result
+
+
+    def __getitem__(self, key):
+        """Retrieve citation snippet for a single PubMed ID"""
+        try:
+            return self.get_many([key])[str(key)]
+        except KeyError:
+            raise KeyError("Key %s not in snippets" % repr(key))
+
+
+    def __contains__(self, key):
+        return str(key) in self.get_many([key])
@@ -4,16 +4,22 @@ to all three representations at the same time."""
 
 from __future__ import with_statement
 from __future__ import division
-from contextlib import closing
+from contextlib import closing, contextmanager
+from itertools import islice, izip
 import logging
 import numpy as nx
+import os
+from path import path
 import sys
 
 from mscanner.configuration import rc
+from mscanner.core.timing import Timings
+from mscanner.medline.Article import FeatureCache
 #from mscanner.medline.FeatureMapping import MemoryFeatureMapping as FeatureMapping
-from mscanner.medline.FeatureMapping import FeatureMapping
+from mscanner.medline.FeatureMapping import FeatureMapping, HashedFeatureMapping
 from mscanner.medline.FeatureVectors import FeatureVectors
-from mscanner.medline.FeatureStream import FeatureStream, DateAsInteger, vb_encode
+from mscanner.medline.FeatureStream import FeatureStream, DateAsInteger, \
+     vb_encode, vb_encode_many, vb_decode_many
 from mscanner import endpath
 
 
@@ -48,9 +54,25 @@ class FeatureData:
     the feature databases are to be kep.
     
     @ivar rdonly: If True, treat all databases as read-only.
+
+    @ivar hash_bits: If not None, use a L{HashedFeatureMapping} with this
+    many bits instead of a L{FeatureMapping}.
+
+    @ivar timings: L{Timings} of adding articles and rebuilding the index
+    (the L{Updater} shares its own with each L{FeatureData}).
+
+    @ivar manifest: Path to the list of new files to rename over the old
+    ones after a L{vacuum} or L{reorder}.  If it exists when opening, the
+    renaming was interrupted: writers complete it before opening the
+    databases, and readers open the new files where they have not been
+    renamed yet.
+
+    @ivar lockfile: Path to the lock held by writers while renaming the
+    files in the L{manifest}, and by readers while opening the databases.
     """
     
-    def __init__(self, featmap, featdb, fstream, featurespace, rdonly=True):
+    def __init__(self, featmap, featdb, fstream, featurespace, rdonly=True, 
+                 hash_bits=None):
         """Constructor.
         @param featmap: Path to FeatureMapping.
         @param featdb: Path to FeatureVectors.
@@ -58,10 +80,27 @@ class FeatureData:
         """
         logging.debug("Loading features from %s", endpath(featmap.dirname()))
         self.rdonly = rdonly
-        self.featmap = FeatureMapping(featmap)
-        self.featuredb = FeatureVectors(featdb)
-        self.fstream = FeatureStream(fstream, rdonly)
+        self.hash_bits = hash_bits
+        self.timings = Timings()
+        self.manifest = featmap + ".manifest"
+        self.lockfile = featmap + ".lock"
+        with self._replace_lock(exclusive=not rdonly):
+            renamed = {}
+            if self.manifest.exists():
+                if rdonly:
+                    renamed = self._unfinished_replace()
+                else:
+                    self._finish_replace()
+            self.featmap = self._open_featmap(renamed.get(featmap, featmap))
+            self.featuredb = FeatureVectors(renamed.get(featdb, featdb))
+            self.fstream = FeatureStream(renamed.get(fstream, fstream), rdonly)
         self.featurespace = featurespace
+        if hash_bits is not None and not rdonly:
+            try:
+                self.featmap.counts
+            except ValueError, e:
+                logging.warning("%s: counting the feature vectors again.", e)
+                self.recount()
 
 
     @staticmethod 
@@ -72,7 +111,16 @@ class FeatureData:
         base = rc.articles_home / featurespace
         if not base.exists(): base.makedirs()
         return FeatureData(base/rc.featuremap, base/rc.featuredb, 
-                           base/rc.featurestream, featurespace, rdonly)
+                           base/rc.featurestream, featurespace, rdonly,
+                           rc.feature_hash_bits.get(featurespace))
+
+
+    def _open_featmap(self, featmap):
+        """Open the feature mapping at the given path, which is hashed
+        if L{hash_bits} is set."""
+        if self.hash_bits is None:
+            return FeatureMapping(featmap)
+        return HashedFeatureMapping(featmap, self.hash_bits)
 
 
     def close(self):
@@ -82,39 +130,66 @@ class FeatureData:
         self.featmap.close()
 
 
-    def add_articles(self, articles, check=True):
+    def reconnect(self):
+        """Reconnect to the databases after forking a process to read them,
+        keeping the cached PubMed IDs and feature counts (which stay shared
+        with the parent process until either one modifies them)."""
+        self.featuredb.reconnect()
+        self.featmap.reconnect()
+
+
+    def add_articles(self, articles, check=True, caches=None):
         """Incrementally add new articles to the existing feature 
         database, stream and feature map.  
         @param articles: Iterator over Article objects.
         @param check: If True, check for already-added articles to avoid 
         inconsistent overwrites (but slow and unnecessary if regenerating).
+        @param caches: Optional list of L{FeatureCache} corresponding to
+        L{articles}, shared with other L{FeatureData} so that common feature
+        groups are extracted once per article.
         """
         if self.rdonly:
             raise NotImplementedError("Attempt to write to read-only index.")
         logging.debug("Adding articles to %s", endpath(self.featmap.filename.dirname()))
-        for article in counter(articles):
-            pmid = article.pmid
-            if check and (pmid in self.featuredb): continue
-            date = DateAsInteger(article.date_completed)
-            features = getattr(article, self.featurespace)()
-            self.featmap.add_article(features)
-            featvec = vb_encode(self.featmap.make_vector(features))
-            self.featuredb.add_record(pmid, date, featvec)
-            self.fstream.additem(pmid, date, featvec)
-        self.featuredb.commit()
-        self.fstream.flush()
-        self.featmap.commit()
+        if caches is None:
+            pairs = ((article, FeatureCache(article)) for article in articles)
+        else:
+            pairs = izip(articles, caches)
+        with self.timings.span(self.featurespace + ".add_articles"):
+            added = 0
+            for article, cache in counter(pairs):
+                pmid = article.pmid
+                if check and (pmid in self.featuredb): continue
+                date = DateAsInteger(article.date_completed)
+                features = cache(self.featurespace)
+                featvec = vb_encode(self.featmap.add_article(features))
+                self.featuredb.add_record(pmid, date, featvec)
+                self.fstream.additem(pmid, date, featvec)
+                added += 1
+            with self.timings.span("commit"):
+                self.featuredb.commit()
+                self.fstream.flush()
+                self.featmap.commit()
+        self.timings.count(self.featurespace + ".articles", added)
 
 
-    def regenerate(self, artdb):
+    def regenerate(self, artdb, nprocs=None):
         """Regenerate feature map, feature stream and feature database, but
-        only if they have been deleted. FeatureMapping is flushed to disk only
-        at the end.
+        only if they have been deleted. 
+        
+        When regenerating the feature map, features are extracted by a pool
+        of L{nprocs} processes, and feature IDs are assigned and counted in
+        memory, after which the feature map is bulk-loaded.  The feature
+        stream is written as we go, and the feature database is bulk-loaded
+        from the stream at the end (in order of PubMed ID).
         
-        @param artdb: Dictionary of Article objects keyed by PubMed ID."""
+        @param artdb: Dictionary of Article objects keyed by PubMed ID.
+        
+        @param nprocs: Number of processes for feature extraction (defaults
+        to rc.nprocs)."""
         if self.rdonly:
             raise NotImplementedError("Failed: may not write read-only index.")
-        do_featmap = len(self.featmap) == 1
+        do_featmap = self.featmap.empty
         do_stream = self.fstream.filename.size == 0
         do_featuredb = len(self.featuredb) == 0
         if not (do_featmap or do_stream or do_featuredb):
@@ -125,7 +200,10 @@ class FeatureData:
             logging.info("Regenerating map,db,stream %s.", endpath(self.featmap.filename.dirname()))
             if not (do_stream and do_featuredb):
                 raise ValueError("Cannot regenerate feature map without doing stream/database as well.")
-            self.add_articles(artdb.itervalues(), check=False)
+            with self.timings.span(self.featurespace + ".regenerate_stream"):
+                self._regenerate_stream(artdb, rc.nprocs if nprocs is None else nprocs)
+            with self.timings.span(self.featurespace + ".load_featuredb"):
+                self._load_featuredb()
         # Regenerate FeatureStream from FeatureVectors
         elif do_stream: 
             logging.info("Regenerating FeatureStream %s.", endpath(self.fstream.filename))
@@ -135,12 +213,99 @@ class FeatureData:
         # Regenerate FeatureVectors from FeatureStream
         elif do_featuredb: 
             logging.info("Regenerating FeatureVectors %s.", endpath(self.featuredb.filename))
-            for pmid, date, featvec in counter(self.fstream.iteritems(decode=False)):
-                self.featuredb.add_record(pmid, date, featvec)
-            self.featuredb.commit()
+            self._load_featuredb()
         logging.info("Index regeneration complete.")
 
 
+    def _regenerate_stream(self, artdb, nprocs):
+        """Write the feature stream and feature map for all articles, 
+        assigning feature IDs in order of first occurrence (as for
+        L{add_articles}) in a single pass with in-memory dictionaries, or by
+        hashing if the feature map is a L{HashedFeatureMapping}.
+        @param artdb: Dictionary of Article objects keyed by PubMed ID.
+        @param nprocs: Number of processes for feature extraction."""
+        feature_ids = {} # Feature ID by type and name
+        features = [] # (type, name) of each new feature
+        counts = [] # Occurrence count of each new feature
+        start = len(self.featmap)
+        if nprocs > 1:
+            from multiprocessing import Pool
+            pool = Pool(nprocs, _init_extract, (self.featurespace,))
+            extracted = pool.imap(_extract, artdb.itervalues(), chunksize=200)
+        else:
+            pool = None
+            _init_extract(self.featurespace)
+            extracted = (_extract(article) for article in artdb.itervalues())
+        try:
+            for pmid, date, featuredict in counter(extracted):
+                if self.hash_bits is not None:
+                    # Hashed feature IDs need no dictionary
+                    self.fstream.additem(pmid, date, self.featmap.add_article(featuredict))
+                    continue
+                vector = set()
+                for ftype, featlist in featuredict.iteritems():
+                    fdict = feature_ids.setdefault(ftype, {})
+                    for fname in featlist:
+                        fid = fdict.get(fname)
+                        if fid is None:
+                            fid = fdict[fname] = start + len(features)
+                            features.append((ftype, fname))
+                            counts.append(0)
+                        vector.add(fid)
+                vector = sorted(vector)
+                for fid in vector:
+                    counts[fid-start] += 1
+                self.fstream.additem(pmid, date, vector)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.fstream.flush()
+        if len(features) > 0:
+            logging.info("Loading %d features into the feature map.", len(features))
+            self.featmap.add_features(features, counts)
+        self.featmap.commit()
+
+
+    def recount(self, batchsize=10000):
+        """Rebuild the occurrence counts of a L{HashedFeatureMapping} from the
+        feature vectors, for when its count file is missing or stale (it
+        cannot be recovered from the feature map, which keeps only one
+        sample feature for each ID).
+        @param batchsize: Number of vectors to decode at once."""
+        if self.rdonly:
+            raise NotImplementedError("Failed: may not write read-only index.")
+        counts = nx.zeros(len(self.featmap), nx.uint32)
+        items = self.featuredb.iteritems(decode=False)
+        with self.timings.span(self.featurespace + ".recount"):
+            while True:
+                batch = list(islice(items, batchsize))
+                if len(batch) == 0:
+                    break
+                values, indptr = vb_decode_many([str(v) for p, d, v in batch])
+                counts += nx.bincount(values, minlength=len(counts)).astype(nx.uint32)
+        self.featmap.set_counts(counts)
+        self.featmap.commit()
+
+
+    def _load_featuredb(self):
+        """Bulk-load the feature database from the feature stream, in order
+        of increasing PubMed ID (later records for the same PubMed ID win)."""
+        fs = self.fstream
+        fs.flush()
+        pmids, offsets = [], []
+        offset = 0
+        for pmid, date, featvec in fs.iteritems(decode=False):
+            pmids.append(pmid)
+            offsets.append(offset)
+            offset += 4+4+2+len(featvec)
+        order = nx.argsort(nx.array(pmids, nx.uint32), kind="mergesort")
+        offsets = nx.array(offsets, nx.int64)[order]
+        self.featuredb.bulk_load(counter(
+            fs.readitem(int(pos), decode=False) for pos in offsets))
+        fs.stream.seek(0,2)
+
+
     def vacuum(self, mincount):
         """Remove features from the index having less than the specified number
         of occurrences. This is useful with word features, where millions of
@@ -149,24 +314,150 @@ class FeatureData:
         logging.info("FeatureData: vacuuming %s.", endpath(self.featmap.filename.dirname()))
         if self.rdonly:
             raise NotImplementedError("Failed: may not write read-only index.")
-        lookup = self.featmap.vacuum(mincount)
-        oldname = self.fstream.filename
-        newname = oldname + ".new"
-        fstream_new = FeatureStream(newname, rdonly=False)
-        logging.info("FeatureData: Starting replacement of old feature vectors")
-        for pmid, date, featvec in counter(self.fstream.iteritems()):
-            featvec = vb_encode(lookup[f] for f in featvec if lookup[f] != -1)
-            self.featuredb.update_record(pmid, date, featvec)
-            fstream_new.additem(pmid, date, featvec)
-        self.featuredb.commit()
-        # Replace old FeatureStream file
-        fstream_new.close()   # Close new
-        self.fstream.close()  # Close old
-        newname.move(oldname) # Replace old
-        self.fstream = FeatureStream(oldname, rdonly=False)
+        with self.timings.span(self.featurespace + ".vacuum"):
+            self._remap_vectors(lambda fname: self.featmap.vacuum(mincount, fname))
         logging.info("FeatureData: Index vacuuming complete.")
 
 
+    def reorder(self):
+        """Renumber features by decreasing frequency (see 
+        L{FeatureMapping.reorder}), rewriting the feature vectors."""
+        logging.info("FeatureData: reordering %s.", endpath(self.featmap.filename.dirname()))
+        if self.rdonly:
+            raise NotImplementedError("Failed: may not write read-only index.")
+        with self.timings.span(self.featurespace + ".reorder"):
+            self._remap_vectors(lambda fname: self.featmap.reorder(fname))
+        logging.info("FeatureData: Index reordering complete.")
+
+
+    def _remap_vectors(self, remap, batchsize=10000):
+        """Renumber the features, writing the new L{FeatureMapping},
+        L{FeatureVectors} and L{FeatureStream} as fresh files, and then
+        replacing the old files together using the L{manifest}.
+        
+        @param remap: Function taking the path for the new L{FeatureMapping}
+        which it writes, returning the array that maps old feature IDs to
+        new, or -1 to drop the feature from the vectors.
+        
+        @param batchsize: Number of vectors to decode and encode at once."""
+        featmap = self.featmap.filename
+        featdb = self.featuredb.filename
+        fstream = self.fstream.filename
+        replace = [(featmap+".new"+ext, featmap+ext) for ext in ["", ".types", ".counts"]] \
+                + [(featdb+".new", featdb), (fstream+".new", fstream)]
+        for newname, oldname in replace:
+            if newname.exists():
+                newname.remove()
+        lookup = remap(featmap+".new")
+        fstream_new = FeatureStream(fstream+".new", rdonly=False)
+        featdb_new = FeatureVectors(featdb+".new")
+        logging.info("FeatureData: Writing new feature vectors")
+        items = self.fstream.iteritems(decode=False)
+        while True:
+            batch = list(islice(items, batchsize))
+            if len(batch) == 0:
+                break
+            values, indptr = vb_decode_many([featvec for p, d, featvec in batch])
+            # Renumber, drop deleted features and re-sort each vector
+            vector = nx.repeat(nx.arange(len(batch)), indptr[1:]-indptr[:-1])
+            values = lookup[values].astype(nx.int64)
+            vector, values = vector[values >= 0], values[values >= 0]
+            values = values[nx.lexsort((values, vector))]
+            indptr = nx.concatenate(([0], nx.cumsum(nx.bincount(vector, minlength=len(batch)))))
+            records = [(pmid, date, featvec) for (pmid, date, oldvec), featvec in 
+                       zip(batch, vb_encode_many(values, indptr))]
+            for pmid, date, featvec in records:
+                fstream_new.additem(pmid, date, featvec)
+            featdb_new.add_records(records)
+            sys.stdout.write(".")
+            sys.stdout.flush()
+        sys.stdout.write("\n")
+        fstream_new.flush()
+        os.fsync(fstream_new.stream.fileno())
+        fstream_new.close()
+        featdb_new.close()
+        # Record the files to replace, then replace them
+        with open(self.manifest + ".tmp", "w") as f:
+            for newname, oldname in replace:
+                f.write("%s\t%s\n" % (newname, oldname))
+            f.flush()
+            os.fsync(f.fileno())
+        self.featmap.close()
+        self.featuredb.close()
+        self.fstream.close()
+        with self._replace_lock(exclusive=True):
+            (self.manifest + ".tmp").rename(self.manifest)
+            self._finish_replace()
+            self.featmap = self._open_featmap(featmap)
+            self.featuredb = FeatureVectors(featdb)
+            self.fstream = FeatureStream(fstream, rdonly=False)
+
+
+    @contextmanager
+    def _replace_lock(self, exclusive):
+        """Hold the L{lockfile}, exclusively for renaming the files in the
+        L{manifest}, or shared for opening the databases, so that readers do
+        not open a mixture of old and new files.  Readers that cannot create
+        the lock file go without."""
+        import fcntl
+        try:
+            f = open(self.lockfile, "a")
+        except IOError:
+            if exclusive: raise
+            f = None
+        try:
+            if f is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            if f is not None:
+                f.close()
+
+
+    def _unfinished_replace(self):
+        """Get the new files of an interrupted replacement, for readers that
+        must not rename them (see L{manifest}).
+        @return: Mapping from old file name to the new file that has not been
+        renamed over it yet."""
+        logging.warning("FeatureData: Opening files not yet renamed by %s", 
+                        endpath(self.manifest))
+        renamed = {}
+        for line in self.manifest.lines(retain=False):
+            newname, oldname = [path(x) for x in line.split("\t")]
+            if newname.exists():
+                renamed[oldname] = newname
+        return renamed
+
+
+    def _finish_replace(self):
+        """Rename the new files listed in the L{manifest} over the old ones
+        (skipping those already renamed), then remove the manifest.  Only
+        writers do this, while holding the L{lockfile}."""
+        logging.info("FeatureData: Replacing files listed in %s", endpath(self.manifest))
+        for line in self.manifest.lines(retain=False):
+            newname, oldname = [path(x) for x in line.split("\t")]
+            if newname.exists():
+                newname.rename(oldname)
+        self.manifest.remove()
+
+
+_featurespace = None
+"""Name of the feature extraction method of L{Article}, for L{_extract}
+(global so that it is set once in each worker process)."""
+
+
+def _init_extract(featurespace):
+    """Initialise a process for L{_extract} with the feature space."""
+    global _featurespace
+    _featurespace = featurespace
+
+
+def _extract(article):
+    """Get (PubMed ID, integer date, feature dictionary) of an article."""
+    return (article.pmid, DateAsInteger(article.date_completed), 
+            getattr(article, _featurespace)())
+
+
 def counter(iter, per_dot=300, per_msg=3000):
     """Passes through the iterator, printing '.' on stdout after every
     per_dots items and a timing message after every per_msg items."""
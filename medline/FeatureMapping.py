@@ -4,9 +4,9 @@ from __future__ import with_statement
 from contextlib import closing
 from itertools import izip
 import logging
+from hashlib import md5
 import numpy as nx
 from pysqlite2 import dbapi2 as sqlite3
-from mscanner import delattrs
 
                                      
 __author__ = "Graham Poulter"                                        
@@ -30,11 +30,23 @@ class FeatureMapping:
     name (feature string), and count (feature count).  
     
     Feature type is one of "mesh", "qual", "issn", "w" (word) and "a" (author).
-    Database is indexed by id and (type,name).
+    Database is indexed by id and (type,name).  The ftypes table assigns a
+    small integer code to each feature type, and the array of type codes
+    indexed by feature ID is kept in a file next to the database, so that
+    L{type_mask} does not need to query the whole table.  Likewise the array
+    of occurrence counts is saved next to the database on L{commit}, and kept
+    up to date in memory by L{add_article}, so that L{counts} does not need
+    to be re-read after adding articles.
     
     @ivar con: The SQLite database connection.
     
     @ivar filename: Path to SQLite database file.
+
+    @ivar typefile: Path to the uint8 array of feature type codes (None
+    for an in-memory database).
+
+    @ivar countfile: Path to the uint32 array of occurrence counts (None for
+    an in-memory database).
     
     @ivar grow_features: If True, add new feature strings when encountered. If
     False, ignore unknown feature strings (maintains a static feature space).
@@ -44,7 +56,8 @@ class FeatureMapping:
         """Initialise the table of feature counts."""
         self.filename = filename
         self.grow_features = grow_features
-        self.filename = filename
+        self.typefile = filename + ".types" if filename else None
+        self.countfile = filename + ".counts" if filename else None
         self.con = sqlite3.connect(filename or ":memory:")
         #self.con.execute("PRAGMA synchronous=OFF")
         self.con.execute("PRAGMA cache_size=10000")
@@ -52,22 +65,94 @@ class FeatureMapping:
           id INTEGER PRIMARY KEY,
           type TEXT, name TEXT, count INTEGER,
           UNIQUE(type,name) )""")
+        self.con.execute("""CREATE TABLE IF NOT EXISTS ftypes (
+          code INTEGER PRIMARY KEY, type TEXT UNIQUE )""")
+        self.con.execute("""CREATE TABLE IF NOT EXISTS fmeta (
+          key TEXT PRIMARY KEY, value INTEGER )""")
+        # Only write when something is missing, and commit at once so that
+        # readers do not hold a write lock on the database.
+        if self.con.execute("SELECT code FROM ftypes WHERE code=0").fetchone() is None:
+            self.con.execute("INSERT OR IGNORE INTO ftypes VALUES(0, '')")
         # Make sure that feature 0 exists (create a dummy if necessary)
         if self.con.execute("SELECT id FROM fmap WHERE id=0").fetchone() is None:
             self.con.execute("INSERT OR IGNORE INTO fmap VALUES(0, '', '', 0)")
+        self.con.commit()
+        # Type codes allocated but not yet written to the ftypes table
+        self._unsaved_types = {}
+        self._save_types = False
 
 
     def close(self):
         """Close the underlying database"""
-        self.con.commit()
+        self.commit()
         self.con.close()
 
 
+    def reconnect(self):
+        """Open a new connection to the database, for use in a forked
+        process (SQLite connections must not be shared between processes).
+        The cached arrays are kept."""
+        if self.filename:
+            self.con = sqlite3.connect(self.filename)
+            self.con.execute("PRAGMA cache_size=10000")
+
+
     def commit(self):
-        """Commit pending transactions in the underlying connection"""
+        """Commit pending transactions in the underlying connection, and save
+        the type codes and occurrence counts if they have changed.  The saved
+        arrays are stamped with a serial number that is updated in the same
+        transaction, so they are only used if the commit succeeded."""
+        dirty = getattr(self, "_arrays_dirty", False)
+        if dirty:
+            # Load arrays before the serial number changes (which may
+            # allocate codes for the types of new features)
+            types, counts = self.types, self.counts
+        if self._unsaved_types and (self._save_types or dirty):
+            self.con.executemany("INSERT OR IGNORE INTO ftypes VALUES(?,?)",
+                [(code, ftype) for ftype, code in self._unsaved_types.iteritems()])
+            self._unsaved_types = {}
+            self._save_types = False
+        if self.filename and dirty:
+            serial = (self.arrays_serial() + 1) % 2**32
+            self.con.execute("INSERT OR REPLACE INTO fmeta VALUES(?,?)",
+                             ("arrays_serial", serial))
+            self._save_array(self.typefile, serial, types)
+            self._save_array(self.countfile, serial, counts)
+            self._arrays_dirty = False
         self.con.commit()
 
 
+    def arrays_serial(self):
+        """Serial number of the last commit that saved the arrays"""
+        row = self.con.execute(
+            "SELECT value FROM fmeta WHERE key='arrays_serial'").fetchone()
+        return 0 if row is None else row[0]
+
+
+    @staticmethod
+    def _save_array(filename, serial, array):
+        """Save an array preceded by a uint32 serial number, by way of a
+        temporary file so that the old file is replaced in one step."""
+        tmpfile = filename + ".tmp"
+        with open(tmpfile, "wb") as f:
+            nx.array([serial], nx.uint32).tofile(f)
+            array.tofile(f)
+        tmpfile.rename(filename)
+
+
+    def _load_array(self, filename, dtype):
+        """Load an array saved by L{_save_array}.
+        @return: The array, or None if the file is missing or has the wrong 
+        serial number (stale or from an unfinished commit)."""
+        if filename is None or not filename.exists():
+            return None
+        with open(filename, "rb") as f:
+            serial = nx.fromfile(f, nx.uint32, 1)
+            if len(serial) == 0 or serial[0] != self.arrays_serial():
+                return None
+            return nx.fromfile(f, dtype)
+
+
     def __len__(self):
         """Return number of features in the table."""
         try:
@@ -90,13 +175,94 @@ class FeatureMapping:
         try:
             return self._counts
         except AttributeError:
-            self._counts = nx.zeros(len(self), nx.uint32)
-            logging.debug("FeatureMapping: Query occurrence counts vector.")
-            for id,count in self.con.execute("SELECT id,count FROM fmap ORDER BY id"):
-                self._counts[id] = count
+            counts = self._load_array(self.countfile, nx.uint32)
+            if counts is None:
+                counts = nx.zeros(len(self), nx.uint32)
+                logging.debug("FeatureMapping: Query occurrence counts vector.")
+                for id,count in self.con.execute("SELECT id,count FROM fmap ORDER BY id"):
+                    counts[id] = count
+            self._set_counts(counts)
             return self._counts
 
 
+    def _set_counts(self, counts, numfeats=None):
+        """Replace the L{counts} array.
+        @param counts: Array to use as the buffer for the counts, which may
+        be longer than the number of features to leave room for growth.
+        @param numfeats: Number of features (defaults to length of counts)."""
+        if numfeats is None:
+            numfeats = len(counts)
+        self._countbuf = counts
+        self._counts = counts[:numfeats]
+        self._length = numfeats
+
+
+    def _grow_counts(self, numfeats):
+        """Extend L{counts} with zeros to cover L{numfeats} features, 
+        doubling the underlying buffer when it runs out of space."""
+        counts = self.counts
+        if numfeats <= len(counts):
+            return
+        if numfeats > len(self._countbuf):
+            buf = nx.zeros(max(numfeats, 2*len(self._countbuf)), nx.uint32)
+            buf[:len(counts)] = counts
+            self._set_counts(buf, numfeats)
+        else:
+            self._set_counts(self._countbuf, numfeats)
+
+
+    @property
+    def type_codes(self):
+        """Dictionary from feature type string to its code in L{types}"""
+        try:
+            return self._type_codes
+        except AttributeError:
+            self._type_codes = dict((ftype, code) for code, ftype in 
+                self.con.execute("SELECT code,type FROM ftypes"))
+            return self._type_codes
+
+
+    def type_code(self, ftype, save=True):
+        """Get the code for a feature type, allocating one if the type
+        has not been seen before.  New codes are written to the ftypes
+        table by L{commit}, except when only looked up (save=False), so that
+        reading the L{types} never writes to the database.
+        @raise ValueError: if there are too many distinct types for uint8."""
+        codes = self.type_codes
+        if ftype not in codes:
+            code = len(codes)
+            if code > 255:
+                raise ValueError("Too many feature types for uint8 codes")
+            codes[ftype] = code
+            self._unsaved_types[ftype] = code
+        if save and ftype in self._unsaved_types:
+            self._save_types = True
+        return codes[ftype]
+
+
+    @property
+    def types(self):
+        """Array with the type code of each feature (see L{type_codes}),
+        indexed by feature ID. Loaded from L{typefile}, and features added
+        since the file was last saved are filled in from the database."""
+        numfeats = len(self)
+        try:
+            types = self._types
+        except AttributeError:
+            types = self._load_array(self.typefile, nx.uint8)
+            if types is None or len(types) > numfeats:
+                types = nx.zeros(0, nx.uint8)
+        if len(types) < numfeats:
+            logging.debug("FeatureMapping: Query types of features from %d.", len(types))
+            tail = nx.zeros(numfeats-len(types), nx.uint8)
+            for fid, ftype in self.con.execute(
+                "SELECT id,type FROM fmap WHERE id>=?", (len(types),)):
+                tail[fid-len(types)] = self.type_code(ftype, save=False)
+            types = nx.concatenate((types, tail))
+        self._types = types
+        return self._types
+
+
     @staticmethod
     def holders(n):
         """Return a '(?,?,?)' place-holder tuple with n question marks"""
@@ -110,13 +276,13 @@ class FeatureMapping:
         @param ftypes: List of feature types, such as ["mesh","issn"].
         @return: Boolean array indexed by feature ID where True positions
         correspond to features of the types specified in L{ftypes}."""
-        mask = nx.zeros(len(self), nx.bool)
-        if len(ftypes) > 0:
-            for fid, in self.con.execute(
-                "SELECT id FROM fmap WHERE type IN "+
-                self.holders(len(ftypes)), ftypes):
-                mask[fid] = True
-        return mask
+        types = self.types # Loads any new type codes
+        # Lookup table from type code to True/False
+        wanted = nx.zeros(256, nx.bool)
+        for ftype in ftypes:
+            if ftype in self.type_codes:
+                wanted[self.type_codes[ftype]] = True
+        return wanted[types]
     
     
     def remove_vector(self, featurevector):
@@ -125,29 +291,91 @@ class FeatureMapping:
         whose count has dropped to zero."""
         self.con.execute("UPDATE fmap SET count=(count-1) WHERE id IN "+
                          self.holders(len(featurevector)), featurevector)
-        self._counts[featurevector] -= 1
+        self.counts[featurevector] -= 1
+        self._arrays_dirty = True
 
 
-    def vacuum(self, mincount):
+    def vacuum(self, mincount, filename=None):
         """Delete features with fewer than the specified number of occurrences.
+        @param filename: If given, write the vacuumed mapping to this new
+        database instead of changing this one (see L{_remap}).
         @return: Array mapping old feature IDs to new, or -1 for deleted features."""
         keep = self.counts >= mincount
         nkeep, numfeats = sum(keep), len(keep)
         logging.info("FeatureMapping: Keeping %d, deleting %d out of %d (min %d occurrences).",
                      nkeep, numfeats-nkeep, numfeats, mincount)
         # lookup[oldid] == newid or -1
-        lookup = nx.zeros(len(self.counts),nx.int32) - 1
+        lookup = nx.zeros(numfeats, nx.int32) - 1
         lookup[keep] = nx.arange(0, nkeep, dtype=nx.int32)
-        # Map oldfeatures[keep] -> lookup[keep], delete oldfeatures[~keep]
-        oldfeatures = nx.arange(0, numfeats, dtype=nx.int32)
-        # Perform the feature deletion and update
-        self.con.execute("DELETE FROM fmap WHERE count<?", (mincount,))
+        self._remap(lookup, filename)
+        return lookup
+
+
+    def reorder(self, filename=None):
+        """Renumber features in order of decreasing occurrence count, so that
+        frequent features have small IDs.  This places the scores of common
+        features close together in memory, and makes the gaps in feature
+        vectors smaller for variable byte encoding.  Feature 0 stays the
+        dummy feature, and features with equal counts keep their order.
+        @param filename: If given, write the reordered mapping to this new
+        database instead of changing this one (see L{_remap}).
+        @return: Array mapping old feature IDs to new."""
+        logging.info("FeatureMapping: Renumbering %d features by frequency.", len(self))
+        order = nx.argsort(-self.counts[1:].astype(nx.int64), kind="mergesort") + 1
+        lookup = nx.zeros(len(self), nx.int32)
+        lookup[order] = nx.arange(1, len(self), dtype=nx.int32)
+        self._remap(lookup, filename)
+        return lookup
+
+
+    def _remap(self, lookup, filename=None):
+        """Change feature IDs in the database, and in the arrays of counts
+        and type codes.
+        @param lookup: Array mapping old feature IDs to new IDs, which must be
+        0..N-1 for the N features that are kept, or -1 to delete the feature.
+        @param filename: If None, update this database in place.  Otherwise
+        write the renumbered features in one transaction to a new database
+        at this path (replacing any existing file), leaving this one as is."""
+        keep = lookup >= 0
+        oldfeatures = nx.flatnonzero(keep)
+        newfeatures = lookup[keep]
+        counts = nx.zeros(len(newfeatures), nx.uint32)
+        counts[newfeatures] = self.counts[keep]
+        types = nx.zeros(len(newfeatures), nx.uint8)
+        types[newfeatures] = self.types[keep]
+        if filename is not None:
+            self._save_types = True
+            self.commit()
+            for fname in [filename, filename+".types", filename+".counts"]:
+                if fname.exists():
+                    fname.remove()
+            newmap = FeatureMapping(filename, self.grow_features)
+            newmap.con.executemany("INSERT OR REPLACE INTO ftypes VALUES(?,?)",
+                                   self.con.execute("SELECT code,type FROM ftypes"))
+            newmap.con.executemany("INSERT OR REPLACE INTO fmap VALUES(?,?,?,?)",
+                ((int(lookup[fid]), ftype, name, count) for fid, ftype, name, count 
+                 in self.con.execute("SELECT id,type,name,count FROM fmap")
+                 if lookup[fid] >= 0))
+            newmap._set_counts(counts)
+            newmap._types = types
+            newmap._arrays_dirty = True
+            newmap.close()
+            return
+        # Perform the feature deletion and update, moving kept features out 
+        # of the way first, so that no two features have the same ID
+        self.con.executemany("DELETE FROM fmap WHERE id=?",
+                             ((fid,) for fid in nx.flatnonzero(~keep).tolist()))
+        self.con.execute("UPDATE fmap SET id=-1-id")
         self.con.executemany("UPDATE fmap SET id=? WHERE id=?", 
-                             izip(lookup[keep],oldfeatures[keep]))
-        self.con.commit()
+                             izip(newfeatures.tolist(), (-1-oldfeatures).tolist()))
+        self._set_counts(counts)
+        self._types = types
+        self._arrays_dirty = True
+        self.commit()
+        # VACUUM fails inside the implicit transaction of some pysqlite versions
+        self.con.isolation_level = None
         self.con.execute("VACUUM")
-        delattrs(self, "_counts", "_length")
-        return lookup
+        self.con.isolation_level = ""
 
 
     def get_feature(self, fid):
@@ -156,17 +384,42 @@ class FeatureMapping:
         row = self.con.execute(
             "SELECT name, type FROM fmap WHERE id=?", (fid,)).fetchone()
         if row is None:
-            raise KeyError("Invalid key: %s" % str(key))
+            raise KeyError("Invalid key: %s" % str(fid))
         return row
 
 
+    def get_features(self, fids, chunk=500):
+        """Retrieve feature (name, type) for many feature IDs, with one query
+        per L{chunk} IDs instead of one query per ID.
+        @param fids: Iterable of feature IDs.
+        @param chunk: Number of IDs per query (SQLite limits the number of
+        parameters in a query).
+        @return: List of (name, type) corresponding to L{fids}.
+        @raise KeyError: if a feature ID does not exist."""
+        fids = [int(fid) for fid in fids]
+        found = {}
+        unique = list(set(fids))
+        for start in xrange(0, len(unique), chunk):
+            batch = unique[start:start+chunk]
+            for fid, name, ftype in self.con.execute(
+                "SELECT id, name, type FROM fmap WHERE id IN " + 
+                self.holders(len(batch)), batch):
+                found[fid] = (name, ftype)
+        try:
+            return [found[fid] for fid in fids]
+        except KeyError, e:
+            raise KeyError("Invalid key: %s" % str(e.args[0]))
+
+
     def add_article(self, featuredict):
         """For each feature, insert it with count 1, or increment count of the
         existing feature. Also returns the feature vector (same result as
         make_vector, which does not alter occurrence counts).
         
         @param featuredict: Dictionary keyed by feature type, where each value
-        is a list of feature strings of that type C{{'mesh':['A','B']}}."""
+        is a list of feature strings of that type C{{'mesh':['A','B']}}.
+        @return: Sorted list of feature IDs."""
+        self.counts # Load counts before the database changes
         for ftype, featlist in featuredict.iteritems():
             if len(featlist) > 0:
                 c = self.con.execute(
@@ -175,8 +428,32 @@ class FeatureMapping:
                 if c.rowcount < len(featlist) and self.grow_features:
                     c.executemany("INSERT OR IGNORE INTO fmap VALUES(NULL,'"+ftype+"',?,1)",
                                   ((fname,) for fname in featlist))
-        # Feature counts have changed
-        delattrs(self, "_counts", "_length")
+        # Update the counts in place (new features start from zero)
+        vector = self.make_vector(featuredict)
+        if len(vector) > 0:
+            self._grow_counts(vector[-1]+1)
+            self.counts[vector] += 1
+            self._arrays_dirty = True
+        return vector
+
+
+    def add_features(self, features, counts):
+        """Bulk-load new features, such as those counted in memory when
+        regenerating an index.
+        @param features: List of (type, name) for new features, which get
+        consecutive IDs starting from the current number of features.
+        @param counts: Occurrence counts corresponding to L{features}."""
+        self.counts # Load counts before the database changes
+        start = len(self)
+        types = nx.concatenate((self.types, nx.array(
+            [self.type_code(ftype) for ftype, fname in features], nx.uint8)))
+        self.con.executemany("INSERT INTO fmap VALUES(?,?,?,?)", 
+            ((start+i, ftype, fname, int(count)) for i, ((ftype, fname), count) 
+             in enumerate(izip(features, counts))))
+        self._grow_counts(start+len(features))
+        self.counts[start:] = counts
+        self._types = types
+        self._arrays_dirty = True
 
 
     def make_vector(self, featuredict):
@@ -198,6 +475,202 @@ class FeatureMapping:
         return vector
 
 
+    @property
+    def empty(self):
+        """True if no features have been added (only the dummy feature)"""
+        return len(self) == 1
+
+
+
+def feature_hash(ftype, fname):
+    """Stable 64-bit hash of a feature, from the first 8 bytes of the MD5
+    digest of its type and UTF-8 encoded name (the built-in hash depends on
+    the platform and Python version)."""
+    if isinstance(fname, unicode):
+        fname = fname.encode("utf-8")
+    return long(md5(ftype + "\x00" + fname).hexdigest()[:16], 16)
+
+
+
+class HashedFeatureMapping(FeatureMapping):
+    """Implements the interface of L{FeatureMapping} with a fixed number of
+    feature IDs, obtained by hashing the feature type and name (see
+    L{feature_hash}), which bounds the memory taken by word features.
+    
+    Feature IDs are assigned without looking up the database, so different
+    processes can compute feature vectors independently, and the L{counts}
+    and L{types} arrays have a fixed size.  Distinct features may share an
+    ID (a collision): see L{collision_stats}.  The fmap table keeps only the
+    first feature seen for each ID, for displaying feature names in reports,
+    and L{types} holds the type of that feature.  The number of hash bits is
+    stored in the fmeta table.
+
+    Features cannot be deleted or renumbered, so L{vacuum} and L{reorder}
+    are not available, and L{grow_features} has no effect.
+
+    @ivar bits: Number of bits in the hash, for 2**bits feature IDs.
+    """
+
+    def __init__(self, filename, bits=20, grow_features=True):
+        """Initialise the table of sample features.
+        @raise ValueError: If the database was created with a different
+        number of bits, or holds a feature map that is not hashed."""
+        FeatureMapping.__init__(self, filename, grow_features)
+        row = self.con.execute(
+            "SELECT value FROM fmeta WHERE key='hash_bits'").fetchone()
+        if row is not None and row[0] != bits:
+            raise ValueError("Feature map %s uses %d hash bits, not %d" % 
+                             (filename, row[0], bits))
+        if row is None:
+            if self.con.execute("SELECT count(id) FROM fmap").fetchone()[0] > 1:
+                raise ValueError("Feature map %s is not hashed" % filename)
+            self.con.execute("INSERT INTO fmeta VALUES('hash_bits',?)", (bits,))
+            self.con.commit()
+        self.bits = bits
+        self._length = 2**bits
+
+
+    def __len__(self):
+        """Return number of feature IDs (fixed by L{bits})"""
+        return self._length
+
+
+    @property
+    def counts(self):
+        """Array with the number of occurrences of each feature ID (see
+        L{FeatureMapping.counts}), which is only stored in the file.
+        @raise ValueError: If features have been added but the file is
+        missing or stale (see L{set_counts})."""
+        try:
+            return self._counts
+        except AttributeError:
+            counts = self._load_array(self.countfile, nx.uint32)
+            if counts is None:
+                if self.con.execute("SELECT count(id) FROM fmap").fetchone()[0] > 1:
+                    raise ValueError("Occurrence counts of %s are missing or stale" 
+                                     % self.filename)
+                counts = nx.zeros(len(self), nx.uint32)
+            self._set_counts(counts)
+            return self._counts
+
+
+    def set_counts(self, counts):
+        """Replace the occurrence counts, such as after counting the feature
+        vectors again (see L{FeatureData.recount}). They are saved by
+        L{commit}.
+        @param counts: Array of length L{len}(self)."""
+        if len(counts) != len(self):
+            raise ValueError("Expected %d counts, not %d" % (len(self), len(counts)))
+        self._set_counts(nx.asarray(counts, nx.uint32))
+        self._arrays_dirty = True
+
+
+    @property
+    def types(self):
+        """Array with the type code of the first feature seen with each
+        feature ID (see L{FeatureMapping.types})."""
+        try:
+            return self._types
+        except AttributeError:
+            types = self._load_array(self.typefile, nx.uint8)
+            if types is None:
+                types = nx.zeros(len(self), nx.uint8)
+                for fid, ftype in self.con.execute("SELECT id,type FROM fmap"):
+                    types[fid] = self.type_code(ftype, save=False)
+            self._types = types
+            return self._types
+
+
+    @property
+    def empty(self):
+        """True if no features have been added"""
+        return not self.counts.any()
+
+
+    def feature_id(self, ftype, fname):
+        """Feature ID of a feature, which is never 0 (the dummy feature)"""
+        return 1 + feature_hash(ftype, fname) % (self._length - 1)
+
+
+    def _hash_features(self, featuredict):
+        """Get the feature IDs of the features in L{featuredict}.
+        @return: Sorted array of distinct feature IDs, and a list of
+        (feature ID, type, name) for each feature."""
+        feature_id = self.feature_id
+        features = [(feature_id(ftype, fname), ftype, fname) 
+                    for ftype, featlist in featuredict.iteritems() 
+                    for fname in featlist]
+        vector = nx.unique(nx.array([fid for fid, ftype, fname in features], nx.int64))
+        return vector, features
+
+
+    def add_article(self, featuredict):
+        """Increment the counts of the feature IDs of the features, and
+        record the features of previously unused IDs as samples.
+        @return: Sorted list of feature IDs."""
+        vector, features = self._hash_features(featuredict)
+        counts, types = self.counts, self.types
+        fresh = [(fid, ftype, fname) for fid, ftype, fname in features 
+                 if counts[fid] == 0 and types[fid] == 0]
+        if len(fresh) > 0:
+            for fid, ftype, fname in fresh:
+                if types[fid] == 0:
+                    types[fid] = self.type_code(ftype)
+            self.con.executemany("INSERT OR IGNORE INTO fmap VALUES(?,?,?,0)", fresh)
+        if len(vector) > 0:
+            counts[vector] += 1
+            self._arrays_dirty = True
+        return vector.tolist()
+
+
+    def remove_vector(self, featurevector):
+        """Decrement the occurrence counts of the feature IDs"""
+        self.counts[featurevector] -= 1
+        self._arrays_dirty = True
+
+
+    def add_features(self, features, counts):
+        """Not possible because feature IDs are fixed by the hash
+        @raise NotImplementedError: always"""
+        raise NotImplementedError("Cannot bulk-load features into a hashed feature map")
+
+
+    def make_vector(self, featuredict):
+        """Get sorted list of the feature IDs of features (see
+        L{FeatureMapping.make_vector}), without altering counts."""
+        return self._hash_features(featuredict)[0].tolist()
+
+
+    def vacuum(self, mincount, filename=None):
+        """Not possible because feature IDs are fixed by the hash
+        @raise NotImplementedError: always"""
+        raise NotImplementedError("Cannot vacuum a hashed feature map")
+
+
+    def reorder(self, filename=None):
+        """Not possible because feature IDs are fixed by the hash
+        @raise NotImplementedError: always"""
+        raise NotImplementedError("Cannot reorder a hashed feature map")
+
+
+    def collision_stats(self):
+        """Estimate the number of collisions between features. With N
+        distinct features hashed into M IDs, the expected number of IDs in
+        use is M(1-exp(-N/M)), from which N is estimated.
+        @return: Dictionary with "ids" (number of feature IDs), "used"
+        (IDs with non-zero count), "features" (estimated distinct features),
+        "collisions" (estimated features sharing an ID with an earlier
+        feature) and "load" (features per ID)."""
+        ids = len(self) - 1
+        used = int((self.counts[1:] > 0).sum())
+        if used < ids:
+            features = -ids * nx.log(1.0 - used / float(ids))
+        else:
+            features = float("inf")
+        return dict(ids=ids, used=used, features=features, 
+                    collisions=features-used, load=features/ids)
+
+
 
 
 class MemoryFeatureMapping:
@@ -272,6 +745,9 @@ class MemoryFeatureMapping:
     def get_feature(self, fid):
         return self.features[fid]
 
+    def get_features(self, fids):
+        return [self.features[fid] for fid in fids]
+
     def type_mask(self, ftypes):
         mask = nx.zeros(len(self), nx.bool)
         if len(ftypes) > 0:
@@ -281,6 +757,7 @@ class MemoryFeatureMapping:
         return mask
 
     def add_article(self, featuredict):
+        vector = []
         for ftype, featlist in featuredict.iteritems():
             if ftype not in self.feature_ids:
                 self.feature_ids[ftype] = {}
@@ -288,10 +765,14 @@ class MemoryFeatureMapping:
             for fname in featlist:
                 if fname in fdict:
                     self.counts[fdict[fname]] += 1
+                    vector.append(fdict[fname])
                 elif self.grow_features:
                     fdict[fname] = len(self.features)
+                    vector.append(fdict[fname])
                     self.features.append((fname,ftype))
                     self.counts.append(1)
+        vector.sort()
+        return vector
 
     def make_vector(self, featuredict):
         vector = []
@@ -2,6 +2,7 @@
 that can be rapidly processed by the C programs under fastscores."""
 
 import logging
+import numpy as nx
 import struct
 
 
@@ -158,3 +159,65 @@ def vb_decode(bytestring):
             last += gap
             yield last
             gap = 0
+
+
+
+def vb_encode_many(values, indptr):
+    """Variable-byte encode many sorted vectors at once, with numpy array
+    operations instead of a Python loop over every feature.
+    
+    @param values: Concatenated vectors of sorted feature IDs.
+    
+    @param indptr: Vector i is values[indptr[i]:indptr[i+1]].
+    
+    @return: List of encoded strings, the same as from L{vb_encode}."""
+    values = nx.asarray(values, nx.int64)
+    indptr = nx.asarray(indptr, nx.int64)
+    # Gap from the previous item in the same vector
+    gaps = values.copy()
+    gaps[1:] -= values[:-1]
+    starts = indptr[:-1][indptr[:-1] < indptr[1:]]
+    gaps[starts] = values[starts]
+    # Number of 7-bit groups in each gap, and position of its first byte
+    nbytes = nx.ones(len(gaps), nx.int64)
+    for bits in [7, 14, 21, 28, 35]:
+        nbytes += gaps >= (1 << bits)
+    ends = nx.cumsum(nbytes)
+    out = nx.zeros(ends[-1] if len(ends) else 0, nx.uint8)
+    # Fill in the groups from the least significant (last byte) upwards
+    for group in xrange(nbytes.max() if len(nbytes) else 0):
+        has = nbytes > group
+        out[ends[has]-1-group] = (gaps[has] >> (7*group)) & 0x7f
+    out[ends-1] |= 0x80
+    # Split the bytes at vector boundaries
+    bounds = nx.concatenate(([0], ends))[indptr]
+    data = out.tostring()
+    return [data[bounds[i]:bounds[i+1]] for i in xrange(len(bounds)-1)]
+
+
+def vb_decode_many(strings):
+    """Decode many variable-byte-encoded strings at once.
+    
+    @param strings: List of strings from L{vb_encode}.
+    
+    @return: (values, indptr) where values is the int64 concatenation of
+    decoded vectors, and vector i is values[indptr[i]:indptr[i+1]]."""
+    data = nx.fromstring("".join(strings), nx.uint8).astype(nx.int64)
+    lengths = nx.array([len(x) for x in strings], nx.int64)
+    last = nx.flatnonzero(data & 0x80)
+    # Number of values in each string
+    byte_bounds = nx.concatenate(([0], nx.cumsum(lengths)))
+    indptr = nx.searchsorted(last, byte_bounds)
+    # Position of each byte counting back from the last byte of its gap
+    gaps = nx.zeros(len(last), nx.int64)
+    if len(last) > 0:
+        is_last = (data >> 7).astype(nx.int64)
+        gap_of_byte = nx.cumsum(is_last) - is_last
+        shift = 7 * (last[gap_of_byte] - nx.arange(len(data)))
+        gaps = nx.add.reduceat((data & 0x7f) << shift, 
+                               nx.concatenate(([0], last[:-1]+1)))
+    # Undo the gaps within each vector
+    values = nx.cumsum(gaps)
+    before = nx.concatenate(([0], values))[indptr[:-1]]
+    values -= nx.repeat(before, indptr[1:]-indptr[:-1])
+    return values, indptr
@@ -54,6 +54,14 @@ class FeatureVectors:
         self.con.close()
 
 
+    def reconnect(self):
+        """Open a new connection to the database, for use in a forked
+        process (SQLite connections must not be shared between processes).
+        The cached length and PubMed IDs are kept."""
+        if self.filename is not None:
+            self.con = sqlite3.connect(self.filename)
+
+
     def commit(self):
         """Commit pending transactions in the underlying connection"""
         self.con.commit()
@@ -107,6 +115,38 @@ class FeatureVectors:
         delattrs(self, "_length", "_pmids")
 
 
+    def add_records(self, records):
+        """Store many feature vectors with a single executemany, replacing 
+        any existing records for the same PubMed IDs.
+        @param records: Iterable of (pmid, date, vb_encoded string)."""
+        self.con.executemany("INSERT OR REPLACE INTO docs VALUES(?,?,?)",
+            ((pmid, date, sqlite3.Binary(featvec)) for pmid, date, featvec in records))
+        delattrs(self, "_length", "_pmids")
+
+
+    def bulk_load(self, records):
+        """Add many records with journaling and syncing switched off, for
+        filling a new database.  Records should be in increasing order of
+        PubMed ID, so that rows are appended to the end of the table.
+        @param records: Iterable of (pmid, date, vb_encoded string)."""
+        self.con.commit()
+        self._pragmas("synchronous=OFF", "journal_mode=OFF")
+        try:
+            self.add_records(records)
+            self.con.commit()
+        finally:
+            self._pragmas("journal_mode=DELETE", "synchronous=FULL")
+
+
+    def _pragmas(self, *pragmas):
+        """Set pragmas outside of a transaction (some pysqlite versions
+        start an implicit transaction before a PRAGMA)."""
+        self.con.isolation_level = None
+        for pragma in pragmas:
+            self.con.execute("PRAGMA " + pragma)
+        self.con.isolation_level = ""
+
+
     def update_record(self, pmid, date, featurevector):
         """Update a record's vector and date. Parameters are as for L{add_record}."""
         if not isinstance(featurevector, str):
@@ -24,7 +24,8 @@ You should have received a copy of the GNU General Public License along with
 this program. If not, see <http://www.gnu.org/licenses/>."""
 
 
-def open(filename, flags='c', mode=0660, dbenv=None, txn=None, dbname=None, compress=True):
+def open(filename, flags='c', mode=0660, dbenv=None, txn=None, dbname=None, 
+         compress=True, btree=False):
     """Open a shelf with Berkeley DB backend
 
     @param flags: One of 'r','rw','w','c','n'. Optionally specify flags such as
@@ -38,6 +39,9 @@ def open(filename, flags='c', mode=0660, dbenv=None, txn=None, dbname=None, comp
     
     @param compress: If True, also gzip the pickles in the shelf.
     
+    @param btree: If True, use a BTree instead of a hash table, so that
+    records are stored in key order and sorted reads are sequential.
+    
     @return: L{Shelf} using the opened database.
     """
     if isinstance(flags, basestring):
@@ -53,8 +57,9 @@ def open(filename, flags='c', mode=0660, dbenv=None, txn=None, dbname=None, comp
             flags = bsddb.db.DB_TRUNCATE | db.DB_CREATE
         else:
             raise bsddb.db.DBError("Flag %s is not in 'r', 'rw', 'w', 'c' or 'n'"  % str(flags))
+    dbtype = bsddb.db.DB_BTREE if btree else bsddb.db.DB_HASH
     database = bsddb.db.DB(dbenv)
-    database.open(filename, dbname, bsddb.db.DB_HASH, flags, mode, txn=txn)
+    database.open(filename, dbname, dbtype, flags, mode, txn=txn)
     return Shelf(database, txn, compress)
 
 
@@ -122,6 +127,46 @@ class Shelf(DictMixin):
         return self.db.has_key(key, self.txn)
 
 
+    def get_many(self, keys, nthreads=1):
+        """Retrieve many records at once. Keys are de-duplicated and sorted,
+        then fetched through a single cursor (with a BTree shelf this reads
+        the records in storage order instead of seeking at random).
+
+        @param keys: Iterable over keys to look up.
+        
+        @param nthreads: Number of threads for decompressing and unpickling
+        the records (zlib releases the interpreter lock while inflating).
+
+        @return: Dictionary of the values for those keys that were found
+        (missing keys are left out).
+        """
+        raw = []
+        cur = self.db.cursor(self.txn)
+        try:
+            for key in sorted(set(keys)):
+                try:
+                    rec = cur.set(key)
+                except bsddb.db.DBNotFoundError:
+                    rec = None
+                if rec is not None:
+                    raw.append(rec)
+        finally:
+            cur.close()
+        loads = lambda v: cPickle.loads(self.decompress(v))
+        if nthreads <= 1 or len(raw) < 2*nthreads:
+            return dict((k, loads(v)) for k, v in raw)
+        import threading
+        result = {}
+        def worker(chunk):
+            for k, v in chunk:
+                result[k] = loads(v)
+        threads = [threading.Thread(target=worker, args=(raw[i::nthreads],))
+                   for i in xrange(nthreads)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        return result
+
+
     def keys(self):
         return self.db.keys(self.txn)
 
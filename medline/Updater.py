@@ -8,7 +8,9 @@ from path import path
 import time
 
 from mscanner.configuration import rc
-from mscanner.medline.Article import Article
+from mscanner.core.timing import Timings
+from mscanner.medline.Article import Article, FeatureCache
+from mscanner.medline.CitationSnippets import CitationSnippets
 from mscanner.medline.FeatureData import FeatureData
 from mscanner.medline.FeatureStream import DateAsInteger
 from mscanner.medline import Shelf
@@ -35,22 +37,31 @@ class Updater:
     files, and writes to article database and L{FeatureData} indexes.
     
     @ivar artdb: L{Shelf} for looking up Article objects by PubMed ID
+    @ivar snippets: L{CitationSnippets} for printing citation tables (may be None).
     @ivar fdata_list: List of L{FeatureData} instances for article representations.
     @ivar tracker: Path to the list of completed Medline XML files.
     @ivar stopwords: Set of words not to use as features.
+    @ivar timings: L{Timings} of parsing and adding articles, shared with
+    the L{FeatureData} instances.
     """
 
 
-    def __init__(self, artdb, fdata_list, tracker):
+    def __init__(self, artdb, fdata_list, tracker, snippets=None):
         """Constructor parameters set corresponding instance variables."""
         self.artdb = artdb
         self.fdata_list = fdata_list
         self.tracker = tracker
+        self.snippets = snippets
+        self.timings = Timings()
+        for fdata in fdata_list:
+            fdata.timings = self.timings
 
 
     def close(self):
         """Close article database and L{FeatureData} instances"""
         self.artdb.close()
+        if self.snippets is not None:
+            self.snippets.close()
         for fdata in self.fdata_list:
             fdata.close()
 
@@ -66,7 +77,8 @@ class Updater:
         return Updater(
             Shelf.open(base/rc.articledb),
             [FeatureData.Defaults(fs, rdonly=False) for fs in featurespaces], 
-            rc.articles_home/rc.tracker)
+            rc.articles_home/rc.tracker,
+            CitationSnippets(base/rc.snippet_index, base/rc.snippet_blob, rdonly=False))
     
     
     def load_properties(self):
@@ -88,11 +100,18 @@ class Updater:
         @param articles: List of Article objects to add.
         """
         logging.warn("Adding articles to databases. DO NOT INTERRUPT!")
-        for art in articles:
-            self.artdb[str(art.pmid)] = art
-        self.artdb.sync()
+        t = self.timings
+        with t.span("artdb"):
+            for art in articles:
+                self.artdb[str(art.pmid)] = art
+            self.artdb.sync()
+        if self.snippets is not None:
+            with t.span("snippets"):
+                self.snippets.add_articles(articles)
+        # Feature spaces share the features they have in common
+        caches = [FeatureCache(art) for art in articles]
         for fdata in self.fdata_list:
-            fdata.add_articles(articles)
+            fdata.add_articles(articles, caches=caches)
 
 
     def add_directory(self, medline, save_delay=5):
@@ -130,7 +149,8 @@ class Updater:
                     infile = gzip.open(filename, 'r')
                 else:
                     infile = open(filename, 'r')
-                articles = list(Article.parse_medline_xml(infile))
+                with self.timings.span("parse_medline_xml"):
+                    articles = list(Article.parse_medline_xml(infile))
             except KeyboardInterrupt:
                 logging.info("Safely interrupted.")
                 raise
@@ -143,6 +163,9 @@ class Updater:
                 self.tracker.write_lines(sorted(done))
                 logging.info("Added %d articles from file %d out of %d (%s)", 
                              len(articles), idx+1, len(todo), filename.name)
+                self.timings.count("articles", len(articles))
+                logging.debug("Update timings so far: %s", ", ".join(
+                    "%s %.1fs" % x for x in sorted(self.timings.totals().items())))
                 del articles
             except KeyboardInterrupt:
                 logging.error("Unsafely interrupted!!!")
@@ -20,6 +20,7 @@ from mscanner.configuration import rc
 from mscanner.core import iofuncs
 from mscanner.core.QueryManager import QueryManager
 from mscanner.core.ValidationManager import CrossValidation
+from mscanner.medline import Shelf
 from mscanner.medline.FeatureData import FeatureData
 from mscanner.pharmdemo import genedrug
 from mscanner.pharmdemo.Exporter import Exporter
@@ -74,8 +75,10 @@ class PharmdemoQuery(QueryManager):
             rc.genedrug_db, rc.drugtable, rc.gapscore_db)
         gd_articles = []
         gd_pmids = set()
+        articles = self.artdb.get_many(
+            str(pmid) for score, pmid in chain(self.results, self.inputs))
         for score, pmid in chain(self.results, self.inputs):
-            a = self.artdb[str(pmid)]
+            a = articles[str(pmid)]
             a.genedrug = gdfinder[a]
             if len(a.genedrug) > 0:
                 gd_articles.append(a)
@@ -102,10 +105,12 @@ class PharmdemoValidation(CrossValidation):
         @return: Set of PubMed IDs which have gene-drug co-occurrences.
         """
         logging.info("Getting gene-drug associations") 
-        artdb = Shelf(rc.articles_home/rc.articledb,'r')
-        pos_arts = [artdb[x] for x in self.positives]
-        neg_arts = [artdb[x] for x in self.negatives]
+        artdb = Shelf.open(rc.articles_home/rc.articledb, 'r')
+        articles = artdb.get_many(
+            str(pmid) for pmid in chain(self.positives, self.negatives))
         artdb.close()
+        pos_arts = [articles[str(x)] for x in self.positives]
+        neg_arts = [articles[str(x)] for x in self.negatives]
         gdfinder = genedrug.open_genedrug_finder(
             rc.genedrug, rc.drugtable, rc.gapscore)
         postfilter = set()
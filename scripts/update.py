@@ -50,6 +50,9 @@ def regenerate():
     """Regenerate the FeatureMap, FeatureStream, FeatureVectors
     and article list - but only those that have been deleted from dist."""
     updater = Updater.Defaults(featurespaces)
+    if len(updater.snippets) == 0:
+        logging.info("Regenerating citation snippets")
+        updater.snippets.add_articles(updater.artdb.itervalues())
     for fdata in updater.fdata_list:
         fdata.regenerate(updater.artdb)
     return updater
@@ -76,6 +79,16 @@ def vacuum(mincount):
     return updater
 
 
+def reorder():
+    """Renumber features by decreasing frequency, remapping the feature vectors,
+    so that scores of common features are close together in memory."""
+    logging.info("Renumbering features by frequency")
+    updater = Updater.Defaults(featurespaces)
+    for fdata in updater.fdata_list:
+        fdata.reorder()
+    return updater
+
+
 def load_pickles(*pickles):    
     """Add articles to MScanner database from gzip'd pickles, each
     of which contains a list of Article objects."""
@@ -100,10 +113,12 @@ def save_pickle(filename):
     pickle = filename.stripext() + ".pickle.gz"
     logging.debug("Retrieving articles for file %s", filename.basename())
     artdb = Shelf.open(rc.articles_home/rc.articledb,'r')
+    pmids = list(iofuncs.read_pmids(filename))
+    found = artdb.get_many(str(pmid) for pmid in pmids)
     articles = []
-    for pmid in iofuncs.read_pmids(filename):
+    for pmid in pmids:
         try:
-            articles.append(artdb[str(pmid)])
+            articles.append(found[str(pmid)])
         except KeyError:
             logging.debug("%d not found in database", pmid)
     logging.debug("Writing articles to pickle %s", pickle.basename())
@@ -93,9 +93,15 @@ class ResultsTable:
         
     def add_results(self, vmanager):
         """Add a row of results from L{CrossValidation}."""
-        mv = vmanager.metric_vectors
-        results = [vmanager.dataset, mv.AvPrec, mv.W, 
-                   vmanager.featinfo.stats.aggressivity, mv.breakeven]
+        self.add_row(vmanager.dataset, vmanager.featinfo, vmanager.metric_vectors)
+
+    def add_row(self, name, featinfo, mv):
+        """Add a row of results.
+        @param name: Title for the row.
+        @param featinfo: L{FeatureScores} used in the validation.
+        @param mv: L{PerformanceVectors} from the validation."""
+        results = [name, mv.AvPrec, mv.W, 
+                   featinfo.stats.aggressivity, mv.breakeven]
         fmt = "%s, %.3f, %.4f, %.3f, %.3f" + (", %.2f"*11) + "\n"
         self.stream.write(fmt % tuple(results + mv.precision_11))
         self.stream.flush()
@@ -231,6 +237,36 @@ def compare_featspace(*dslist):
             base_valid(s/ds/"ig20"/fs, ds, fspace, tab, df=0, ig=2e-5, skip=False)
 
 
+def sweep_featselection(*dslist):
+    """Different feature selection and smoothing settings, counting the 
+    features of each cross validation fold only once per data set."""
+    logging.info("SWEEPING FEATURE SELECTION AND SMOOTHING")
+    s = base / ("sweep_%d" % rc.randseed)
+    tab = ResultsTable(s/"results.txt", append=True)
+    for ds in dslist:
+        for fs in ["wmqia"]:
+            fspace, type_mask = spaces[fs]
+            configs = []
+            for method in ["bgfreq", "laplace_split", "laplace"]:
+                configs.append(dict(scoremethod="scores_"+method, 
+                    mincount=0, min_infogain=0, type_mask=type_mask))
+            for ig in [1e-6, 1e-5, 2e-5, 1e-4, 1e-3]:
+                configs.append(dict(mincount=0, min_infogain=ig, type_mask=type_mask))
+            for df in [1, 2, 3, 4, 8]:
+                configs.append(dict(mincount=df, min_infogain=0, type_mask=type_mask))
+            configs.append(dict(mincount=0, min_infogain=0, 
+                                positives_only=True, type_mask=type_mask))
+            if fspace not in fdata_cache:
+                fdata_cache[fspace] = FeatureData.Defaults(fspace)
+            fdata = fdata_cache[fspace]
+            pos, neg = get_dataset(ds, fdata)
+            op = CrossValidation(s/ds/fs, "_".join([ds,fs]), fdata)
+            for config, featinfo, mv in op.sweep(pos, neg, configs):
+                name = "_".join([ds, fs] + ["%s=%s" % (k,v) for k,v in 
+                    sorted(config.items()) if k != "type_mask"])
+                tab.add_row(name, featinfo, mv)
+
+
 def compare_wordextract(*dslist):
     """Compare ways of extracting word features"""
     logging.info("COMPARING WORD EXTRACTION")
@@ -31,11 +31,14 @@ def start_logger():
 def suite():
     modules = [
         "test_article",
+        "test_citations",
         "test_iofuncs",
         "test_medline",
+        "test_queue",
         "test_scoring",
         "test_shelf",
         "test_storage",
+        "test_timing",
         "test_validation"
         ]
     #del modules[4]
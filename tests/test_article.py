@@ -14,7 +14,7 @@ import logging
 import unittest
 
 from mscanner import tests
-from mscanner.medline.Article import Article
+from mscanner.medline.Article import Article, FeatureCache, Tokenizer
 
 
 class ArticleTests(unittest.TestCase):
@@ -68,6 +68,17 @@ class ArticleTests(unittest.TestCase):
         self.assertEqual(ft, 
         ['AAA1', 'AAA2-FFF2', 'JJJ1', 'TTT1'])
         logging.debug(str(ft))
+
+    def test_FeatureCache(self):
+        cache = FeatureCache(self.article)
+        mqi = cache("feats_mesh_qual_issn")
+        for space in ["feats_wmqia_filt", "feats_wmqia", "feats_mesh_qual_issn"]:
+            self.assertEqual(cache(space), getattr(self.article, space)())
+        # Component features are shared, and not modified by composites
+        self.assert_(cache("feats_wmqia")["mesh"] is mqi["mesh"])
+        self.assert_(cache("feats_wmqia")["w"] is cache("feats_word")["w"])
+        self.assertEqual(sorted(mqi.keys()), ["issn", "mesh", "qual"])
+        self.assertEqual(len(cache("feats_wmqia")["w"]), 6)
         
         
 class WordExtractionTests(unittest.TestCase):
@@ -106,6 +117,17 @@ class WordExtractionTests(unittest.TestCase):
             u'335-349', u':-Foc:', u'A/V-ATP', u'EU-Ses', u'M.G.T.', u'Neb\xf8',
             u'[ZC', u'ad].',  u'n=>3', u'qe--', u'st--foc'])
 
+    def test_Tokenizer(self):
+        tok = Tokenizer(["orth", "st"])
+        words = tok.words(self.article.text())
+        self.assertEqual(sorted(words), [u'2,3-zn(ncs)2', u'A-3.-b', u'Ad', u'EU-Ses', u'Foc',
+         u'M.G.T', u'Neb\xf8', u'ORF', u'Qe', u'RS', u'V-ATP', u'ZC'])
+        self.assert_(u"Zn" not in words)
+        other = Article(pmid=2, title="The cat's hat", abstract=None)
+        self.assertEqual(tok.tokenize_many([self.article, other], lowcase=True), 
+            [{"w":list(tok.words(self.article.text(), lowcase=True))},
+             {"w":list(tok.words(u"the cat hat", lowcase=True))}])
+
 
 if __name__ == "__main__":
     tests.start_logger()
@@ -0,0 +1,69 @@
+"""Test suite for mscanner.core.CitationTable
+
+
+
+@license: This source file is free software. It comes without any warranty, to
+the extent permitted by applicable law. You can redistribute it and/or modify
+it under the Do Whatever You Want Public License. Terms and conditions:
+   0. Do Whatever You Want
+"""
+
+from path import path
+import tempfile
+import unittest
+from zipfile import ZipFile
+
+from mscanner.core import CitationTable
+from mscanner.medline.Article import Article
+
+
+class CitationTableTests(unittest.TestCase):
+    """Tests of writing citation pages"""
+
+    def setUp(self):
+        self.home = path(tempfile.mkdtemp(prefix="citations-"))
+        self.citations = [
+            (float(10-i), Article(1000+i, title=None if i == 2 else u"T\xeftle %d" % i,
+                date_completed=(2001,2,3), issn="1234-5678", journal="J & J",
+                authors=[("A","Smith")], abstract="<abstract>"))
+            for i in range(7)]
+
+    def tearDown(self):
+        self.home.rmtree(ignore_errors=True)
+
+    def test_write_citations(self):
+        """Pages, the all-in-one file and its zip are written in one pass"""
+        fname = self.home/"results.html"
+        allfname = self.home/"all_results.html"
+        CitationTable.write_citations("output", "test", self.citations,
+                                      fname, 4, allfname)
+        names = [f.name for f in self.home.files()]
+        self.assertEqual(sorted(names), ["all_results.html",
+            "all_results.html.zip", "results.html", "results_02.html"])
+        allhtml = allfname.bytes()
+        for score, art in self.citations:
+            self.assert_('id="P%d"' % art.pmid in allhtml)
+        self.assert_("<td />" in allhtml) # Article without title
+        self.assert_("T\xc3\xaftle 1" in allhtml)
+        self.assert_("&lt;abstract&gt;" in allhtml)
+        self.assertEqual(fname.bytes().count('class="main"'), 4)
+        self.assertEqual((self.home/"results_02.html").bytes().count('class="main"'), 3)
+        zf = ZipFile(allfname + ".zip", "r")
+        try:
+            self.assertEqual(zf.namelist(), ["all_results.html"])
+            self.assertEqual(zf.testzip(), None)
+            self.assertEqual(zf.read("all_results.html"), allhtml)
+        finally:
+            zf.close()
+
+    def test_pages(self):
+        """Only the requested pages are written"""
+        fname = self.home/"results.html"
+        CitationTable.write_citations("output", "test", self.citations,
+                                      fname, 4, pages=[1])
+        self.assertEqual([f.name for f in self.home.files()], ["results_02.html"])
+
+
+
+if __name__ == "__main__":
+    unittest.main()
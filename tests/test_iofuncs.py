@@ -8,6 +8,7 @@ it under the Do Whatever You Want Public License. Terms and conditions:
    0. Do Whatever You Want
 """
 
+from __future__ import with_statement
 import logging
 import unittest
 from mscanner import tests
@@ -28,6 +29,27 @@ class IOTests(unittest.TestCase):
         pairs = list(iofuncs.read_scores(fn))
         self.assertEqual(pairs, allpairs)
 
+    @tests.usetempfile
+    def test_score_records(self, fn):
+        pairs = [(10.0,1), (30.0,3), (20.0,2)]
+        iofuncs.write_score_records(fn, pairs, sort=True)
+        records = iofuncs.read_score_records(fn)
+        self.assertEqual(list(records["pmid"]), [3,2,1])
+        self.assertEqual(list(records["score"]), [30.0,20.0,10.0])
+
+    @tests.usetempfile
+    def test_ZipEntryWriter(self, fn):
+        data = ["<html>", "abc"*1000, "</html>"]
+        with iofuncs.ZipEntryWriter(fn, "results.html") as zw:
+            for x in data:
+                zw.write(x)
+        from zipfile import ZipFile
+        zf = ZipFile(fn, "r")
+        self.assertEqual(zf.namelist(), ["results.html"])
+        self.assertEqual(zf.testzip(), None)
+        self.assertEqual(zf.read("results.html"), "".join(data))
+        zf.close()
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
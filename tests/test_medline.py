@@ -15,15 +15,19 @@ from cStringIO import StringIO
 import logging
 import numpy as nx
 from path import path
+from pysqlite2 import dbapi2 as sqlite3
 import tempfile
 import unittest
 
 from mscanner.configuration import rc
 from mscanner.medline.Article import Article
+from mscanner.medline.CitationSnippets import CitationSnippets
 from mscanner.medline.FeatureData import FeatureData
 from mscanner.medline.FeatureVectors import FeatureVectors, random_subset
-from mscanner.medline.FeatureStream import FeatureStream
-from mscanner.medline.FeatureMapping import FeatureMapping, MemoryFeatureMapping
+from mscanner.medline.FeatureStream import FeatureStream, \
+     vb_encode, vb_encode_many, vb_decode_many
+from mscanner.medline.FeatureMapping import FeatureMapping, \
+     HashedFeatureMapping, MemoryFeatureMapping
 from mscanner.medline.Updater import Updater
 from mscanner.scripts import update
 from mscanner import tests
@@ -86,6 +90,51 @@ class FeatureStreamTests(unittest.TestCase):
             for a, ra in zip(feats, rfeats):
                 self.assertEqual(a, ra)
 
+    def test_many(self):
+        """Variable byte coding of many vectors at once"""
+        feats = [[1,2,6,5484], [], [0,127,128,16383,16384,2**32-1], [5]]
+        values = nx.array(sum(feats, []))
+        indptr = nx.cumsum([0] + [len(x) for x in feats])
+        encoded = vb_encode_many(values, indptr)
+        self.assertEqual(encoded, [vb_encode(x) for x in feats])
+        rvalues, rindptr = vb_decode_many(encoded)
+        self.assertEqual(list(rvalues), list(values))
+        self.assertEqual(list(rindptr), list(indptr))
+
+
+
+class CitationSnippetsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.home = path(tempfile.mkdtemp(prefix="snippets-"))
+
+    def tearDown(self):
+        self.home.rmtree(ignore_errors=True)
+
+    def test(self):
+        """Write citation snippets, and read them back."""
+        a1 = Article(1, u"T1", u"A\xd81", "J1", "I1", (2000,6,29), 
+                     authors=[("F1","L1"),(None,"L2")])
+        a2 = Article(2, "T2", None, None, None, (2001,1,2))
+        a2b = Article(2, "T2b", "A2b", None, None, (2001,1,3))
+        sn = CitationSnippets(self.home/"s.index", self.home/"s.blob", rdonly=False)
+        self.assertEqual(sn.get_many(["1"]), {})
+        sn.add_articles([a1, a2])
+        sn.add_articles([a2b])
+        sn.close()
+        sn = CitationSnippets(self.home/"s.index", self.home/"s.blob")
+        self.assertEqual(len(sn), 2)
+        self.failUnless(1 in sn)
+        self.failIf(3 in sn)
+        found = sn.get_many(["2", "1", "3", "1"])
+        self.assertEqual(sorted(found.keys()), ["1","2"])
+        for art, correct in [(found["1"], a1), (found["2"], a2b)]:
+            for k in ["pmid", "title", "abstract", "journal", "issn", 
+                      "date_completed", "authors"]:
+                self.assertEqual(getattr(art, k), getattr(correct, k))
+        self.assertRaises(KeyError, sn.__getitem__, "3")
+        sn.close()
+
 
 
 class FeatureMappingTests(unittest.TestCase):
@@ -95,9 +144,12 @@ class FeatureMappingTests(unittest.TestCase):
         fm = FeatureMapping(filename=None)
         a1 = dict(Q=["A","B"], T=["A","C"])
         # Test adding of a feature vector
-        fm.add_article(a1)
+        self.assertEqual(fm.add_article(a1), [1,2,3,4])
         self.assertEqual(fm.make_vector(a1), [1,2,3,4])
         self.assertEqual([fm.get_feature(i) for i in [1,2,3,4]], [("A","Q"), ("B","Q"),("A","T"),("C","T")])
+        self.assertEqual(fm.get_features(nx.array([4,1,4])), [("C","T"),("A","Q"),("C","T")])
+        self.assertEqual(fm.get_features([3,2,1], chunk=2), [("A","T"),("B","Q"),("A","Q")])
+        self.assertRaises(KeyError, fm.get_features, [1,9])
         self.assert_(nx.all(fm.counts == [0,1,1,1,1]))
         self.assert_(nx.all(fm.type_mask("Q") == [0,1,1,0,0]))
         # Test read/write of unicode characters
@@ -116,14 +168,111 @@ class FeatureMappingTests(unittest.TestCase):
         #logging.debug(str(list(fm.con.execute("SELECT * FROM fmap"))))
         # Close database
         fm.con.close()
+
+
+    def test_types(self):
+        """FeatureMapping - persisted type codes"""
+        home = path(tempfile.mkdtemp(prefix="fmap-"))
+        try:
+            fm = FeatureMapping(home/"fmap.db")
+            fm.add_article(dict(Q=["A","B"], T=["A"]))
+            fm.close()
+            self.assertEqual((home/"fmap.db.types").size, 4+4)
+            fm = FeatureMapping(home/"fmap.db")
+            fm.add_article(dict(T=["C"]))
+            fm.add_article(dict(R=["A"]))
+            self.assert_(nx.all(fm.type_mask(["T","R"]) == [0,0,0,1,1,1]))
+            self.assert_(nx.all(fm.type_mask(["X"]) == [0,0,0,0,0,0]))
+            fm.remove_vector(fm.make_vector(dict(Q=["B"])))
+            fm.vacuum(1)
+            self.assert_(nx.all(fm.type_mask(["Q"]) == [1,0,0,0]))
+            fm.close()
+            fm = FeatureMapping(home/"fmap.db")
+            self.assert_(nx.all(fm.type_mask(["T"]) == [0,1,1,0]))
+            fm.close()
+        finally:
+            home.rmtree(ignore_errors=True)
         
         
+    def test_readers(self):
+        """FeatureMapping - reading does not lock out writers"""
+        home = path(tempfile.mkdtemp(prefix="fmap-"))
+        try:
+            fm = FeatureMapping(home/"fmap.db")
+            fm.add_article(dict(Q=["A"], T=["B"]))
+            fm.close()
+            # Forget the type codes, as in a map from before they existed
+            with closing(sqlite3.connect(home/"fmap.db")) as con:
+                con.execute("DELETE FROM ftypes WHERE code>0")
+                con.commit()
+            (home/"fmap.db.types").remove()
+            reader = FeatureMapping(home/"fmap.db")
+            self.assert_(nx.all(reader.type_mask(["T"]) == [0,0,1]))
+            with closing(sqlite3.connect(home/"fmap.db", timeout=0)) as con:
+                con.execute("UPDATE fmap SET count=5 WHERE id=1")
+                con.commit()
+            reader.con.close()
+        finally:
+            home.rmtree(ignore_errors=True)
+
+
+    def test_counts(self):
+        """FeatureMapping - persisted occurrence counts"""
+        home = path(tempfile.mkdtemp(prefix="fmap-"))
+        try:
+            fm = FeatureMapping(home/"fmap.db")
+            fm.add_article(dict(Q=["A","B"]))
+            for i in range(20):
+                fm.add_article(dict(Q=["B"], T=[str(i)]))
+            self.assertEqual(len(fm), 23)
+            self.assertEqual(list(fm.counts[:4]), [0,1,21,1])
+            fm.close()
+            # Counts are read from file
+            fm = FeatureMapping(home/"fmap.db")
+            self.assertEqual(fm.arrays_serial(), 1)
+            fm.con.execute("UPDATE fmap SET count=99 WHERE id=1")
+            self.assertEqual(list(fm.counts[:4]), [0,1,21,1])
+            fm.remove_vector([2])
+            fm.con.close()
+            # Uncommitted counts file is ignored
+            fm = FeatureMapping(home/"fmap.db")
+            self.assertEqual(list(fm.counts[:4]), [0,1,21,1])
+            fm.add_article(dict(Q=["A"]))
+            fm.commit()
+            fm.close()
+            fm = FeatureMapping(home/"fmap.db")
+            self.assertEqual(fm.arrays_serial(), 2)
+            self.assertEqual(list(fm.counts[:4]), [0,2,21,1])
+            fm.close()
+        finally:
+            home.rmtree(ignore_errors=True)
+
+
+    def test_reorder(self):
+        """FeatureMapping - renumber features by frequency"""
+        fm = FeatureMapping(filename=None)
+        fm.add_article(dict(Q=["A","B"], T=["A"]))
+        fm.add_article(dict(T=["A"], R=["A"]))
+        fm.add_article(dict(T=["A"], R=["A"]))
+        # Q/A, Q/B, T/A, R/A
+        self.assert_(nx.all(fm.counts == [0,1,1,3,2]))
+        self.assert_(nx.all(fm.reorder() == [0,3,4,1,2]))
+        self.assert_(nx.all(fm.counts == [0,3,2,1,1]))
+        self.assertEqual(fm.get_features([1,2,3,4]), 
+                         [("A","T"),("A","R"),("A","Q"),("B","Q")])
+        self.assert_(nx.all(fm.type_mask(["Q"]) == [0,0,0,1,1]))
+        self.assertEqual(fm.make_vector(dict(Q=["B"], T=["A"])), [1,4])
+        self.assertEqual(list(fm.con.execute("SELECT id,count FROM fmap")),
+                         [(0,0),(1,3),(2,2),(3,1),(4,1)])
+        fm.con.close()
+
+
     def testMemoryFeatureMapping(self):
         """MemoryFeatureMapping tests"""
         fm = MemoryFeatureMapping(filename=None)
         a1 = dict(Q=["A","B"], T=["A","C"])
         # Test adding of a feature vector
-        fm.add_article(a1)
+        self.assertEqual(fm.add_article(a1), [1,2,3,4])
         self.assertEqual(fm.make_vector(a1), [1,2,3,4])
         self.assertEqual([fm.get_feature(i) for i in [1,2,3,4]], [("A","Q"), ("B","Q"),("A","T"),("C","T")])
         self.assert_(nx.all(fm.counts == [0,1,1,1,1]))
@@ -138,6 +287,51 @@ class FeatureMappingTests(unittest.TestCase):
         self.assertEqual(fm.make_vector(a2), [2,5])
 
 
+    def testHashedFeatureMapping(self):
+        """HashedFeatureMapping - fixed feature IDs from hashing"""
+        home = path(tempfile.mkdtemp(prefix="fmap-"))
+        try:
+            fm = HashedFeatureMapping(home/"fmap.db", bits=8)
+            self.assertEqual(len(fm), 256)
+            a1 = dict(Q=["A","B"], T=["A", u"D\xd8"])
+            vector = fm.add_article(a1)
+            self.assertEqual(vector, sorted(set(vector)))
+            self.assertEqual(fm.make_vector(a1), vector)
+            self.assert_(0 not in vector)
+            fid = fm.feature_id("T", u"D\xd8")
+            self.assertEqual(fm.get_feature(fid), (u"D\xd8", "T"))
+            self.assertEqual(fm.counts.sum(), len(vector))
+            self.assertEqual(fm.type_mask(["T"])[fid], True)
+            fm.add_article(dict(Q=["A"]))
+            self.assertEqual(fm.counts[fm.feature_id("Q","A")], 2)
+            fm.remove_vector([fid])
+            self.assertEqual(fm.counts[fid], 0)
+            self.assertRaises(NotImplementedError, fm.vacuum, 1)
+            fm.close()
+            # Same IDs and counts after reopening
+            fm = HashedFeatureMapping(home/"fmap.db", bits=8)
+            self.assertEqual(fm.make_vector(a1), vector)
+            self.assertEqual(fm.counts[fm.feature_id("Q","A")], 2)
+            self.assertEqual(fm.type_mask(["T"])[fid], True)
+            fm.close()
+            self.assertRaises(ValueError, HashedFeatureMapping, home/"fmap.db", 9)
+            # Counts are not silently reset when the file is lost
+            (home/"fmap.db.counts").remove()
+            fm = HashedFeatureMapping(home/"fmap.db", bits=8)
+            self.assertRaises(ValueError, getattr, fm, "counts")
+            fm.close()
+        finally:
+            home.rmtree(ignore_errors=True)
+        # Collision statistics
+        fm = HashedFeatureMapping(None, bits=12)
+        for i in range(2000):
+            fm.add_article(dict(w=[str(i)]))
+        stats = fm.collision_stats()
+        self.assertEqual(stats["used"], (fm.counts > 0).sum())
+        self.assert_(1800 < stats["features"] < 2200)
+        self.assertAlmostEqual(stats["collisions"], stats["features"]-stats["used"])
+
+
 
 class XMLParserTests(unittest.TestCase):
 
@@ -204,6 +398,118 @@ class FeatureDataTests(unittest.TestCase):
         #logging.debug(str(list(fd.featmap.con.execute("SELECT * FROM fmap"))))
         fd.close()
 
+    def test_regenerate(self):
+        """Bulk regeneration matches adding articles one at a time"""
+        articles = dict((str(pmid), Article(pmid, date_completed=(1990,01,01), 
+            meshterms=[(str(pmid%7),str(pmid%3)),(str(pmid%5),)], issn=str(pmid%2)))
+            for pmid in range(1000,1100))
+        fd = FeatureData.Defaults("feats_mesh_qual_issn", False)
+        fd.add_articles(articles.itervalues(), check=False)
+        stream = fd.fstream.filename.bytes()
+        rows = list(fd.featmap.con.execute("SELECT * FROM fmap"))
+        counts = fd.featmap.counts.copy()
+        fd.close()
+        for nprocs in [1, 2]:
+            for fname in fd.featmap.filename.dirname().files():
+                fname.remove()
+            fd = FeatureData.Defaults("feats_mesh_qual_issn", False)
+            fd.regenerate(articles, nprocs)
+            self.assertEqual(fd.fstream.filename.bytes(), stream)
+            self.assertEqual(list(fd.featmap.con.execute("SELECT * FROM fmap")), rows)
+            self.assert_(nx.all(fd.featmap.counts == counts))
+            self.assertEqual(len(fd.featuredb), 100)
+            self.assertEqual(list(fd.featuredb.iteritems())[:3], 
+                             list(sorted(fd.fstream.iteritems()))[:3])
+            fd.close()
+
+    def test_reconnect(self):
+        """Reconnecting keeps the cached arrays and can still read records"""
+        articles = [Article(333,date_completed=(1990,01,01),meshterms=[("A","B"),"C"])]
+        fd = FeatureData.Defaults("feats_mesh_qual_issn", False)
+        fd.add_articles(articles)
+        fd.featuredb.commit()
+        fd.featmap.commit()
+        pmids, counts = fd.featuredb.pmids_array(), fd.featmap.counts
+        fd.reconnect()
+        self.assert_(fd.featuredb.pmids_array() is pmids)
+        self.assert_(fd.featmap.counts is counts)
+        self.assertEqual([pmid for pmid, date, vec in fd.featuredb.get_records([333])], [333])
+        self.assertEqual(fd.featmap.get_feature(1), ("B", "qual"))
+        fd.close()
+
+    def test_hashed(self):
+        """FeatureData with hashed feature IDs"""
+        articles = dict((str(pmid), Article(pmid, date_completed=(1990,01,01), 
+            meshterms=[(str(pmid%7),str(pmid%3)),(str(pmid%5),)], issn=str(pmid%2)))
+            for pmid in range(1000,1100))
+        rc.feature_hash_bits = {"feats_mesh_qual_issn":16}
+        try:
+            fd = FeatureData.Defaults("feats_mesh_qual_issn", False)
+            fd.add_articles(articles.itervalues(), check=False)
+            stream = fd.fstream.filename.bytes()
+            counts = fd.featmap.counts.copy()
+            self.assertEqual(len(counts), 2**16)
+            fd.close()
+            for fname in fd.featmap.filename.dirname().files():
+                fname.remove()
+            fd = FeatureData.Defaults("feats_mesh_qual_issn", False)
+            fd.regenerate(articles, 2)
+            self.assertEqual(fd.fstream.filename.bytes(), stream)
+            self.assert_(nx.all(fd.featmap.counts == counts))
+            self.assertEqual(len(fd.featuredb), 100)
+            self.assertRaises(NotImplementedError, fd.reorder)
+            fd.close()
+            # Lost counts are rebuilt from the feature vectors by writers
+            fd.featmap.countfile.remove()
+            fd = FeatureData.Defaults("feats_mesh_qual_issn", True)
+            self.assertRaises(ValueError, getattr, fd.featmap, "counts")
+            fd.close()
+            fd = FeatureData.Defaults("feats_mesh_qual_issn", False)
+            self.assert_(nx.all(fd.featmap.counts == counts))
+            fd.close()
+            fd = FeatureData.Defaults("feats_mesh_qual_issn", True)
+            self.assert_(nx.all(fd.featmap.counts == counts))
+            fd.close()
+        finally:
+            rc.feature_hash_bits = {}
+
+    def test_reorder(self):
+        """Renumbering features of FeatureData by frequency"""
+        articles = [
+            Article(333,date_completed=(1990,01,01),meshterms=[("A",),("C",)]),
+            Article(444,date_completed=(1990,01,01),meshterms=[("B",),("C",)]),
+            Article(555,date_completed=(1990,01,01),meshterms=[("B",),("C",)]),
+            ]
+        fd = FeatureData.Defaults("feats_mesh_qual_issn", False)
+        fd.add_articles(articles)
+        self.assert_(nx.all(fd.featmap.counts == [0,1,3,2]))
+        fd.reorder()
+        self.assert_(nx.all(fd.featmap.counts == [0,3,2,1]))
+        correct = [(333, 19900101, [1,3]), (444, 19900101, [1,2]), 
+                   (555, 19900101, [1,2])]
+        self.assertEqual(list(fd.featuredb.get_records([333,444,555])), correct)
+        self.assertEqual(list(fd.fstream.iteritems()), correct)
+        fd.close()
+        # Interrupted replacement is completed on opening
+        fd = FeatureData.Defaults("feats_mesh_qual_issn", False)
+        fd.reorder()
+        fd.close()
+        fstream = fd.fstream.filename
+        fstream.rename(fstream + ".new")
+        fstream.touch()
+        fd.manifest.write_text("%s\t%s\n%s\t%s\n" % (
+            fstream+".new", fstream, fd.featmap.filename+".new", fd.featmap.filename))
+        # Readers use the new files without renaming them
+        fd = FeatureData.Defaults("feats_mesh_qual_issn", True)
+        self.assert_(fd.manifest.exists())
+        self.assertEqual(list(fd.fstream.iteritems()), correct)
+        fd.close()
+        fd = FeatureData.Defaults("feats_mesh_qual_issn", False)
+        self.failIf(fd.manifest.exists())
+        self.assertEqual(list(fd.fstream.iteritems()), correct)
+        self.assert_(nx.all(fd.featmap.counts == [0,3,2,1]))
+        fd.close()
+
 
 class UpdaterTests(unittest.TestCase):
     """Tests L{Updater}"""
@@ -0,0 +1,300 @@
+"""Test suite for mscanner.htdocs.queue
+
+
+
+@license: This source file is free software. It comes without any warranty, to
+the extent permitted by applicable law. You can redistribute it and/or modify
+it under the Do Whatever You Want Public License. Terms and conditions:
+   0. Do Whatever You Want
+"""
+
+from path import path
+import tempfile
+import time
+import unittest
+
+from mscanner.configuration import rc
+from mscanner.core.Storage import Storage
+from mscanner.htdocs import queue
+
+
+def make_task(dataset, operation="retrieval", numnegs=1000, submitter="a",
+              submitted=None):
+    """Descriptor of a task with the given parameters"""
+    return Storage(
+        allfeatures = False,
+        dataset = dataset,
+        limit = 500,
+        mindate = 19700101,
+        minscore = 0.0,
+        numnegs = numnegs,
+        operation = operation,
+        submitted = time.time() if submitted is None else submitted,
+        submitter = submitter)
+
+
+
+class ScheduleTests(unittest.TestCase):
+    """Tests of the choice of the next task to start"""
+
+    def setUp(self):
+        rc.queue_workers = 2
+        rc.queue_heavy_numnegs = 50000
+        rc.queue_max_heavy = 1
+        rc.queue_max_wait = 900
+        self.now = time.time()
+
+    def names(self, tasks):
+        return [t.dataset for t in tasks]
+
+    def test_workers(self):
+        """No task starts while every worker is busy"""
+        running = [make_task("r1"), make_task("r2")]
+        self.assertEqual(queue.schedule([make_task("w")], running, self.now), None)
+        self.assertEqual(queue.schedule([], [], self.now), None)
+
+    def test_size(self):
+        """Retrievals before validations, and smaller validations first"""
+        waiting = [
+            make_task("big", "validate", 90000, submitted=self.now-30),
+            make_task("small", "validate", 100, submitted=self.now-20),
+            make_task("query", "retrieval", submitted=self.now-10)]
+        order = []
+        while waiting:
+            task = queue.schedule(waiting, [], self.now)
+            order.append(task.dataset)
+            waiting.remove(task)
+        self.assertEqual(order, ["query", "small", "big"])
+
+    def test_fairness(self):
+        """Submitters with fewer running tasks go first"""
+        running = [make_task("a1", submitter="a")]
+        waiting = [make_task("a2", submitter="a", submitted=self.now-20),
+                   make_task("b1", submitter="b", submitted=self.now-10)]
+        self.assertEqual(queue.schedule(waiting, running, self.now).dataset, "b1")
+        self.assertEqual(queue.schedule(waiting, [], self.now).dataset, "a2")
+
+    def test_heavy(self):
+        """Memory-heavy validations are capped"""
+        heavy = make_task("heavy", "validate", 50000)
+        self.assert_(queue.heavy_task(heavy))
+        self.failIf(queue.heavy_task(make_task("light", "validate", 49999)))
+        self.failIf(queue.heavy_task(make_task("query", "retrieval", 100000)))
+        running = [make_task("running", "validate", 60000)]
+        self.assertEqual(queue.schedule([heavy], running, self.now), None)
+        light = make_task("light", "validate", 100, submitted=self.now+1)
+        self.assertEqual(queue.schedule([heavy, light], running, self.now).dataset, "light")
+        rc.queue_max_heavy = 2
+        self.assertEqual(queue.schedule([heavy], running, self.now).dataset, "heavy")
+
+    def test_max_wait(self):
+        """Tasks waiting too long go first, oldest first"""
+        waiting = [
+            make_task("query", "retrieval", submitter="b", submitted=self.now-10),
+            make_task("old", "validate", 90000, submitted=self.now-1000),
+            make_task("older", "validate", 90000, submitted=self.now-2000)]
+        running = [make_task("a1", submitter="a")]
+        self.assertEqual(queue.schedule(waiting, running, self.now).dataset, "older")
+        rc.queue_max_wait = 3000
+        self.assertEqual(queue.schedule(waiting, running, self.now).dataset, "query")
+
+
+
+class TaskIndexTests(unittest.TestCase):
+    """Tests of the index of task states"""
+
+    def setUp(self):
+        self.home = path(tempfile.mkdtemp(prefix="queue-"))
+        rc.queue_path = self.home / "queue"
+        rc.web_report_dir = self.home / "output"
+        rc.queue_index = self.home / "queue_index.db"
+        rc.queue_path.mkdir()
+        rc.web_report_dir.mkdir()
+        self.index = queue.TaskIndex()
+
+    def tearDown(self):
+        self.index.close()
+        self.home.rmtree(ignore_errors=True)
+
+    def queued(self, dataset, **kwargs):
+        """Write a descriptor to the queue directory"""
+        queue.write_descriptor(rc.queue_path/dataset, [1,2], 
+                               make_task(dataset, **kwargs))
+
+    def done(self, dataset):
+        """Write a descriptor to the output directory"""
+        (rc.web_report_dir/dataset).mkdir()
+        queue.write_descriptor(rc.web_report_dir/dataset/rc.report_descriptor, 
+                               [1,2], make_task(dataset))
+
+    def names(self, *statuses):
+        return [t.dataset for t in self.index.tasks(*statuses)]
+
+    def test_rebuild(self):
+        """Rebuilding reads the queue and output directories"""
+        self.queued("w", submitted=2)
+        self.queued("both", submitted=3)
+        self.done("both")
+        self.done("d")
+        (rc.queue_path/".partial").touch()
+        self.failIf(self.index.built)
+        self.index.rebuild()
+        self.assert_(self.index.built)
+        self.assertEqual(self.names(queue.QueueStatus.WAITING), ["w"])
+        self.assertEqual(sorted(self.names(queue.QueueStatus.DONE)), ["both", "d"])
+        task = self.index.tasks(queue.QueueStatus.WAITING)[0]
+        self.assertEqual(task, queue.read_descriptor(rc.queue_path/"w"))
+        self.assertEqual(task._filename, rc.queue_path/"w")
+
+    def test_sync_queue(self):
+        """Syncing picks up tasks added to and removed from the queue"""
+        self.index.rebuild()
+        self.queued("a")
+        self.queued("b")
+        self.queued("c")
+        (rc.queue_path/".partial").touch()
+        self.assertEqual(self.index.sync_queue(), 3)
+        self.assertEqual(self.index.sync_queue(), 0)
+        self.index.set_status("c", queue.QueueStatus.RUNNING, time.time())
+        # Moved to output, removed, and running (left to the queue)
+        (rc.queue_path/"a").remove()
+        self.done("a")
+        (rc.queue_path/"b").remove()
+        (rc.queue_path/"c").remove()
+        self.assertEqual(self.index.sync_queue(), 2)
+        self.assertEqual(self.names(queue.QueueStatus.DONE), ["a"])
+        self.assertEqual(self.names(queue.QueueStatus.WAITING), [])
+        self.assertEqual(self.names(queue.QueueStatus.RUNNING), ["c"])
+
+    def test_task_finished(self):
+        """Finished tasks are done if moved to the output, else failed"""
+        self.queued("ok")
+        self.queued("failed")
+        self.index.rebuild()
+        for name in ["ok", "failed"]:
+            self.index.set_status(name, queue.QueueStatus.RUNNING, time.time())
+        (rc.queue_path/"ok").remove()
+        self.done("ok")
+        self.index.task_finished("ok")
+        self.index.task_finished("failed")
+        self.assertEqual(self.names(queue.QueueStatus.DONE), ["ok"])
+        self.assertEqual(self.names(queue.QueueStatus.FAILED), ["failed"])
+        self.assertEqual(self.index.tasks(queue.QueueStatus.DONE)[0]._filename,
+                         rc.web_report_dir/"ok"/rc.report_descriptor)
+        # Failed tasks are not re-added by syncing, but are by rebuilding
+        self.assertEqual(self.index.sync_queue(), 0)
+        status = queue.QueueStatus()
+        self.assertEqual(status.status["failed"], status.FAILED)
+        self.assertEqual(status.waitlist, [])
+        self.assertEqual(status.position("failed"), None)
+        self.index.rebuild()
+        self.assertEqual(self.names(queue.QueueStatus.WAITING), ["failed"])
+        # Failed tasks are removed by syncing when cancelled
+        self.index.task_finished("failed")
+        (rc.queue_path/"failed").remove()
+        self.assertEqual(self.index.sync_queue(), 1)
+        self.assertEqual(self.names(queue.QueueStatus.FAILED), [])
+
+    def test_submit(self):
+        """Submitted tasks are indexed, and stay running once started"""
+        self.index.rebuild()
+        # The task must be indexed before the queue can see its descriptor
+        seen = []
+        put = queue.TaskIndex.put
+        def checked_put(index, task, status, started=None):
+            seen.append((rc.queue_path/task.dataset).exists())
+            put(index, task, status, started)
+        queue.TaskIndex.put = checked_put
+        try:
+            queue.submit_task([1,2], make_task("s", submitted=5))
+        finally:
+            queue.TaskIndex.put = put
+        self.assertEqual(seen, [False])
+        self.assertEqual([f.name for f in rc.queue_path.files()], ["s"])
+        status = queue.QueueStatus()
+        self.assertEqual(status.status["s"], status.WAITING)
+        self.assertEqual(status["s"]._filename, rc.queue_path/"s")
+        self.index.sync_queue()
+        self.index.set_status("s", queue.QueueStatus.RUNNING, time.time())
+        self.index.sync_queue()
+        status = queue.QueueStatus()
+        self.assertEqual([t.dataset for t in status.runlist], ["s"])
+        self.assertEqual(status.waitlist, [])
+        # Cancelling removes the index row while the descriptor still exists
+        remove = queue.TaskIndex.remove
+        def checked_remove(index, dataset):
+            seen.append((rc.queue_path/dataset).exists())
+            remove(index, dataset)
+        queue.TaskIndex.remove = checked_remove
+        try:
+            queue.cancel_task("s")
+        finally:
+            queue.TaskIndex.remove = remove
+        self.assertEqual(seen, [False, True])
+        self.failIf((rc.queue_path/"s").exists())
+        self.failIf("s" in queue.QueueStatus())
+
+    def test_permissions(self):
+        """A new index is writable by the other user (web server or queue)"""
+        self.assertEqual(rc.queue_index.stat().st_mode & 0777, 0666)
+
+    def test_status(self):
+        """QueueStatus builds the index on first use"""
+        self.queued("w")
+        self.done("d")
+        status = queue.QueueStatus()
+        self.assertEqual(status.status, {"w":status.WAITING, "d":status.DONE})
+        self.assertEqual(status.running, None)
+        self.assertEqual(status.position("w"), 0)
+        self.assertEqual(queue.QueueStatus(with_done=False).donelist, [])
+
+
+
+class QueueMetricsTests(unittest.TestCase):
+    """Tests of the queue statistics"""
+
+    def test_task_done(self):
+        """Latency is only of completed tasks, and failures are counted"""
+        rc.queue_min_scan_rate = 0
+        metrics = queue.QueueMetrics()
+        now = time.time()
+        task = make_task("a", submitted=now-30)
+        metrics.task_done(task, now-20, None)
+        metrics.task_done(task, now-1000, None, failed=True)
+        metrics.task_done(make_task("v", "validate", submitted=now-5), 
+                          now-2, None, failed=True)
+        self.assertEqual(metrics.tasks, {"retrieval":1})
+        self.assertEqual(metrics.failed, {"retrieval":1, "validate":1})
+        self.assertEqual(metrics.wait.as_dict()["count"], 3)
+        latency = metrics.latency["retrieval"].as_dict()
+        self.assertEqual(latency["count"], 1)
+        self.assert_(20 <= latency["mean"] < 25)
+        self.failIf("validate" in metrics.latency)
+
+
+
+class QueueWatcherTests(unittest.TestCase):
+    """Tests of waking up when the queue directory changes"""
+
+    def setUp(self):
+        self.home = path(tempfile.mkdtemp(prefix="watch-"))
+        self.watcher = queue.QueueWatcher(self.home)
+
+    def tearDown(self):
+        self.watcher.close()
+        self.home.rmtree(ignore_errors=True)
+
+    def test(self):
+        (self.home/"a").write_text("x")
+        self.assert_(self.watcher.wait(1))
+        if self.watcher.fd is not None:
+            self.failIf(self.watcher.wait(0.01))
+            (self.home/"a").rename(self.home/"b")
+            start = time.time()
+            self.assert_(self.watcher.wait(5))
+            self.assert_(time.time() - start < 1)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -108,6 +108,15 @@ class CScoreModuleTests(unittest.TestCase):
         scores_pipe = nx.array([score for score,pmid in out_pipe])
         scores_py = nx.array([score for score,pmid in out_pyscore])
         self.assert_(nx.allclose(scores_pipe, scores_py))
+        # Compare sparse scores with dense scores
+        ids = nx.flatnonzero(featscores)
+        scorer.featscores = (ids, featscores[ids])
+        out_sparse = scorer.cscore_pipe()
+        self.assertEqual(out_sparse, out_pipe)
+        self.assertEqual(scorer.pyscore(), out_pyscore)
+        # Sparse feature IDs need not be given in order
+        scorer.featscores = (ids[::-1], featscores[ids][::-1])
+        self.assertEqual(scorer.cscore_pipe(), out_pipe)
         # Compare pyscore and cscore_dll 
         """
         try: 
@@ -161,6 +170,19 @@ class FeatureScoresTests(unittest.TestCase):
         s.assert_(nx.allclose(f.tfidf, correct_tfidf))
 
 
+    def test_top_features(s):
+        """Top-N features match heapq.nlargest ordering."""
+        from heapq import nlargest
+        from itertools import izip
+        f = FeatureScores(s.featmap, "scores_laplace_split")
+        f.features = nx.arange(2, 202)
+        values = nx.random.randint(0, 20, 200).astype(nx.float32)
+        for n in [0, 1, 7, 50, 200, 500]:
+            ids, best = f.top_features(values, n)
+            correct = nlargest(n, izip(values, f.features))
+            s.assertEqual(zip(best, ids), correct)
+
+
     def test_InformationGain(s):
         """Calculation of Information Gain."""
         rc.min_infogain = 0.001
@@ -191,6 +213,72 @@ class FeatureScoresTests(unittest.TestCase):
         logging.debug("N counts: %s", pp.pformat(s.nfreqs))
     
 
+    def test_options(s):
+        """Feature selection options override rc when given."""
+        rc.mincount = 0
+        rc.min_infogain = 0
+        rc.positives_only = False
+        f = FeatureScores(s.featmap, "scores_laplace_split")
+        f.update(s.pfreqs, s.nfreqs, s.pdocs, s.ndocs)
+        s.assertEqual(len(f.features), len(s.featmap))
+        f = FeatureScores(s.featmap, "scores_laplace_split", mincount=3)
+        f.update(s.pfreqs, s.nfreqs, s.pdocs, s.ndocs)
+        s.assertEqual(f.option("mincount"), 3)
+        s.assertEqual(f.option("min_infogain"), 0)
+        s.assert_(nx.all(f.pos_counts[f.features] + f.neg_counts[f.features] >= 3))
+        s.assert_(len(f.features) < len(s.featmap))
+        f = FeatureScores(s.featmap, "scores_laplace_split", positives_only=True)
+        f.update(s.pfreqs, s.nfreqs, s.pdocs, s.ndocs)
+        s.assert_(nx.all(f.pos_counts[f.features] > 0))
+        ids, values = f.sparse_scores()
+        dense = nx.zeros(len(f.scores), nx.float32)
+        dense[ids] = values
+        s.assert_(nx.all(dense == f.scores))
+    
+
+    def test_repeated_updates(s):
+        """Updating the same instance gives the same results as a new one,
+        and leaves the arrays from earlier updates alone."""
+        rc.mincount = 0
+        rc.min_infogain = 0.001
+        rc.positives_only = False
+        rc.type_mask = []
+        nx.random.seed(0)
+        counts = [(nx.random.randint(0, 3, len(s.featmap)),
+                   nx.random.randint(0, 3, len(s.featmap))) for i in range(3)]
+        f = FeatureScores(s.featmap, "scores_laplace_split")
+        kept = []
+        for pos_counts, neg_counts in counts:
+            f.update(pos_counts, neg_counts, 3, 3)
+            kept.append((f.scores, f.selected, f.feats_infogain))
+        for (pos_counts, neg_counts), arrays in zip(counts, kept):
+            fresh = FeatureScores(s.featmap, "scores_laplace_split")
+            fresh.update(pos_counts, neg_counts, 3, 3)
+            for kept_array, fresh_array in zip(
+                arrays, (fresh.scores, fresh.selected, fresh.feats_infogain)):
+                s.assert_(nx.all(kept_array == fresh_array))
+
+
+    def test_selected_arrays(s):
+        """Information gain in blocks and scores looked up by feature ID give
+        the same results as the full-length arrays."""
+        rc.mincount = 0
+        rc.min_infogain = 0.001
+        rc.positives_only = False
+        rc.type_mask = []
+        f = FeatureScores(s.featmap, "scores_laplace_split")
+        f.update(s.pfreqs, s.nfreqs, s.pdocs, s.ndocs)
+        IG = f.infogain()
+        f.infogain_block = 4
+        s.assert_(nx.all(f.infogain() == IG))
+        s.assert_(nx.all(f.infogain(f.features) == f.feats_infogain))
+        s.assert_(nx.all(f.feats_infogain == IG[f.features]))
+        s.assert_(nx.all(f.scores[f.features] == f.scores_selected))
+        docs = [s.featdb[i] for i in sorted(s.featdb)]
+        dense = [f.base + f.prior + nx.sum(f.scores[d]) for d in docs]
+        s.assert_(nx.allclose(f.scores_of(docs), dense))
+
+
     def _scoremethodtester(s, scoremethod, answer):
         """Test a score calculation method"""
         rc.mincount = 1
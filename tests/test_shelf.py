@@ -36,12 +36,29 @@ class DbshelveTests(unittest.TestCase):
         self.assertEqual(list(d.iterkeys()), ["B","A"])
         self.assertEqual(list(d.iteritems()), [ ("B",("B",3)), ("A",("A",2)),  ])
         self.assertEqual(list(d.itervalues()), [ ("B",3) , ("A",2), ])
+        self.assertEqual(d.get_many(["A","B","A","C"]), 
+                         {"A":("A",2), "B":("B",3)})
         del d["B"]
         self.assertRaises(KeyError, d.__getitem__, "B")
         self.assertRaises(KeyError, d.__delitem__, "B")
 
 
 
+class BTreeTests(unittest.TestCase):
+    """Test for a BTree-backed L{Shelf}"""
+
+    def test(self):
+        d = Shelf.open(None, btree=True)
+        keys = ["%03d" % x for x in [5,2,9,7,1,3,8,6,4,0]]
+        for key in keys:
+            d[key] = int(key)
+        self.assertEqual(d.keys(), sorted(keys))
+        # Threaded decompression and missing keys
+        self.assertEqual(d.get_many(keys + ["999"], nthreads=3),
+                         dict((k, int(k)) for k in keys))
+
+
+
 class TransactionTests(DbshelveTests):
     """Test using transactions with L{Shelf}"""
 
@@ -0,0 +1,48 @@
+"""Test suite for mscanner.core.timing
+
+                               
+
+@license: This source file is free software. It comes without any warranty, to
+the extent permitted by applicable law. You can redistribute it and/or modify
+it under the Do Whatever You Want Public License. Terms and conditions: 
+   0. Do Whatever You Want
+"""
+
+from __future__ import with_statement
+import unittest
+
+from mscanner.core.timing import Timings, aggregate, load_timings
+from mscanner import tests
+
+
+class TimingsTests(unittest.TestCase):
+
+    @tests.usetempfile
+    def test_Timings(self, tmpfile):
+        t = Timings()
+        with t.span("query"):
+            with t.span("load"):
+                t.count("pmids", 5)
+            with t.span("load"):
+                t.count("pmids")
+        try:
+            with t.span("fail"):
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual([s["name"] for s in t.spans], 
+                         ["query/load", "query/load", "query", "fail"])
+        self.assertEqual(t.counters, {"pmids":6})
+        self.assertEqual(sorted(t.totals().keys()), ["fail", "query", "query/load"])
+        t.save(tmpfile)
+        saved = load_timings(tmpfile)
+        self.assertEqual(saved["counters"], {"pmids":6})
+        self.assertEqual(len(saved["spans"]), 4)
+        summary = aggregate([saved, saved, dict(seconds=1.0, totals={"fail":2.0})])
+        self.assertEqual(summary["*"]["count"], 3)
+        self.assertEqual(summary["query"]["count"], 2)
+        self.assertEqual(summary["fail"]["max"], 2.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -17,7 +17,8 @@ import unittest
 
 from mscanner.configuration import rc
 from mscanner.core.FeatureScores import FeatureScores
-from mscanner.core.Validator import cross_validate, make_partitions, count_features
+from mscanner.core.Validator import cross_validate, make_partitions, \
+     count_features, make_folds, PackedVectors
 from mscanner.core.metrics import PerformanceVectors
 from mscanner import tests
 
@@ -35,6 +36,84 @@ class PerformanceVectorsTests(unittest.TestCase):
         logging.debug("PerformanceVectors: %s", pp.pformat(p.__dict__))
 
 
+    def test_against_loops(self):
+        """Compare vectorised metrics with the original loop versions"""
+        nx.random.seed(0)
+        for P, N in [(7,7), (50,1000), (1,5), (100,3)]:
+            # Rounding the scores gives many ties
+            pscores = nx.round_(nx.random.normal(1,1,P), 1).astype(nx.float32)
+            nscores = nx.round_(nx.random.normal(-1,1,N), 1).astype(nx.float32)
+            p = PerformanceVectors(pscores, nscores, alpha=0.5)
+            TP, TN, FP, FN, PE, NE = confusion_loop(p.pscores, p.nscores, p.uscores)
+            for name, vec in [("TP",TP), ("TN",TN), ("FP",FP), 
+                              ("FN",FN), ("PE",PE), ("NE",NE)]:
+                self.assert_(nx.all(getattr(p,name) == vec), name)
+            self.assertAlmostEqual(p.AvPrec, averaged_precision_loop(
+                p.pscores, p.nscores), 6)
+            self.assert_(nx.allclose(p.precision_11, 
+                         precision_11_loop(p.TPR, p.PPV)))
+            scores, relevant = p._mergescores()
+            self.assert_(nx.all(scores[:-1] >= scores[1:]))
+            self.assertEqual(relevant.sum(), P)
+
+
+
+def confusion_loop(pscores, nscores, uscores):
+    """Original loop calculation of PerformanceVectors._confusion_vectors"""
+    P, N, vlen = len(pscores), len(nscores), len(uscores)
+    result = [nx.zeros(vlen, nx.float32) for i in range(6)]
+    vTP, vTN, vFP, vFN, vPE, vNE = result
+    TN = 0
+    FN = 0
+    for idx, threshold in enumerate(uscores):
+        while (FN < P) and (pscores[FN] < threshold):
+            FN += 1
+        pcount = FN
+        while (pcount < P) and pscores[pcount] == threshold:
+            pcount += 1
+        vPE[idx] = pcount-FN
+        while (TN < N) and (nscores[TN] < threshold):
+            TN += 1
+        ncount = TN
+        while (ncount < N) and nscores[ncount] == threshold:
+            ncount += 1
+        vNE[idx] = ncount-TN
+        vTP[idx] = P - FN
+        vTN[idx] = TN
+        vFP[idx] = N - TN
+        vFN[idx] = FN
+    return result
+
+
+def averaged_precision_loop(pscores, nscores):
+    """Original loop calculation of PerformanceVectors._averaged_precision"""
+    merged = [(s,1) for s in pscores] + [(s,0) for s in nscores]
+    merged.sort(reverse=True)
+    AvPrec, TP, FP = 0.0, 0, 0
+    for score, relevant in merged:
+        if relevant:
+            TP += 1
+            AvPrec += TP/float(TP+FP)
+        else:
+            FP += 1
+    return AvPrec/TP
+
+
+def precision_11_loop(TPR, PPV):
+    """Original loop calculation of PerformanceVectors.precision_11"""
+    precision_11 = [0] * 11
+    idx = 0
+    curprec = 0
+    for i, recall in enumerate(nx.linspace(1,0,11)):
+        while idx < len(TPR) and TPR[idx] >= recall:
+            if PPV[idx] > curprec:
+                curprec = PPV[idx]
+            idx += 1
+        precision_11[i] = curprec
+    precision_11.reverse()
+    return precision_11
+
+
 class ValidatorTests(unittest.TestCase):
 
 
@@ -55,6 +134,19 @@ class ValidatorTests(unittest.TestCase):
         self.assert_(nx.all(counts == [0,1,2,2,1]))
 
 
+    def test_PackedVectors(self):
+        """Count features and score documents in ranges of packed vectors"""
+        features = [[1,2], [], [2,3], [3,4]]
+        packed = PackedVectors(nx.array(f, nx.uint32) for f in features)
+        self.assertEqual(len(packed), 4)
+        self.assert_(nx.all(packed.counts(6) == [0,1,2,2,1,0]))
+        self.assert_(nx.all(packed.counts(6, 1, 3) == [0,0,1,1,0,0]))
+        featscores = nx.array([0,1,2,4,8,16], nx.float32)
+        self.assert_(nx.all(packed.scores(featscores) == [3,0,6,12]))
+        self.assert_(nx.all(packed.scores(featscores, 1, 3) == [0,6]))
+        self.assert_(nx.all(packed.scores(featscores, 2, 2) == []))
+
+
     def _check_scores(self, featinfo, cpscores, cnscores):
         positives = [ [1,2,3], [1,3], [1,3], [1,3] ]
         negatives = [ [1,2], [1,2], [1,2], [1,2,3] ]
@@ -67,6 +159,59 @@ class ValidatorTests(unittest.TestCase):
         self.assert_(nx.allclose(nscores,cnscores,rtol=1e-3))
 
 
+    def test_cross_validate_parallel(self):
+        """Parallel cross validation gives the same scores as serial"""
+        rc.mincount = 0
+        rc.min_infogain = 0
+        rc.type_mask = []
+        nx.random.seed(0)
+        positives = [nx.unique(nx.random.randint(1,50,10)) for i in range(30)]
+        negatives = [nx.unique(nx.random.randint(1,50,10)) for i in range(90)]
+        featinfo = FeatureScores([0]*50, "scores_laplace_split")
+        pscores, nscores = cross_validate(featinfo, positives, negatives, 5)
+        pscores2, nscores2 = cross_validate(featinfo, positives, negatives, 5, 3)
+        self.assert_(nx.all(pscores == pscores2))
+        self.assert_(nx.all(nscores == nscores2))
+        # Counting the features of each fold up front gives the same scores
+        folds = make_folds(PackedVectors(positives), PackedVectors(negatives), 5, 50)
+        for nprocs in [1, 3]:
+            pscores3, nscores3 = cross_validate(
+                featinfo, positives, negatives, 5, nprocs, folds)
+            self.assert_(nx.all(pscores == pscores3))
+            self.assert_(nx.all(nscores == nscores3))
+
+
+    def test_cross_validate_featmap(self):
+        """Parallel cross validation masking types from a feature mapping"""
+        from mscanner.medline.FeatureMapping import FeatureMapping
+        rc.mincount = 0
+        rc.min_infogain = 0
+        rc.type_mask = ["T"]
+        home = path(tempfile.mkdtemp(prefix="validate-"))
+        try:
+            fm = FeatureMapping(home/"fmap.db")
+            nx.random.seed(0)
+            articles = [dict(Q=list(nx.random.randint(0,20,5).astype(str)), 
+                             T=list(nx.random.randint(0,20,5).astype(str)))
+                        for i in range(120)]
+            vectors = [nx.array(fm.add_article(a), nx.uint32) for a in articles]
+            fm.close()
+            fm = FeatureMapping(home/"fmap.db")
+            featinfo = FeatureScores(fm, "scores_laplace_split")
+            pscores, nscores = cross_validate(
+                featinfo, vectors[:30], vectors[30:], 5)
+            pscores2, nscores2 = cross_validate(
+                featinfo, vectors[:30], vectors[30:], 5, 3)
+            self.assert_(nx.all(pscores == pscores2))
+            self.assert_(nx.all(nscores == nscores2))
+            self.failIf(nx.any(featinfo.selected & fm.type_mask(["T"])))
+            # The parent connection is still usable
+            self.assertEqual(fm.get_feature(1)[1], "Q")
+            fm.close()
+        finally:
+            home.rmtree(ignore_errors=True)
+
+
     def test_cross_validate(self):
         """Cross validation with scores_laplace_split."""
         rc.mincount = 0